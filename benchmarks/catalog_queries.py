@@ -0,0 +1,178 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Cross-graph query time: matching metadata descriptors by string vs joining
+through the catalog graph.
+
+Loads batches of synthetic crates (with their catalog entries) into a
+running Fuseki (FUSEKI_BASE_URL / FUSEKI_DATASET, see .env.example; use a
+scratch dataset) and, after each batch, times a few lookups written both
+ways: the legacy queries, which filter every CreativeWork on
+contains(str(?md), "ro-crate-metadata.json"), and the current ones from
+utils/queries.py. The benchmark's graphs and catalog entries are removed at
+the end.
+
+Usage: python benchmarks/catalog_queries.py [N_CRATES ...]
+"""
+
+import argparse
+import asyncio
+import time
+
+from rdflib import Graph, Literal, Namespace, RDF, URIRef
+
+import provstor_api.routes.upload as upload
+from provstor_api.utils.catalog import CATALOG_GRAPH, catalog_graph
+from provstor_api.utils.query import aclose_sparql_client, arun_query, arun_update
+from provstor_api.utils.queries import ACTIONS_FOR_RESULT_QUERY, CRATE_URLS_QUERY, GRAPH_ID_FOR_FILE_QUERY
+
+
+SDO = Namespace("http://schema.org/")
+GRAPH_PREFIX = "http://benchmark.provstor/catalog_queries/"
+BATCH_SIZE = 100
+REPEAT = 5
+
+LEGACY_ACTIONS_FOR_RESULT_QUERY = """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?action
+WHERE {
+  ?md a schema:CreativeWork .
+  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+  ?md schema:about ?rde .
+  ?rde schema:mentions ?action .
+  ?action a schema:CreateAction .
+  ?action schema:result <%s> .
+}
+"""
+
+LEGACY_GRAPH_ID_FOR_FILE_QUERY = """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?url
+WHERE {
+  ?md a schema:CreativeWork .
+  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+  ?md schema:about ?rde .
+  ?rde schema:url ?url .
+  ?rde schema:hasPart <%s> .
+}
+"""
+
+LEGACY_CRATE_URLS_QUERY = """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?rde ?crate_url
+WHERE {
+  GRAPH ?g {
+    ?md a schema:CreativeWork .
+    FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+    ?md schema:about ?rde .
+    FILTER(STRSTARTS(STR(?md), "arcp://uuid,"))
+    ?rde schema:url ?crate_url .
+  }
+}
+"""
+
+
+CLEANUP_CATALOG_UPDATE = f"""\
+PREFIX schema: <http://schema.org/>
+
+DELETE {{ GRAPH <{CATALOG_GRAPH}> {{ ?md schema:about ?rde . ?rde ?p ?o }} }}
+WHERE {{
+  GRAPH <{CATALOG_GRAPH}> {{
+    ?rde schema:url ?url .
+    FILTER(STRSTARTS(?url, "{GRAPH_PREFIX}"))
+    ?rde ?p ?o .
+    OPTIONAL {{ ?md schema:about ?rde }}
+  }}
+}}
+"""
+
+
+def make_crate(i):
+    base = f"arcp://uuid,00000000-0000-0000-0000-{i:012d}/"
+    rde = URIRef(base)
+    g = Graph()
+    md = URIRef(f"{base}ro-crate-metadata.json")
+    g.add((md, RDF.type, SDO.CreativeWork))
+    g.add((md, SDO.about, rde))
+    g.add((rde, RDF.type, SDO.Dataset))
+    g.add((rde, SDO.url, Literal(f"{GRAPH_PREFIX}{i}.zip")))
+    g.add((rde, SDO.mainEntity, URIRef(f"{base}workflow.cwl")))
+    for j in range(5):
+        action = URIRef(f"{base}#action-{j}")
+        g.add((rde, SDO.mentions, action))
+        g.add((action, RDF.type, SDO.CreateAction))
+        for kind, prop in ("in", SDO.object), ("out", SDO.result):
+            f = URIRef(f"file:/benchmark/{i}/{kind}/{j}.txt")
+            g.add((action, prop, f))
+            g.add((f, RDF.type, SDO.MediaObject))
+            g.add((rde, SDO.hasPart, f))
+        # other creative works, which the legacy queries have to scan
+        g.add((URIRef(f"{base}#howto-{j}"), RDF.type, SDO.CreativeWork))
+    return f"{GRAPH_PREFIX}{i}.zip", g
+
+
+async def timed(query):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        await arun_query(query)
+    return (time.perf_counter() - start) / REPEAT
+
+
+async def cleanup(n_crates):
+    for i in range(n_crates):
+        await arun_update(f"DROP SILENT GRAPH <{GRAPH_PREFIX}{i}.zip>")
+    await arun_update(CLEANUP_CATALOG_UPDATE)
+
+
+async def run(sizes):
+    result, file_ = "file:/benchmark/0/out/0.txt", "file:/benchmark/0/in/0.txt"
+    lookups = [
+        ("actions-for-result", LEGACY_ACTIONS_FOR_RESULT_QUERY % result, ACTIONS_FOR_RESULT_QUERY.bind(result=result)),
+        ("graphs-for-file", LEGACY_GRAPH_ID_FOR_FILE_QUERY % file_, GRAPH_ID_FOR_FILE_QUERY.bind(file=file_)),
+        ("crate-urls", LEGACY_CRATE_URLS_QUERY, CRATE_URLS_QUERY),
+    ]
+    print(f"{'crates':>8} {'lookup':>20} {'legacy s':>10} {'catalog s':>10}")
+    loaded = 0
+    try:
+        for n_crates in sorted(sizes):
+            while loaded < n_crates:
+                batch = dict(make_crate(i) for i in range(loaded, min(loaded + BATCH_SIZE, n_crates)))
+                batch[CATALOG_GRAPH] = catalog_graph(*batch.values())
+                await upload.store_graphs(batch)
+                loaded += len(batch) - 1
+            for name, legacy, current in lookups:
+                legacy_time = await timed(legacy)
+                current_time = await timed(current)
+                print(f"{n_crates:>8} {name:>20} {legacy_time:>10.4f} {current_time:>10.4f}")
+    finally:
+        await cleanup(loaded)
+        await aclose_sparql_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sizes", metavar="N_CRATES", type=int, nargs="*", default=[100, 1000, 10000])
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Time to load crate metadata into Fuseki: SPARQL INSERT DATA vs Graph Store
+Protocol.
+
+Loads synthetic provenance graphs of increasing size into a running Fuseki
+(FUSEKI_BASE_URL / FUSEKI_DATASET, see .env.example) through the upload
+path, store_graphs, both as a single INSERT DATA update and by streaming
+N-Quads to the dataset's Graph Store HTTP endpoint, and reports the
+wall-clock time (serialization included) and the peak Python memory
+allocation on the client side. Each graph is dropped after being loaded.
+
+Usage: python benchmarks/graph_load.py [N_ACTIONS ...]
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from rdflib import Graph, Literal, Namespace, RDF, URIRef
+
+import provstor_api.routes.upload as upload
+from provstor_api.config import settings
+from provstor_api.utils.query import aclose_sparql_client, arun_update
+
+
+SDO = Namespace("http://schema.org/")
+BASE = "arcp://uuid,00000000-0000-0000-0000-000000000000/"
+GRAPH = "http://benchmark.provstor/graph_load"
+
+
+def make_graph(n_actions):
+    g = Graph()
+    for i in range(n_actions):
+        action = URIRef(f"{BASE}#action-{i}")
+        g.add((action, RDF.type, SDO.CreateAction))
+        g.add((action, SDO.name, Literal(f"Run of step {i}")))
+        g.add((action, SDO.startTime, Literal("2026-01-01T00:00:00Z")))
+        for kind, prop in ("in", SDO.object), ("out", SDO.result):
+            for j in range(3):
+                f = URIRef(f"{BASE}{kind}/{i}/file-{j}.txt")
+                g.add((action, prop, f))
+                g.add((f, RDF.type, SDO.MediaObject))
+                g.add((f, SDO.contentSize, Literal(str(1024 * j))))
+    return g
+
+
+async def load(g, graph_store):
+    settings.fuseki_graph_store = graph_store
+    tracemalloc.start()
+    start = time.perf_counter()
+    await upload.store_graphs({GRAPH: g})
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    await arun_update(f"DROP SILENT GRAPH <{GRAPH}>")
+    return elapsed, peak
+
+
+async def run(sizes):
+    print(f"{'triples':>10} {'method':>12} {'seconds':>10} {'peak MB':>10}")
+    await arun_update(f"DROP SILENT GRAPH <{GRAPH}>")
+    for n_actions in sizes:
+        g = make_graph(n_actions)
+        for method, graph_store in ("insert-data", False), ("graph-store", True):
+            elapsed, peak = await load(g, graph_store)
+            print(f"{len(g):>10} {method:>12} {elapsed:>10.2f} {peak / 2**20:>10.1f}")
+    await aclose_sparql_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sizes", metavar="N_ACTIONS", type=int, nargs="*", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+SPARQL SELECT result parsing: rdflib terms vs plain strings.
+
+Builds synthetic result documents (an IRI, a literal with a language tag and
+a typed literal per row, like a lineage or listing query returns) and times
+turning them into rows of strings: with rdflib's result parsers, for the
+XML and JSON result formats, followed by str() on every term, as the
+endpoints used to do; and with the parsers used by run_select, for JSON and
+TSV. No store is needed, so only the parsing cost is measured.
+
+Usage: python benchmarks/result_parsing.py [N_ROWS ...]
+"""
+
+import argparse
+from io import BytesIO
+import json
+import time
+from xml.sax.saxutils import escape
+
+from rdflib.query import Result
+
+from provstor_api.utils.query import _json_rows, _tsv_rows
+
+
+REPEAT = 5
+XSD_INTEGER = "http://www.w3.org/2001/XMLSchema#integer"
+
+
+def make_rows(n_rows):
+    return [(f"arcp://uuid,{i:012d}/#action-{i % 7}", f"result \"{i}\"\tof run", str(i)) for i in range(n_rows)]
+
+
+def to_json(rows):
+    return json.dumps({
+        "head": {"vars": ["s", "label", "n"]},
+        "results": {"bindings": [{
+            "s": {"type": "uri", "value": s},
+            "label": {"type": "literal", "xml:lang": "en", "value": label},
+            "n": {"type": "literal", "datatype": XSD_INTEGER, "value": n},
+        } for s, label, n in rows]},
+    }).encode()
+
+
+def to_tsv(rows):
+    lines = ["?s\t?label\t?n"]
+    for s, label, n in rows:
+        label = label.replace("\\", "\\\\").replace('"', '\\"').replace("\t", "\\t")
+        lines.append(f'<{s}>\t"{label}"@en\t{n}')
+    return ("\n".join(lines) + "\n").encode()
+
+
+def to_xml(rows):
+    out = ['<?xml version="1.0"?>\n<sparql xmlns="http://www.w3.org/2005/sparql-results#">',
+           '<head><variable name="s"/><variable name="label"/><variable name="n"/></head><results>']
+    for s, label, n in rows:
+        out.append(
+            f'<result><binding name="s"><uri>{escape(s)}</uri></binding>'
+            f'<binding name="label"><literal xml:lang="en">{escape(label)}</literal></binding>'
+            f'<binding name="n"><literal datatype="{XSD_INTEGER}">{n}</literal></binding></result>'
+        )
+    out.append("</results></sparql>")
+    return "\n".join(out).encode()
+
+
+def rdflib_rows(content_type):
+    def parse(content):
+        result = Result.parse(BytesIO(content), content_type=content_type)
+        return [tuple(None if _ is None else str(_) for _ in row) for row in result]
+    return parse
+
+
+def timed(parse, content):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        rows = parse(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+def run(sizes):
+    parsers = [
+        ("rdflib xml", to_xml, rdflib_rows("application/sparql-results+xml")),
+        ("rdflib json", to_json, rdflib_rows("application/sparql-results+json")),
+        ("json rows", to_json, _json_rows),
+        ("tsv rows", to_tsv, _tsv_rows),
+    ]
+    print(f"{'rows':>8} {'parser':>12} {'MB':>8} {'best s':>10} {'rows/s':>12}")
+    for n_rows in sorted(sizes):
+        rows = make_rows(n_rows)
+        for name, serialize, parse in parsers:
+            content = serialize(rows)
+            elapsed, parsed = timed(parse, content)
+            assert parsed == rows, f"{name} rows differ"
+            print(f"{n_rows:>8} {name:>12} {len(content) / 2**20:>8.1f} {elapsed:>10.4f} {n_rows / elapsed:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sizes", metavar="N_ROWS", type=int, nargs="*", default=[1000, 10000, 100000])
+    args = parser.parse_args()
+    run(args.sizes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Peak memory of the crate upload path with large synthetic crates.
+
+Runs load_crate_metadata in-process, with the S3 client and the SPARQL store
+replaced by local stand-ins, and reports the peak Python memory allocation
+(as measured by tracemalloc) for each crate size. Uploads go through
+S3ObjectStore, and the stand-in client consumes them in multipart-sized
+chunks. Peak memory is expected to stay flat as the crate size grows.
+
+Usage: python benchmarks/upload_memory.py [SIZE_MB ...]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+from fastapi import UploadFile
+
+import provstor_api.routes.upload as upload
+import provstor_api.utils.storage as storage
+from provstor_api.config import settings
+
+
+METADATA = {
+    "@context": {"@vocab": "http://schema.org/"},
+    "@graph": [
+        {"@id": "ro-crate-metadata.json", "@type": "CreativeWork", "about": {"@id": "./"}},
+        {"@id": "./", "@type": "Dataset", "hasPart": {"@id": "data.bin"}},
+        {"@id": "data.bin", "@type": "MediaObject"},
+    ]
+}
+CHUNK_SIZE = 1024 * 1024
+
+
+class LocalS3:
+    """\
+    Stand-in for the S3 client that consumes uploads in multipart-sized
+    chunks, like boto3's managed transfer does.
+    """
+
+    exceptions = type("exceptions", (), {"BucketAlreadyExists": KeyError, "BucketAlreadyOwnedByYou": KeyError})
+
+    def create_bucket(self, **kwargs):
+        pass
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        while fileobj.read(Config.multipart_chunksize if Config else settings.s3_multipart_chunksize):
+            pass
+
+
+async def noop(*args, **kwargs):
+    return []
+
+
+def make_crate(path, size_mb):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zf:
+        zf.writestr("ro-crate-metadata.json", json.dumps(METADATA))
+        with zf.open("data.bin", "w", force_zip64=True) as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(CHUNK_SIZE))
+
+
+def upload_crate(path):
+    with open(path, "rb") as f:
+        crate = UploadFile(f, filename=os.path.basename(path), headers={"content-type": "application/zip"})
+        return asyncio.run(upload.load_crate_metadata(crate))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sizes", metavar="SIZE_MB", type=int, nargs="*", default=[16, 256, 1024])
+    args = parser.parse_args()
+    upload.arun_select = upload.arun_update = upload.aload_quads = noop
+    print(f"{'crate MB':>10} {'peak MB':>10} {'seconds':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage.set_object_store(storage.S3ObjectStore(None, None, None, settings.seaweedfs_bucket, client=LocalS3()))
+        # warm up: load parser plugins etc. outside of the measurements
+        path = os.path.join(tmp_dir, "warmup.zip")
+        make_crate(path, 1)
+        upload_crate(path)
+        for size_mb in args.sizes:
+            path = os.path.join(tmp_dir, f"crate_{size_mb}.zip")
+            make_crate(path, size_mb)
+            tracemalloc.start()
+            start = time.perf_counter()
+            upload_crate(path)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            os.unlink(path)
+            print(f"{size_mb:>10} {peak / 2**20:>10.1f} {elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
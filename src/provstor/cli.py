@@ -17,6 +17,8 @@
 
 
 import atexit
+from contextlib import ExitStack
+from itertools import islice
 import logging
 import sys
 from pathlib import Path
@@ -31,6 +33,9 @@ from . import __version__
 
 
 LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
+# ids sent in each request by the commands that read them from stdin
+ID_BATCH_SIZE = 10000
+LIST_PAGE_SIZE = 1000
 
 
 def _log_error(response):
@@ -50,6 +55,49 @@ def get_base_api_url():
     return f"http://{API_HOST}:{API_PORT}"
 
 
+def _get_for_ids(path, stream):
+    """\
+    Look up the ids read from stream, in batches, with the POST variant of
+    the /get/{path}/ endpoint.
+    """
+    url = f"{get_base_api_url()}/get/{path}/"
+    ids = (line.strip() for line in stream)
+    ids = (_ for _ in ids if _)
+    while batch := list(islice(ids, ID_BATCH_SIZE)):
+        try:
+            response = requests.post(url, json=batch)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            _log_error(response)
+            raise
+        for id_, matches in response.json()['result'].items():
+            if not matches:
+                logging.debug("Nothing found for '%s'", id_)
+            for item in matches:
+                sys.stdout.write(f"{id_}\t{item}\n")
+
+
+def _list_pages(path, prefix):
+    """\
+    Get all the items listed by the /query/{path}/ endpoint, one page at a
+    time.
+    """
+    url = f"{get_base_api_url()}/query/{path}/"
+    params = {"prefix": prefix, "limit": LIST_PAGE_SIZE}
+    while True:
+        try:
+            response = requests.get(url, params=params)
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            _log_error(response)
+            raise
+        page = response.json()
+        yield from page['result']
+        if not page.get('next_cursor'):
+            break
+        params["cursor"] = page['next_cursor']
+
+
 @click.group()
 @click.option(
     "-l",
@@ -61,33 +109,23 @@ def cli(log_level):
     logging.basicConfig(level=getattr(logging, log_level))
 
 
-@cli.command()
-@click.argument(
-    "crate",
-    metavar="RO_CRATE",
-    type=click.Path(exists=True, readable=True, path_type=Path),
-)
-def load(crate):
+def _zip_crate(crate):
     """\
-    Load RO-Crate metadata into Fuseki and upload zipped crate to SeaweedFS.
-
-    RO_CRATE: RO-Crate directory or ZIP archive.
+    Return the path of the zipped crate and the name it is uploaded with,
+    zipping it to a temporary location if it is a directory.
     """
     if zipfile.is_zipfile(crate):
-        crate_path = crate
-        crate_name = crate_path.name
-    else:
-        if not crate.is_dir():
-            raise click.ClickException("Crate must be either a zip file or a directory.")
-        tmp_dir = Path(tempfile.mkdtemp(prefix="provstor_"))
-        atexit.register(shutil.rmtree, tmp_dir)
-        crate = crate.absolute()
-        dest_path = tmp_dir / crate.name
-        crate_name = f"{crate.name}.zip"
-        crate_path = shutil.make_archive(dest_path, 'zip', crate)
+        return crate, crate.name
+    if not crate.is_dir():
+        raise click.ClickException("Crate must be either a zip file or a directory.")
+    tmp_dir = Path(tempfile.mkdtemp(prefix="provstor_"))
+    atexit.register(shutil.rmtree, tmp_dir)
+    crate = crate.absolute()
+    dest_path = tmp_dir / crate.name
+    return shutil.make_archive(dest_path, 'zip', crate), f"{crate.name}.zip"
 
-    logging.info("Crate path: %s", crate_path)
 
+def _load_crate(crate_path, crate_name, no_wait):
     url = f"{get_base_api_url()}/upload/crate/"
 
     try:
@@ -96,10 +134,14 @@ def load(crate):
             response = requests.post(
                 url,
                 files={'crate_path': (crate_name, crate_to_upload, 'application/zip')},
+                params={'async_mode': no_wait},
             )
         response.raise_for_status()
         json_res = response.json()
-        if json_res['result'] == "success":
+        if json_res['result'] == "accepted":
+            logging.info("Crate queued for ingestion")
+            sys.stdout.write(f"{json_res['job_id']}\n")
+        elif json_res['result'] == "success":
             logging.info("Crate successfully uploaded")
             logging.info("Crate URL: %s", json_res['crate_url'])
     except requests.exceptions.HTTPError:
@@ -107,6 +149,86 @@ def load(crate):
         raise
 
 
+def _load_crates(zipped_crates):
+    url = f"{get_base_api_url()}/upload/crates/"
+
+    try:
+        with ExitStack() as stack:
+            files = [
+                ('crate_paths', (crate_name, stack.enter_context(open(crate_path, 'rb')), 'application/zip'))
+                for crate_path, crate_name in zipped_crates
+            ]
+            logging.info("Uploading %d crates to %s", len(files), url)
+            response = requests.post(url, files=files)
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        _log_error(response)
+        raise
+    n_failed = 0
+    for res in response.json()['crates']:
+        if res['result'] == "success":
+            logging.info("Crate %s successfully uploaded", res['filename'])
+            logging.info("Crate URL: %s", res['crate_url'])
+        else:
+            logging.error("%s: %s", res['filename'], res['detail'])
+            n_failed += 1
+    if n_failed:
+        raise click.ClickException(f"failed to load {n_failed} out of {len(zipped_crates)} crates")
+
+
+@cli.command()
+@click.argument(
+    "crates",
+    metavar="RO_CRATE...",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, readable=True, path_type=Path),
+)
+@click.option(
+    "--no-wait",
+    is_flag=True,
+    help="Queue the crates for ingestion and print their job IDs instead of waiting",
+)
+def load(crates, no_wait):
+    """\
+    Load RO-Crate metadata into Fuseki and upload zipped crates to SeaweedFS.
+
+    RO_CRATE: RO-Crate directory or ZIP archive. Multiple crates are loaded
+    with a single request (or queued as one job each with --no-wait).
+    """
+    zipped_crates = [_zip_crate(crate) for crate in crates]
+    for crate_path, _ in zipped_crates:
+        logging.info("Crate path: %s", crate_path)
+
+    if no_wait or len(zipped_crates) == 1:
+        for crate_path, crate_name in zipped_crates:
+            _load_crate(crate_path, crate_name, no_wait)
+    else:
+        _load_crates(zipped_crates)
+
+
+@cli.command()
+@click.argument(
+    "job_id",
+    metavar="JOB_ID",
+)
+def job_status(job_id):
+    """\
+    Show the status of an upload job started with load --no-wait.
+
+    JOB_ID: the job ID printed by load --no-wait.
+    """
+    url = f"{get_base_api_url()}/upload/jobs/{job_id}"
+    try:
+        response = requests.get(url)
+        response.raise_for_status()
+        for k, v in response.json().items():
+            sys.stdout.write(f"{k}: {v}\n")
+    except requests.exceptions.HTTPError:
+        _log_error(response)
+        raise
+
+
 @cli.command()
 @click.argument(
     "query_file",
@@ -119,24 +241,63 @@ def load(crate):
     metavar="STRING",
     help="Graph name (crate basename without extension)",
 )
-def query(query_file, graph):
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "tsv", "ndjson"]),
+    help="Stream the results in this format, as returned by the API (SELECT queries only)",
+)
+@click.option(
+    "-l",
+    "--limit",
+    type=click.IntRange(min=1),
+    help="Maximum number of results (the cursor for the next page goes to stderr)",
+)
+@click.option(
+    "-c",
+    "--cursor",
+    metavar="STRING",
+    help="Cursor returned by a previous run with the same query and limit",
+)
+def query(query_file, graph, output_format, limit, cursor):
     """\
     Run the SPARQL query in the provided file on the Fuseki store.
 
+    Results are printed one per line, or, with --format, streamed as they
+    arrive.
+
     QUERY_FILE: SPARQL query file path.
     """
     query_text = query_file.read_text()
 
     url = f"{get_base_api_url()}/query/run-query/"
-
-    try:
-        response = requests.post(url, files={'query_file': query_text}, params={'graph': graph})
-        response.raise_for_status()
-        for row in response.json()['result']:
-            sys.stdout.write(", ".join(row) + "\n")
-    except requests.exceptions.HTTPError:
-        _log_error(response)
-        raise
+    params = {
+        "graph": graph,
+        "format": output_format or "json",
+        "limit": limit,
+        "cursor": cursor,
+    }
+
+    with requests.post(url, files={'query_file': query_text}, params=params, stream=True) as response:
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            _log_error(response)
+            raise
+        if output_format:
+            for chunk in response.iter_content(chunk_size=None):
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            next_cursor = response.headers.get("X-Next-Cursor")
+        else:
+            # SELECT solutions or CONSTRUCT/DESCRIBE triples
+            res = response.json()
+            for row in res["result"]:
+                sys.stdout.write(", ".join("" if _ is None else str(_) for _ in row) + "\n")
+            next_cursor = res.get("next_cursor")
+        if next_cursor:
+            sys.stderr.write(f"next cursor: {next_cursor}\n")
 
 
 @cli.command()
@@ -250,7 +411,13 @@ def get_graphs_for_file(file_id):
     Get the ids of the graphs that contain (hasPart) the given file.
 
     FILE_ID: full URI of the file (e.g. "file://...").
+
+    Use "-" to read ids from standard input, one per line: each line of the
+    output then has an id and one of its matches, separated by a tab.
     """
+    if file_id == "-":
+        _get_for_ids("graphs-for-file", sys.stdin)
+        return
     url = f"{get_base_api_url()}/get/graphs-for-file/"
 
     try:
@@ -279,7 +446,13 @@ def get_graphs_for_result(result_id):
     CreateAction.
 
     RESULT_ID: RO-Crate id of the result (e.g. "file://...").
+
+    Use "-" to read ids from standard input, one per line: each line of the
+    output then has an id and one of its matches, separated by a tab.
     """
+    if result_id == "-":
+        _get_for_ids("graphs-for-result", sys.stdin)
+        return
     url = f"{get_base_api_url()}/get/graphs-for-result/"
 
     try:
@@ -395,7 +568,13 @@ def get_objects_for_result(result_id):
     Get objects that are related to the given result in a CreateAction.
 
     RESULT_ID: RO-Crate id of the result (e.g. "file://...").
+
+    Use "-" to read ids from standard input, one per line: each line of the
+    output then has an id and one of its matches, separated by a tab.
     """
+    if result_id == "-":
+        _get_for_ids("objects-for-result", sys.stdin)
+        return
     url = f"{get_base_api_url()}/get/objects-for-result/"
 
     try:
@@ -423,7 +602,13 @@ def get_actions_for_result(result_id):
     Get actions that have the given result.
 
     RESULT_ID: RO-Crate id of the result (e.g. "file://...").
+
+    Use "-" to read ids from standard input, one per line: each line of the
+    output then has an id and one of its matches, separated by a tab.
     """
+    if result_id == "-":
+        _get_for_ids("actions-for-result", sys.stdin)
+        return
     url = f"{get_base_api_url()}/get/actions-for-result/"
 
     try:
@@ -451,7 +636,13 @@ def get_objects_for_action(action_id):
     Get the objects of the given CreateAction.
 
     ACTION_ID: id of the CreateAction (e.g. "arcp://...").
+
+    Use "-" to read ids from standard input, one per line: each line of the
+    output then has an id and one of its matches, separated by a tab.
     """
+    if action_id == "-":
+        _get_for_ids("objects-for-action", sys.stdin)
+        return
     url = f"{get_base_api_url()}/get/objects-for-action/"
 
     try:
@@ -479,7 +670,13 @@ def get_results_for_action(action_id):
     Get the results of the given CreateAction.
 
     ACTION_ID: id of the CreateAction (e.g. "arcp://...").
+
+    Use "-" to read ids from standard input, one per line: each line of the
+    output then has an id and one of its matches, separated by a tab.
     """
+    if action_id == "-":
+        _get_for_ids("results-for-action", sys.stdin)
+        return
     url = f"{get_base_api_url()}/get/results-for-action/"
 
     try:
@@ -527,38 +724,32 @@ def get_run_params(graph_id):
 
 
 @cli.command()
-def list_graphs():
+@click.option(
+    "-p",
+    "--prefix",
+    metavar="STRING",
+    help="Only list graphs starting with this (a URL or the start of a crate name)",
+)
+def list_graphs(prefix):
     """\
     List all graphs in the triple store.
     """
-    url = f"{get_base_api_url()}/query/list-graphs/"
-
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError:
-        _log_error(response)
-        raise
-
-    for row in response.json()['result']:
+    for row in _list_pages("list-graphs", prefix):
         sys.stdout.write(row + "\n")
 
 
 @cli.command()
-def list_rde_graphs():
+@click.option(
+    "-p",
+    "--prefix",
+    metavar="STRING",
+    help="Only list graphs starting with this (a URL or the start of a crate name)",
+)
+def list_rde_graphs(prefix):
     """\
     List all graphs in the triple store and the associated RDE ids.
     """
-    url = f"{get_base_api_url()}/query/list-RDE-graphs/"
-
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.exceptions.HTTPError:
-        _log_error(response)
-        raise
-
-    for row in response.json()['result']:
+    for row in _list_pages("list-RDE-graphs", prefix):
         sys.stdout.write('\t'.join(row) + "\n")
 
 
@@ -690,6 +881,73 @@ def movechain(path_id):
         sys.stdout.write(item + "\n")
 
 
+@cli.command()
+def check_lineage_index():
+    """\
+    Check that the API's in-memory lineage index matches the triple store.
+    """
+    url = f"{get_base_api_url()}/admin/lineage-index/check"
+
+    try:
+        response = requests.get(url)
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        _log_error(response)
+        raise
+
+    result = response.json()['result']
+    for key in "ready", "consistent", "ids", "facts", "n_missing", "n_extra":
+        sys.stdout.write(f"{key}: {result[key]}\n")
+    for key in "missing", "extra":
+        for item in result[key]:
+            sys.stdout.write(f"{key}: {' '.join(item)}\n")
+
+
+@cli.command()
+def rebuild_lineage_index():
+    """\
+    Rebuild the API's in-memory lineage index from the triple store.
+    """
+    url = f"{get_base_api_url()}/admin/lineage-index/rebuild"
+
+    try:
+        response = requests.post(url)
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        _log_error(response)
+        raise
+
+    logging.info("Lineage index rebuilt: %s ids", response.json()['ids'])
+
+
+@cli.command()
+@click.option(
+    "-g",
+    "--graph",
+    metavar="STRING",
+    help="Graph name (crate basename without extension). Default: all crates",
+)
+def rebuild_member_index(graph):
+    """\
+    Rebuild the member index used to extract files from stored crates.
+    """
+    url = f"{get_base_api_url()}/admin/member-index/rebuild"
+
+    try:
+        response = requests.post(url, params={'graph': graph})
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        _log_error(response)
+        raise
+
+    result = response.json()
+    logging.info("Member index rebuilt for %s crates", result['indexed'])
+    for crate_url in result['failed']:
+        logging.error("failed to index %s", crate_url)
+    if result['failed']:
+        raise click.ClickException(f"failed to index {len(result['failed'])} crates")
+
+
 @cli.command()
 def version():
     """\
@@ -26,9 +26,35 @@ class Settings(BaseSettings):
     seaweedfs_user: str = "admin"
     seaweedfs_access_key: str = "admin_access_key"
     seaweedfs_secret_key: str = "admin_secret_key"
+    seaweedfs_timeout: float = 60.0
+    seaweedfs_read_buffer_size: int = 256 * 1024
+    member_index_cache_size: int = 1024
+    run_summary_cache_size: int = 1024
+    crate_url_cache_size: int = 100000
+    query_cache_size: int = 64 * 1024 * 1024
+    query_cache_ttl: float = 3600.0
+    crate_cache_dir: str = ""
+    crate_cache_size: int = 2 * 1024 * 1024 * 1024
+    crate_cache_max_entry_size: int = 256 * 1024 * 1024
+    s3_multipart_threshold: int = 16 * 1024 * 1024
+    s3_multipart_chunksize: int = 8 * 1024 * 1024
+    s3_max_concurrency: int = 4
+    s3_batch_concurrency: int = 8
     fuseki_base_url: str = "http://fuseki:3030"
     fuseki_dataset: str = "ds"
+    fuseki_pool_size: int = 10
+    fuseki_timeout: float = 60.0
+    fuseki_connect_timeout: float = 5.0
+    fuseki_graph_store: bool = True
+    sparql_batch_size: int = 200
+    lineage_index: bool = True
+    upload_workers: int = 4
+    upload_queue_size: int = 100
+    upload_max_jobs: int = 1000
     cors_allowed_origins: str = ""
+    server_timing: bool = True
+    slow_query_threshold: float = 1.0
+    tracing_exporter: str = ""
     dev_mode: bool = False
 
 
@@ -16,19 +16,61 @@
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
 
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
 import os
 import uvicorn
 import logging
 from fastapi.middleware.cors import CORSMiddleware
 
-from provstor_api.routes import upload, query, get, backtrack, pathops
+from provstor_api.routes import upload, query, get, backtrack, pathops, admin
 from provstor_api.config import settings
+from provstor_api.utils.catalog import backfill_catalog
+from provstor_api.utils.lineage import build_lineage_index
+from provstor_api.utils.lookup import prewarm_crate_urls
+from provstor_api.utils.metrics import (
+    PROMETHEUS_CONTENT_TYPE, MetricsMiddleware, TimedJSONResponse, render_metrics
+)
+from provstor_api.utils.query import aclose_sparql_client, close_sparql_client
+from provstor_api.utils.storage import (
+    aclose_filer_client, close_filer_sync_client, close_object_store, get_object_store
+)
+from provstor_api.utils.templates import InvalidTermError
+from provstor_api.utils.tracing import TracingMiddleware, exporter_from_name, set_exporter
 
 logging.getLogger().setLevel(logging.INFO)
 
-app = FastAPI(title="Provenance Storage API", version="1.0")
+
+async def _setup_catalog():
+    await backfill_catalog()
+    # answer downloads without querying the store for each crate's URL
+    await prewarm_crate_urls()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    set_exporter(exporter_from_name(settings.tracing_exporter))
+    get_object_store()
+    if settings.lineage_index:
+        # build in the background, backtrack queries the store until ready
+        app.state.lineage_index_build = asyncio.create_task(build_lineage_index())
+    app.state.catalog_setup = asyncio.create_task(_setup_catalog())
+    upload.ingest_queue.start()
+    yield
+    # the catalog setup retries until the store answers
+    app.state.catalog_setup.cancel()
+    await upload.ingest_queue.stop()
+    close_sparql_client()
+    await aclose_sparql_client()
+    await aclose_filer_client()
+    close_filer_sync_client()
+    close_object_store()
+
+
+app = FastAPI(title="Provenance Storage API", version="1.0", lifespan=lifespan,
+              default_response_class=TimedJSONResponse)
 
 allowed_origins = settings.cors_allowed_origins.split(",") if settings.cors_allowed_origins else []
 app.add_middleware(
@@ -39,6 +81,9 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["Content-Disposition"],
 )
+# outermost, so that the whole request is timed and traced
+app.add_middleware(MetricsMiddleware, server_timing=settings.server_timing)
+app.add_middleware(TracingMiddleware)
 
 
 app.include_router(upload.router, prefix="/upload", tags=["Upload"])
@@ -46,6 +91,13 @@ app.include_router(query.router, prefix="/query", tags=["Query"])
 app.include_router(get.router, prefix="/get", tags=["Get"])
 app.include_router(backtrack.router, prefix="/backtrack", tags=["Backtrack"])
 app.include_router(pathops.router, prefix="/pathops", tags=["PathOps"])
+app.include_router(admin.router, prefix="/admin", tags=["Admin"])
+
+
+@app.exception_handler(InvalidTermError)
+async def invalid_term_handler(request, exc):
+    # ids that cannot be written in a query cannot be in the store either
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
 
 
 @app.get("/status/", tags=["Status"])
@@ -53,6 +105,11 @@ def check_status():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
 @app.get("/favicon.ico", include_in_schema=False)
 def favicon():
     icon_file = os.path.join(os.path.dirname(__file__), "static", "favicon.ico")
@@ -0,0 +1,85 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+from fastapi import APIRouter
+
+from provstor_api.utils.cache import get_crate_cache
+from provstor_api.utils.catalog import rebuild_catalog
+from provstor_api.utils.lineage import lineage_index
+from provstor_api.utils.lookup import query_cache
+from provstor_api.utils.members import rebuild_member_index
+from provstor_api.utils.queries import GRAPHS_QUERY
+from provstor_api.utils.summary import rebuild_run_summary
+from provstor_api.utils.query import resolve_graph_id, run_query
+
+router = APIRouter()
+
+
+@router.get("/lineage-index/check")
+def check_lineage_index():
+    return {"result": lineage_index.check(run_query)}
+
+
+@router.post("/lineage-index/rebuild")
+def rebuild_lineage_index():
+    lineage_index.rebuild(run_query)
+    return {"result": "success", "ids": len(lineage_index)}
+
+
+@router.post("/member-index/rebuild")
+def rebuild_crate_member_index(graph: str = None):
+    """\
+    Rebuild the member index of the given crate graph, or of all crates
+    (e.g., those uploaded before indexing was introduced).
+    """
+    if graph:
+        crate_urls = [str(resolve_graph_id(graph))]
+    else:
+        crate_urls = [str(_[0]) for _ in run_query(GRAPHS_QUERY)]
+    failed = rebuild_member_index(crate_urls)
+    return {"result": "success", "indexed": len(crate_urls) - len(failed), "failed": failed}
+
+
+@router.post("/run-summary/rebuild")
+def rebuild_crate_run_summary(graph: str = None):
+    """\
+    Rebuild the run summary of the given crate graph, or of all crates
+    (e.g., those uploaded before summaries were introduced).
+    """
+    if graph:
+        crate_urls = [str(resolve_graph_id(graph))]
+    else:
+        crate_urls = [str(_[0]) for _ in run_query(GRAPHS_QUERY)]
+    failed = rebuild_run_summary(crate_urls)
+    return {"result": "success", "summarized": len(crate_urls) - len(failed), "failed": failed}
+
+
+@router.post("/catalog/rebuild")
+def rebuild_crate_catalog():
+    rebuild_catalog()
+    query_cache.bump()
+    return {"result": "success"}
+
+
+@router.get("/crate-cache/stats")
+def crate_cache_stats():
+    return {"result": get_crate_cache().stats()}
+
+
+@router.get("/query-cache/stats")
+def query_cache_stats():
+    return {"result": query_cache.stats()}
@@ -16,41 +16,76 @@
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
 from fastapi import APIRouter
-from provstor_api.utils.get_utils import (
-    fetch_actions_for_result, fetch_objects_for_action, fetch_results_for_action
-)
+from provstor_api.utils.get_utils import fetch_lineage_level
+from provstor_api.utils.lineage import lineage_index
 
 router = APIRouter()
 
 
-def _backtrack_recursive(result_id, visited=None):
-    if visited is None:
-        visited = set()
+def _walk_lineage(result_id, actions_for_result, objects_for_action, results_for_action):
+    """\
+    Depth-first traversal of the lineage graph, starting from result_id.
 
-    if result_id in visited:
-        return []
+    Each object is visited once; the output order is the one of a recursive
+    visit that, for each action, recurses into its objects before moving on to
+    the next action.
+    """
+    output = []
+    visited = set()
+    stack = [iter([("visit", result_id)])]
+    while stack:
+        try:
+            kind, item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if kind == "action":
+            output.append({
+                "action": item,
+                "objects": objects_for_action.get(item, []),
+                "results": results_for_action.get(item, []),
+            })
+        elif item not in visited:
+            visited.add(item)
+            stack.append(iter([
+                step
+                for a in actions_for_result.get(item, [])
+                for step in [("action", a)] + [("visit", o) for o in objects_for_action.get(a, [])]
+            ]))
+    return output
 
-    visited.add(result_id)
-    results = []
 
-    actions = fetch_actions_for_result(result_id)
-    for a in actions:
-        objects = fetch_objects_for_action(a)
-        action_results = fetch_results_for_action(a)
-        results.append({
-            "action": a,
-            "objects": objects,
-            "results": action_results
-        })
-
-        for obj in objects:
-            nested_results = _backtrack_recursive(obj, visited)
-            results.extend(nested_results)
-
-    return results
+def backtrack_lineage(result_id):
+    """\
+    Fetch the lineage of result_id one frontier level at a time, so that the
+    number of queries grows with the depth of the lineage rather than with
+    the number of actions and objects in it.
+    """
+    actions_for_result = {}
+    objects_for_action = {}
+    results_for_action = {}
+    frontier = [result_id]
+    seen = {result_id}
+    while frontier:
+        level = fetch_lineage_level(frontier)
+        actions_for_result.update(level[0])
+        objects_for_action.update(level[1])
+        results_for_action.update(level[2])
+        next_frontier = []
+        for r in frontier:
+            for a in level[0].get(r, []):
+                for o in level[1].get(a, []):
+                    if o not in seen:
+                        seen.add(o)
+                        next_frontier.append(o)
+        frontier = next_frontier
+    return _walk_lineage(result_id, actions_for_result, objects_for_action, results_for_action)
 
 
 @router.get("/")
 def backtrack_fn(result_id: str):
-    backtrack_results = _backtrack_recursive(result_id)
+    if lineage_index.ready:
+        backtrack_results = _walk_lineage(result_id, *lineage_index.lineage(result_id))
+    else:
+        backtrack_results = backtrack_lineage(result_id)
     return {"result": backtrack_results}
@@ -16,24 +16,40 @@
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from fastapi.responses import StreamingResponse
+import httpx
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 import logging
-from urllib.request import urlopen
+import os
 from urllib.parse import urlsplit
 import zipfile
-import io
 
-from provstor_api.utils.query import run_query
+from provstor_api.utils.cache import cached_chunks, get_crate_cache, iter_file
+from provstor_api.utils.lookup import crate_urls, query_cache, rde_key
+from provstor_api.utils.members import STREAMABLE, get_member_index, stream_member
+from provstor_api.utils.query import arun_select, resolve_graph_id, run_query, run_select
+from provstor_api.utils.storage import open_crate, stream_crate
+from provstor_api.utils.summary import build_run_summary, read_run_summary
 from provstor_api.utils.queries import (
     CRATE_URL_QUERY, GRAPH_ID_FOR_FILE_QUERY,
     GRAPH_ID_FOR_RESULT_QUERY, WORKFLOW_QUERY, WFRUN_RESULTS_QUERY,
-    WFRUN_OBJECTS_QUERY, OBJECTS_FOR_RESULT_QUERY, WFRUN_PARAMS_QUERY
+    WFRUN_OBJECTS_QUERY, OBJECTS_FOR_RESULT_QUERY, WFRUN_PARAMS_QUERY,
+    GRAPH_IDS_FOR_FILES_QUERY, GRAPH_IDS_FOR_RESULTS_QUERY, ACTIONS_FOR_RESULTS_QUERY,
+    OBJECTS_FOR_RESULTS_QUERY, OBJECTS_FOR_ACTIONS_QUERY, RESULTS_FOR_ACTIONS_QUERY
+)
+from provstor_api.utils.get_utils import (
+    fetch_actions_for_result, fetch_for_ids, fetch_objects_for_action, fetch_results_for_action
 )
-from provstor_api.utils.get_utils import fetch_actions_for_result, fetch_objects_for_action, fetch_results_for_action
 
 router = APIRouter()
 
+CHUNK_SIZE = 1024 * 1024
+# response headers of the filer that are relayed by get_crate
+PASSTHROUGH_HEADERS = ["Content-Length", "Content-Range", "Accept-Ranges", "ETag", "Last-Modified"]
+# response headers of the filer that are stored with a cached crate
+CACHED_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
 
 content_type_map = {
     'zip': 'application/zip',
@@ -45,29 +61,115 @@ content_type_map = {
 }
 
 
-@router.get("/crate/")
-async def get_crate(rde_id: str):
-    rde_id = rde_id.rstrip("/") + "/"
-    qres = run_query(CRATE_URL_QUERY % rde_id)
+async def _crate_url(rde_id):
+    rde_id = rde_key(rde_id)
+    # a crate's URL never changes, only the store is asked the first time
+    crate_url = crate_urls.get(rde_id)
+    if crate_url is None:
+        rows = await arun_select(CRATE_URL_QUERY.bind(rde=rde_id))
+        if len(rows) < 1:
+            raise HTTPException(status_code=404, detail=f"No crate found for '{rde_id}'")
+        crate_url = rows[0][0]
+        crate_urls.put(rde_id, crate_url)
+    return crate_url
 
-    if len(qres) < 1:
-        raise HTTPException(status_code=404, detail=f"No crate found for '{rde_id}'")
 
-    crate_url = str(list(qres)[0][0])
+@router.get("/crate/")
+async def get_crate(rde_id: str,
+                    byte_range: str = Header(None, alias="Range"),
+                    if_range: str = Header(None, alias="If-Range")):
+    crate_url = await _crate_url(rde_id)
     logging.info("Internal crate URL: %s", crate_url)
     file_to_download = crate_url.rsplit("/", 1)[-1]
     logging.info("downloading file: %s", file_to_download)
 
-    with urlopen(crate_url) as response:
-        content_type = response.headers.get('Content-Type', 'application/zip')
-
-        return StreamingResponse(
-            io.BytesIO(response.read()),
-            media_type=content_type,
-            headers={
-                "Content-Disposition": f"attachment; filename={file_to_download}",
-            }
-        )
+    cache = get_crate_cache()
+    if not byte_range:
+        cached = cache.open(crate_url)
+        if cached is not None:
+            cached_headers = cache.headers(crate_url)
+            # ranges are served by the filer, with the same validators
+            return StreamingResponse(
+                iter_file(cached),
+                media_type=cached_headers.pop("Content-Type", "application/zip"),
+                headers={
+                    "Content-Disposition": f"attachment; filename={file_to_download}",
+                    "Content-Length": str(os.fstat(cached.fileno()).st_size),
+                    "Accept-Ranges": "bytes",
+                    **cached_headers,
+                }
+            )
+
+    # pass ranges through to the filer, so that downloads can be resumed
+    request_headers = {}
+    if byte_range:
+        request_headers["Range"] = byte_range
+        if if_range:
+            request_headers["If-Range"] = if_range
+    try:
+        status_code, headers, chunks = await stream_crate(crate_url, request_headers=request_headers)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 416:
+            raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                                headers={"Content-Range": e.response.headers.get("Content-Range", "")})
+        raise
+    content_type = headers.get('Content-Type', 'application/zip')
+    if status_code == 200 and "Content-Length" in headers:
+        fill = cache.filler(crate_url, size=int(headers["Content-Length"]),
+                            headers={k: headers[k] for k in CACHED_HEADERS if k in headers})
+        if fill is not None:
+            chunks = cached_chunks(fill, chunks)
+
+    # the body is relayed chunk by chunk, as fast as the client reads it
+    return StreamingResponse(
+        chunks,
+        status_code=status_code,
+        media_type=content_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={file_to_download}",
+            **{k: headers[k] for k in PASSTHROUGH_HEADERS if k in headers},
+        }
+    )
+
+
+def _open_member(crate_url, zip_member):
+    # only the zip directory and the member's bytes are downloaded
+    crate_file = open_crate(crate_url)
+    try:
+        zipf = zipfile.ZipFile(crate_file, "r")
+        info = zipf.getinfo(zip_member)
+        return info, zipf.open(info), crate_file
+    except BaseException:
+        crate_file.close()
+        raise
+
+
+def _iter_member(member, crate_file):
+    try:
+        while chunk := member.read(CHUNK_SIZE):
+            yield chunk
+    finally:
+        member.close()
+        crate_file.close()
+
+
+async def _member_chunks(crate_url, zip_member):
+    """\
+    Return the size of the crate member and an async iterator over its data.
+    """
+    index = await get_member_index(crate_url)
+    entry = index["members"].get(zip_member) if index is not None else None
+    if index is not None and entry is None:
+        raise HTTPException(status_code=404, detail=f"File '{zip_member}' not found in the crate")
+    if entry is not None and entry[3] in STREAMABLE:
+        # one range request for the member's data
+        return entry[2], await stream_member(crate_url, zip_member, entry)
+    try:
+        # reading and unzipping are blocking, keep them off the event loop
+        info, member, crate_file = await run_in_threadpool(_open_member, crate_url, zip_member)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"File '{zip_member}' not found in the crate")
+    return info.file_size, iterate_in_threadpool(_iter_member(member, crate_file))
 
 
 @router.get("/file/")
@@ -82,75 +184,122 @@ async def get_file(file_uri: str):
     file_to_download = zip_member.rsplit("/", 1)[-1]
     logging.info("extracting: %s", zip_member)
 
-    rde_id = rde_id.rstrip("/") + "/"
-    qres = run_query(CRATE_URL_QUERY % rde_id)
-    if len(qres) < 1:
-        raise HTTPException(status_code=404, detail=f"No crate found for '{rde_id}'")
-
-    crate_url = str(list(qres)[0][0])
-    with urlopen(crate_url) as zip_response:
-        zip_data = io.BytesIO(zip_response.read())
-
-        with zipfile.ZipFile(zip_data, "r") as zipf:
-            try:
-                file_data = zipf.read(zip_member)
-                file_ext = file_to_download.rsplit('.', 1)[-1].lower()
-                if file_ext in content_type_map:
-                    content_type = content_type_map[file_ext]
-                else:
-                    content_type = 'application/octet-stream'
-
-                return StreamingResponse(
-                    io.BytesIO(file_data),
-                    media_type=content_type,
-                    headers={
-                        "Content-Disposition": f"attachment; filename={file_to_download}",
-                    }
-                )
-
-            except KeyError:
-                raise HTTPException(status_code=404, detail=f"File '{zip_member}' not found in the crate")
+    crate_url = await _crate_url(rde_id)
+    cache = get_crate_cache()
+    cached = cache.open(crate_url, zip_member)
+    if cached is not None:
+        file_size = os.fstat(cached.fileno()).st_size
+        # the sync iterator is run in the threadpool by StreamingResponse
+        chunks = iter_file(cached)
+    else:
+        file_size, chunks = await _member_chunks(crate_url, zip_member)
+        fill = cache.filler(crate_url, zip_member, size=file_size)
+        if fill is not None:
+            chunks = cached_chunks(fill, chunks)
+
+    file_ext = file_to_download.rsplit('.', 1)[-1].lower()
+    if file_ext in content_type_map:
+        content_type = content_type_map[file_ext]
+    else:
+        content_type = 'application/octet-stream'
+
+    return StreamingResponse(
+        chunks,
+        media_type=content_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={file_to_download}",
+            "Content-Length": str(file_size),
+        }
+    )
+
+
+def _column(query, graph_id=None):
+    """\
+    Values of the first column of the query results, cached. If graph_id is
+    given, the query runs on that graph only.
+    """
+    if graph_id is None:
+        return query_cache.get_or_compute(query, lambda: [_[0] for _ in run_select(query)])
+    return query_cache.get_or_compute(
+        (query, graph_id), lambda: [_[0] for _ in run_select(query, graph_id=graph_id)], per_graph=True
+    )
 
 
 @router.get("/graphs-for-file/")
 def get_graphs_for_file(file_id: str):
-    query_res = run_query(GRAPH_ID_FOR_FILE_QUERY % file_id)
-    output = [str(_[0]) for _ in query_res]
+    output = _column(GRAPH_ID_FOR_FILE_QUERY.bind(file=file_id))
+    return {"result": output}
+
+
+@router.post("/graphs-for-file/")
+def get_graphs_for_files(file_ids: list[str]):
+    output = fetch_for_ids(GRAPH_IDS_FOR_FILES_QUERY, file_ids)
     return {"result": output}
 
 
 @router.get("/graphs-for-result/")
 def get_graphs_for_result(result_id: str):
-    query_res = run_query(GRAPH_ID_FOR_RESULT_QUERY % result_id)
-    output = [str(_[0]) for _ in query_res]
+    output = _column(GRAPH_ID_FOR_RESULT_QUERY.bind(result=result_id))
+    return {"result": output}
+
+
+@router.post("/graphs-for-result/")
+def get_graphs_for_results(result_ids: list[str]):
+    output = fetch_for_ids(GRAPH_IDS_FOR_RESULTS_QUERY, result_ids)
     return {"result": output}
 
 
+def _params(graph_id):
+    return query_cache.get_or_compute(
+        (WFRUN_PARAMS_QUERY, graph_id),
+        lambda: run_select(WFRUN_PARAMS_QUERY, graph_id=graph_id),
+        per_graph=True
+    )
+
+
+async def _from_summary(graph_id, field, compute):
+    # crates loaded before run summaries were introduced have none
+    summary = await read_run_summary(str(resolve_graph_id(graph_id)))
+    if summary is not None:
+        return summary[field]
+    return await run_in_threadpool(compute)
+
+
+@router.get("/run-summary/")
+async def get_run_summary(graph_id: str):
+    summary = await read_run_summary(str(resolve_graph_id(graph_id)))
+    if summary is None:
+        summary = await run_in_threadpool(build_run_summary, lambda q: run_query(q, graph_id=graph_id))
+    return {"result": summary}
+
+
 @router.get("/workflow/")
-def get_workflow(graph_id: str):
-    query_res = run_query(WORKFLOW_QUERY, graph_id=graph_id)
-    output = [str(_[0]) for _ in query_res]
+async def get_workflow(graph_id: str):
+    output = await _from_summary(graph_id, "workflow", lambda: _column(WORKFLOW_QUERY, graph_id=graph_id))
     return {"result": output}
 
 
 @router.get("/run-results/")
-def get_run_results(graph_id: str):
-    query_res = run_query(WFRUN_RESULTS_QUERY, graph_id=graph_id)
-    output = [str(_[0]) for _ in query_res]
+async def get_run_results(graph_id: str):
+    output = await _from_summary(graph_id, "results", lambda: _column(WFRUN_RESULTS_QUERY, graph_id=graph_id))
     return {"result": output}
 
 
 @router.get("/run-objects/")
-def get_run_objects(graph_id: str):
-    query_res = run_query(WFRUN_OBJECTS_QUERY, graph_id=graph_id)
-    output = [str(_[0]) for _ in query_res]
+async def get_run_objects(graph_id: str):
+    output = await _from_summary(graph_id, "objects", lambda: _column(WFRUN_OBJECTS_QUERY, graph_id=graph_id))
     return {"result": output}
 
 
 @router.get("/objects-for-result/")
 def get_objects_for_result(result_id: str):
-    query_res = run_query(OBJECTS_FOR_RESULT_QUERY % result_id)
-    output = [str(_[0]) for _ in query_res]
+    output = _column(OBJECTS_FOR_RESULT_QUERY.bind(result=result_id))
+    return {"result": output}
+
+
+@router.post("/objects-for-result/")
+def get_objects_for_results(result_ids: list[str]):
+    output = fetch_for_ids(OBJECTS_FOR_RESULTS_QUERY, result_ids)
     return {"result": output}
 
 
@@ -160,20 +309,37 @@ def get_actions_for_result(result_id: str):
     return {"result": output}
 
 
+@router.post("/actions-for-result/")
+def get_actions_for_results(result_ids: list[str]):
+    output = fetch_for_ids(ACTIONS_FOR_RESULTS_QUERY, result_ids)
+    return {"result": output}
+
+
 @router.get("/objects-for-action/")
 def get_objects_for_action(action_id: str):
     output = fetch_objects_for_action(action_id)
     return {"result": output}
 
 
+@router.post("/objects-for-action/")
+def get_objects_for_actions(action_ids: list[str]):
+    output = fetch_for_ids(OBJECTS_FOR_ACTIONS_QUERY, action_ids)
+    return {"result": output}
+
+
 @router.get("/results-for-action/")
 def get_results_for_action(action_id: str):
     output = fetch_results_for_action(action_id)
     return {"result": output}
 
 
+@router.post("/results-for-action/")
+def get_results_for_actions(action_ids: list[str]):
+    output = fetch_for_ids(RESULTS_FOR_ACTIONS_QUERY, action_ids)
+    return {"result": output}
+
+
 @router.get("/run-params/")
-def get_run_params(graph_id: str):
-    query_res = run_query(WFRUN_PARAMS_QUERY, graph_id=graph_id)
-    output = [(str(_.name), str(_.value)) for _ in query_res]
+async def get_run_params(graph_id: str):
+    output = await _from_summary(graph_id, "params", lambda: _params(graph_id))
     return {"result": output}
@@ -21,16 +21,19 @@ import uuid
 from datetime import datetime, timezone
 
 from fastapi import APIRouter, HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
 
 from provstor_api.routes.upload import load_crate_metadata
 from provstor_api.utils.gencrate import CopyCrateGenerator, MoveCrateGenerator
+from provstor_api.utils.lineage import lineage_index
 from provstor_api.utils.queries import IS_FILE_OR_DIR_QUERY, MOVE_DEST_QUERY
-from provstor_api.utils.query import run_query
+from provstor_api.utils.query import arun_query, run_query
+from provstor_api.utils.templates import QueryTemplate
 
 router = APIRouter()
 
 
-FILEINFO_QUERY = """\
+FILEINFO_QUERY = QueryTemplate("fileinfo", """\
 PREFIX schema: <http://schema.org/>
 PREFIX wfrun: <https://w3id.org/ro/terms/workflow-run#>
 
@@ -39,9 +42,9 @@ WHERE {
   ?id a schema:MediaObject .
   ?id wfrun:sha256 ?checksum .
   ?id schema:contentSize ?size .
-  FILTER(?id = <%s>)
+  FILTER(?id = $iri{id})
 }
-"""
+""")
 
 
 @router.post("/copy/")
@@ -62,13 +65,13 @@ async def _copy_or_move(src: str, dest: str, when: datetime = None, op="cp"):
         raise HTTPException(status_code=422, detail=f"datetime {when.isoformat()} is in the future")
     if not src.startswith("file:/"):
         raise HTTPException(status_code=422, detail="Can only operate on a 'file:/' File or Dataset")
-    qres = run_query(IS_FILE_OR_DIR_QUERY % src)
+    qres = await arun_query(IS_FILE_OR_DIR_QUERY.bind(id=src))
     if len(qres) < 1:
         raise HTTPException(status_code=404, detail=f"File or Dataset '{src}' not found")
-    chain = movechain(src)["result"]
+    chain = (await run_in_threadpool(movechain, src))["result"]
     if chain:
         raise HTTPException(status_code=422, detail=f"'{src}' has already been moved to: {chain}")
-    qres = run_query(FILEINFO_QUERY % src)
+    qres = await arun_query(FILEINFO_QUERY.bind(id=src))
     kwargs = {"when": when}
     if len(qres) >= 1:
         # raise if > 1 ? (multiple checksums or sizes for an id)
@@ -81,7 +84,7 @@ async def _copy_or_move(src: str, dest: str, when: datetime = None, op="cp"):
     logging.info("%s crate name: %s", op, crate_filename)
     with tempfile.TemporaryDirectory() as tmp_dir:
         crate_path = os.path.join(tmp_dir, crate_filename)
-        crate.write_zip(crate_path)
+        await run_in_threadpool(crate.write_zip, crate_path)
         with open(crate_path, "rb") as f:
             upload_file = UploadFile(f, filename=crate_filename, headers={
                 "content-type": "application/zip"
@@ -100,10 +103,13 @@ def _movechain_recursive(path_id, visited=None):
     visited.add(path_id)
     results = []
 
-    qres = run_query(MOVE_DEST_QUERY % path_id)
+    if lineage_index.ready:
+        dests = lineage_index.move_dest(path_id)
+    else:
+        dests = [str(_[0]) for _ in run_query(MOVE_DEST_QUERY.bind(src=path_id))]
 
-    if len(qres):
-        dest_id = str(list(qres)[0][0])
+    if dests:
+        dest_id = dests[0]
         logging.info("dest_id: %s", dest_id)
         results.append(dest_id)
         nested_results = _movechain_recursive(dest_id, visited)
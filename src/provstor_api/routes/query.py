@@ -16,32 +16,157 @@
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
 
-from fastapi import APIRouter, UploadFile
+import base64
+import hashlib
+import json
+import re
+from typing import Literal
 
-from provstor_api.utils.query import run_query
-from provstor_api.utils.queries import GRAPHS_QUERY, RDE_GRAPH_QUERY
+from fastapi import APIRouter, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+from provstor_api.utils.catalog import list_catalog_graphs
+from provstor_api.utils.query import astream_query, run_query, tsv_value
 
 router = APIRouter()
 
+# media types of the streaming formats, as asked to the store and as returned
+STREAM_TYPES = {
+    "csv": ("text/csv", "text/csv"),
+    "tsv": ("text/tab-separated-values", "text/tab-separated-values"),
+    # converted from TSV, where each solution is on a single line
+    "ndjson": ("text/tab-separated-values", "application/x-ndjson"),
+}
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+TRAILING_SLICE = re.compile(r"\b(LIMIT|OFFSET)\s+\d+\s*$", re.IGNORECASE)
+# whitespace, comments and PREFIX / BASE declarations before the query form
+PROLOGUE = re.compile(r"(?:\s+|#[^\n]*|PREFIX\s+[^\s:]*:\s*<[^>]*>|BASE\s*<[^>]*>)*", re.IGNORECASE)
+
 
 @router.get("/list-graphs/")
-def list_graphs():
-    query_res = run_query(GRAPHS_QUERY)
-    output = [item[0] for item in query_res]
-    return {"result": output}
+def list_graphs(prefix: str = None, cursor: str = None, limit: int = Query(None, ge=1)):
+    rows, total, next_cursor = list_catalog_graphs(prefix, cursor, limit)
+    output = [item[0] for item in rows]
+    return {"result": output, "total": total, "next_cursor": next_cursor}
 
 
 @router.get("/list-RDE-graphs/")
-def list_rde_graphs():
-    query_res = run_query(RDE_GRAPH_QUERY)
-    output = [item for item in query_res]
-    return {"result": output}
+def list_rde_graphs(prefix: str = None, cursor: str = None, limit: int = Query(None, ge=1)):
+    rows, total, next_cursor = list_catalog_graphs(prefix, cursor, limit)
+    return {"result": rows, "total": total, "next_cursor": next_cursor}
+
+
+def _query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()[:16]
+
+
+# run-query cursors: the offset of the next page, bound to the query
+def _encode_cursor(query, offset):
+    token = json.dumps({"offset": offset, "query": _query_hash(query)})
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def _decode_cursor(query, cursor):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        offset, query_hash = int(token["offset"]), token["query"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if query_hash != _query_hash(query) or offset < 0:
+        raise HTTPException(status_code=400, detail="Cursor does not match the query")
+    return offset
+
+
+def _paginate(query, limit, offset):
+    if TRAILING_SLICE.search(query):
+        raise HTTPException(status_code=422, detail="Paginated queries cannot have their own LIMIT or OFFSET")
+    query = query.rstrip()
+    if limit is not None:
+        query += f"\nLIMIT {limit}"
+    if offset:
+        query += f"\nOFFSET {offset}"
+    return query
+
+
+def _query_form(query):
+    form = re.match(r"[A-Za-z]*", query[PROLOGUE.match(query).end():]).group()
+    return form.upper() or None
+
+
+async def _lines(chunks):
+    tail = b""
+    async for chunk in chunks:
+        *lines, tail = (tail + chunk).split(b"\n")
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+async def _ndjson(chunks):
+    """\
+    Convert SPARQL TSV results to one JSON object per solution, keyed by
+    variable name. Unbound variables are null.
+    """
+    names = None
+    async for line in _lines(chunks):
+        fields = line.decode("utf-8").rstrip("\r").split("\t")
+        if names is None:
+            names = [_.lstrip("?$") for _ in fields]
+            continue
+        row = {k: tsv_value(v) for k, v in zip(names, fields)}
+        yield (json.dumps(row) + "\n").encode()
 
 
 @router.post("/run-query/")
-async def run_query_sparql(query_file: UploadFile, graph: str = None):
+async def run_query_sparql(query_file: UploadFile, graph: str = None,
+                           format: Literal["json", "ndjson", "csv", "tsv"] = "json",
+                           limit: int = Query(None, ge=1), cursor: str = None):
+    """\
+    Run the query in query_file, optionally on the graph only.
+
+    With format other than json, the results of a SELECT query are streamed
+    as the store produces them; other query forms are only available as
+    json. If limit is set, at most limit results are returned, and
+    the cursor for the next page is returned too (in the X-Next-Cursor header
+    for streaming formats, where a page with less than limit results is the
+    last one).
+
+    This is offset pagination behind an opaque token: the cursor encodes
+    the offset of the next page and a hash of the query, and each page is
+    fetched with OFFSET/LIMIT. The store evaluates the skipped results
+    again for every page, and changes to the data between requests shift
+    the page boundaries. Pages are only stable if the query has an ORDER
+    BY.
+    """
     content = await query_file.read()
     query = content.decode("utf-8")
-    query_res = run_query(query, graph)
-    result_list = [item for item in query_res]
-    return {"result": result_list}
+    offset = _decode_cursor(query, cursor) if cursor else 0
+    next_cursor = _encode_cursor(query, offset + limit) if limit is not None else None
+    if format == "json":
+        if limit is None and not offset:
+            query_res = await run_in_threadpool(run_query, query, graph)
+            return {"result": [item for item in query_res]}
+        # one more result tells whether there is a next page
+        page = _paginate(query, None if limit is None else limit + 1, offset)
+        query_res = await run_in_threadpool(run_query, page, graph)
+        result_list = [item for item in query_res]
+        if limit is None or len(result_list) <= limit:
+            next_cursor = None
+        return {"result": result_list[:limit], "next_cursor": next_cursor}
+
+    if _query_form(query) != "SELECT":
+        raise HTTPException(status_code=400, detail=f"Format {format} is only available for SELECT queries")
+    accept, media_type = STREAM_TYPES[format]
+    if limit is not None or offset:
+        query = _paginate(query, limit, offset)
+    try:
+        _, chunks = await astream_query(query, accept, graph)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    if format == "ndjson":
+        chunks = _ndjson(chunks)
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor is not None else {}
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
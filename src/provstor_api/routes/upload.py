@@ -17,24 +17,35 @@
 
 
 from fastapi import APIRouter, UploadFile, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
 import logging
 import tempfile
 import zipfile
 import os
 import arcp
-import boto3
 from rdflib import Graph
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
 from rdflib.term import URIRef, Literal
 
-from provstor_api.utils.queries import RDE_QUERY, INSERT_QUERY
-from provstor_api.utils.query import run_query
+from provstor_api.utils.cache import get_crate_cache
+from provstor_api.utils.catalog import CATALOG_GRAPH, catalog_graph
+from provstor_api.utils.get_utils import chunked
+from provstor_api.utils.jobs import IngestQueue
+from provstor_api.utils.lineage import LineageDelta, lineage_index
+from provstor_api.utils.lookup import crate_urls, query_cache, rde_key
+from provstor_api.utils.members import index_crate
+from provstor_api.utils.metrics import timed
+from provstor_api.utils.queries import RDE_QUERY, INSERT_GRAPHS_QUERY, GRAPH_BLOCK
+from provstor_api.utils.query import aload_quads, arun_select, arun_update, crate_base_url
+from provstor_api.utils.storage import delete_crate, delete_crates, put_crate, put_crates
+from provstor_api.utils.summary import summarize_crate
+from provstor_api.utils.templates import InvalidTermError, Query, QueryTemplate, iri
 from provstor_api.config import settings
 
 router = APIRouter()
 
 
-EXTERNAL_RESULTS_QUERY = """\
+EXTERNAL_RESULTS_QUERY = Query("external-results", """\
 PREFIX schema: <http://schema.org/>
 SELECT ?f ?c
 WHERE {
@@ -44,100 +55,297 @@ WHERE {
   ?a a schema:CreateAction .
   ?a schema:result ?f .
 }
-"""
+""")
 
+EXISTING_RESULTS_QUERY = QueryTemplate("existing-results", """\
+PREFIX schema: <http://schema.org/>
+SELECT DISTINCT ?f
+WHERE {
+  VALUES ?f { $iris{ids} }
+  { ?f a schema:MediaObject } UNION { ?f a schema:Dataset } .
+  ?a a schema:CreateAction .
+  ?a schema:result ?f .
+}
+""")
 
-@router.post("/crate/")
-async def load_crate_metadata(crate_path: UploadFile):
+
+async def find_existing_results(result_ids):
+    """\
+    Return the subset of result_ids that are already results of an action in
+    the store. Only the given ids are looked up, so the cost does not depend
+    on the size of the store.
+    """
+    existing = set()
+    for batch in chunked(sorted(result_ids)):
+        rows = await arun_select(EXISTING_RESULTS_QUERY.bind(ids=batch))
+        existing.update(r[0] for r in rows)
+    return existing
+
+
+async def store_graphs(graphs):
+    """\
+    Load several graphs, given as a {graph_uri: Graph} dict, into the
+    corresponding named graphs with a single request (and thus in a single
+    transaction): N-Quads via the Graph Store Protocol or, if that is
+    disabled, one INSERT DATA update.
+    """
+    if settings.fuseki_graph_store:
+        with tempfile.TemporaryFile() as nq_file:
+            with timed("encode", "nquads") as timing:
+                await run_in_threadpool(_serialize_nquads, graphs, nq_file)
+                timing.bytes = nq_file.tell()
+            nq_file.seek(0)
+            await aload_quads(nq_file)
+    else:
+        blocks = []
+        for graph_uri, graph in graphs.items():
+            ntriples = await run_in_threadpool(graph.serialize, format="nt", encoding="utf-8")
+            blocks.append(GRAPH_BLOCK % (iri(graph_uri), ntriples.decode()))
+        await arun_update(INSERT_GRAPHS_QUERY % "\n".join(blocks))
+
+
+def _serialize_nquads(graphs, out):
+    for graph_uri, graph in graphs.items():
+        context = f" {iri(graph_uri)} .\n".encode()
+        with tempfile.TemporaryFile() as nt_file:
+            graph.serialize(destination=nt_file, format="nt", encoding="utf-8")
+            nt_file.seek(0)
+            # N-Triples has one triple per line, terminated by " ."
+            for line in nt_file:
+                line = line.rstrip()
+                if line:
+                    out.write(line.removesuffix(b".").rstrip() + context)
+
+
+def _check_upload(crate_path):
     if crate_path.content_type != "application/zip":
         raise HTTPException(status_code=415, detail="crate_path must be a zip file.")
+    # the crate name ends up in the graph IRI
+    try:
+        iri(crate_base_url() + crate_path.filename)
+    except InvalidTermError:
+        raise HTTPException(status_code=400, detail=f"Invalid crate name: {crate_path.filename!r}")
 
-    content = await crate_path.read()
-
-    if not content:
+    # the multipart parser has already spooled the body to a temporary file:
+    # work on that directly rather than reading it into memory
+    crate_file = crate_path.file
+    crate_file.seek(0, os.SEEK_END)
+    if crate_file.tell() == 0:
         raise HTTPException(status_code=400, detail="Empty file uploaded.")
+    crate_file.seek(0)
+    return crate_file
 
-    crate_url = f"http://{settings.seaweedfs_filer}/buckets/{settings.seaweedfs_bucket}/{crate_path.filename}"
-    logging.info("Crate URL: %s", crate_url)
-    loc = arcp.arcp_location(crate_url)
-    logging.info("ARCP location: %s", loc)
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        tmp_zip_path = os.path.join(tmp_dir, crate_path.filename)
+@router.post("/crate/")
+async def load_crate_metadata(crate_path: UploadFile, async_mode: bool = False):
+    """\
+    Upload a zipped crate and load its metadata into the store.
 
-        with open(tmp_zip_path, 'wb') as f:
-            f.write(content)  # type: ignore
+    With async_mode, the crate is queued for ingestion and the response
+    (202) carries a job ID, whose progress can be followed at
+    /upload/jobs/{job_id}.
+    """
+    crate_file = _check_upload(crate_path)
+    if async_mode:
+        job = await ingest_queue.submit(crate_path.filename, crate_file)
+        return JSONResponse(status_code=202, content={"result": "accepted", "job_id": job.id})
+    crate_url = await ingest_crate(crate_path.filename, crate_file)
+    return {"result": "success", "crate_url": crate_url}
 
-        metadata_filename = "ro-crate-metadata.json"
-        metadata_path = None
 
-        with zipfile.ZipFile(tmp_zip_path, 'r') as zip_ref:
-            for zip_info in zip_ref.infolist():
-                if os.path.basename(zip_info.filename) == metadata_filename:
-                    if zip_info.file_size > 50_000_000:
-                        raise HTTPException(status_code=413, detail="Metadata file exceeds size limit (50 MB)")
+@router.post("/crates/")
+async def load_crates_metadata(crate_paths: list[UploadFile]):
+    """\
+    Upload several zipped crates and load their metadata into the store.
 
-                    metadata_path = os.path.join(tmp_dir, metadata_filename)
-                    with zip_ref.open(zip_info) as src, open(metadata_path, 'wb') as dst:
-                        dst.write(src.read())  # type: ignore
+    The duplicate results check runs once for all crates, the crates are
+    uploaded to the object store in parallel and their metadata is loaded
+    in a single request. A crate that fails does not prevent the others from
+    being loaded; the outcome for each crate is reported in the "crates"
+    list, in the same order as the uploads.
+    """
+    outcomes = [None] * len(crate_paths)
+    prepared = {}
+    for i, crate_path in enumerate(crate_paths):
+        try:
+            crate_file = _check_upload(crate_path)
+            if any(p[0] == crate_path.filename for p in prepared.values()):
+                raise HTTPException(status_code=422, detail=f"duplicate crate name: {crate_path.filename}")
+            prepared[i] = (crate_path.filename, crate_file, *await run_in_threadpool(
+                _prepare_crate, crate_path.filename, crate_file
+            ))
+        except HTTPException as e:
+            outcomes[i] = _failure(crate_path.filename, e.status_code, e.detail)
 
-                    logging.info("Extracted metadata file: %s", metadata_path)
-                    break
+    all_results = set().union(*(p[4] for p in prepared.values()))
+    existing = await find_existing_results(all_results)
+    for i, (filename, _, _, _, new_results) in list(prepared.items()):
+        common_results = new_results & existing
+        if common_results:
+            outcomes[i] = _failure(filename, 422, f"these results already exist: {common_results}")
+            del prepared[i]
+        else:
+            # results of a crate must not be claimed by later crates in the batch
+            existing |= new_results
 
-        if not metadata_path:
-            raise HTTPException(status_code=422, detail="ro-crate-metadata.json not found in the zip file")
+    if prepared:
+        for _, crate_file, *_ in prepared.values():
+            crate_file.seek(0)
+        errors = await put_crates([(filename, crate_file) for filename, crate_file, *_ in prepared.values()])
+        for _, _, crate_url, *_ in prepared.values():
+            get_crate_cache().invalidate(crate_url)
+        for i, e in zip(list(prepared), errors):
+            if e is not None:
+                outcomes[i] = _failure(prepared[i][0], 500, f"Failed to upload crate to the object store: {e}")
+                del prepared[i]
 
-        local_graph = Graph()
-        local_graph.parse(metadata_path, publicID=loc)
-        qres = local_graph.query(EXTERNAL_RESULTS_QUERY)
-        new_results = set(str(r[0]) for r in qres)
-        qres = run_query(EXTERNAL_RESULTS_QUERY)
-        existing_results = set(str(r[0]) for r in qres)
-        common_results = new_results & existing_results
-        if common_results:
-            raise HTTPException(status_code=422, detail=f"these results already exist: {common_results}")
-        # store crate url as root data entity "url"
-        qres = local_graph.query(RDE_QUERY)
-        if not qres:
-            raise HTTPException(status_code=500, detail="Failed to store crate metadata in the graph")
-        assert len(qres) == 1
-        rde = list(qres)[0][0]
-        local_graph.add((rde, URIRef("http://schema.org/url"), Literal(crate_url)))
-        metadata = local_graph.serialize(format="nt")
-        if isinstance(metadata, bytes):
-            metadata = metadata.decode()
-
-        client = boto3.client(
-            "s3",
-            endpoint_url=f"http://{settings.seaweedfs_store}",
-            aws_access_key_id=settings.seaweedfs_access_key,
-            aws_secret_access_key=settings.seaweedfs_secret_key,
-        )
+    if prepared:
         try:
-            client.create_bucket(Bucket=settings.seaweedfs_bucket)
-        except client.exceptions.BucketAlreadyExists:
-            pass
+            graphs = {crate_url: graph for _, _, crate_url, graph, _ in prepared.values()}
+            graphs[CATALOG_GRAPH] = await run_in_threadpool(catalog_graph, *graphs.values())
+            await store_graphs(graphs)
+        except Exception as e:
+            await delete_crates([filename for filename, *_ in prepared.values()])
+            for _, _, crate_url, *_ in prepared.values():
+                get_crate_cache().invalidate(crate_url)
+            for i, (filename, *_) in prepared.items():
+                outcomes[i] = _failure(filename, 500, f"Failed to upload metadata to the store: {e}")
         else:
-            logging.info('created bucket "%s"', settings.seaweedfs_bucket)
+            for i, (filename, crate_file, crate_url, graph, _) in prepared.items():
+                _graph_stored(graph, crate_url)
+                await run_in_threadpool(index_crate, filename, crate_url, crate_file)
+                await run_in_threadpool(summarize_crate, filename, crate_url, graph)
+                await _index_lineage(graph)
+                outcomes[i] = {"filename": filename, "result": "success", "crate_url": crate_url}
+
+    ok = all(o["result"] == "success" for o in outcomes)
+    return {"result": "success" if ok else "error", "crates": outcomes}
 
-        await crate_path.seek(0)
-        client.put_object(
-            Bucket=settings.seaweedfs_bucket,
-            Key=crate_path.filename,
-            Body=crate_path.file,
-        )
 
+def _failure(filename, status_code, detail):
+    return {"filename": filename, "result": "error", "status_code": status_code, "detail": detail}
+
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No upload job found with ID {job_id}")
+    return job.to_dict()
+
+
+def _prepare_crate(filename, crate_file):
+    """\
+    Parse the metadata of the zipped crate in crate_file and add the crate
+    URL to its root data entity. Return the crate URL, the metadata graph
+    and the ids of the crate's results.
+    """
+    crate_url = f"http://{settings.seaweedfs_filer}/buckets/{settings.seaweedfs_bucket}/{filename}"
+    logging.info("Crate URL: %s", crate_url)
+    loc = arcp.arcp_location(crate_url)
+    logging.info("ARCP location: %s", loc)
+    local_graph = _parse_metadata(crate_file, loc)
+    qres = local_graph.query(EXTERNAL_RESULTS_QUERY)
+    new_results = set(str(r[0]) for r in qres)
+    # the result ids end up in the duplicate results query
+    for result in sorted(new_results):
         try:
-            store = SPARQLUpdateStore()
-            query_endpoint = f"{settings.fuseki_base_url}/{settings.fuseki_dataset}/sparql"
-            update_endpoint = f"{settings.fuseki_base_url}/{settings.fuseki_dataset}/update"
-            store.open((query_endpoint, update_endpoint))
-            graph = Graph(store, identifier=URIRef(crate_url))
-            graph.update(INSERT_QUERY % metadata)
-        except Exception as e:
-            client.delete_object(
-                Bucket=settings.seaweedfs_bucket,
-                Key=crate_path.filename,
-            )
-            raise HTTPException(status_code=500, detail=f"Failed to upload metadata to the store: {e}")
-        return {"result": "success", "crate_url": crate_url}
+            iri(result)
+        except InvalidTermError:
+            raise HTTPException(status_code=400, detail=f"Invalid result id: {result!r}")
+    # store crate url as root data entity "url"
+    qres = local_graph.query(RDE_QUERY)
+    if not qres:
+        raise HTTPException(status_code=500, detail="Failed to store crate metadata in the graph")
+    if len(qres) != 1:
+        raise HTTPException(status_code=400, detail=f"Expected one root data entity, found {len(qres)}")
+    rde = list(qres)[0][0]
+    local_graph.add((rde, URIRef("http://schema.org/url"), Literal(crate_url)))
+    return crate_url, local_graph, new_results
+
+
+def _graph_stored(local_graph, crate_url):
+    """\
+    Update the in-process lookups after the crate's graph has been stored.
+    """
+    for rde in local_graph.subjects(URIRef("http://schema.org/url"), Literal(crate_url)):
+        crate_urls.put(rde_key(str(rde)), crate_url)
+    # new graph, cross-graph query output might be stale
+    query_cache.bump()
+
+
+async def _index_lineage(local_graph):
+    if lineage_index.ready or lineage_index.building:
+        lineage_index.add(await run_in_threadpool(LineageDelta.from_queries, local_graph.query))
+
+
+async def ingest_crate(filename, crate_file):
+    """\
+    Store the zipped crate in crate_file in the object store and its metadata
+    in the SPARQL store, returning the crate URL.
+    """
+    # zip extraction and RDF parsing are CPU-bound, keep them off the event loop
+    crate_url, local_graph, new_results = await run_in_threadpool(_prepare_crate, filename, crate_file)
+    common_results = await find_existing_results(new_results)
+    if common_results:
+        raise HTTPException(status_code=422, detail=f"these results already exist: {common_results}")
+
+    crate_file.seek(0)
+    await put_crate(filename, crate_file)
+    # the crate might be replacing a cached one with the same name
+    get_crate_cache().invalidate(crate_url)
+
+    catalog = await run_in_threadpool(catalog_graph, local_graph)
+    try:
+        # the crate's graph and its catalog entries, in one transaction
+        await store_graphs({crate_url: local_graph, CATALOG_GRAPH: catalog})
+    except Exception as e:
+        await delete_crate(filename)
+        get_crate_cache().invalidate(crate_url)
+        raise HTTPException(status_code=500, detail=f"Failed to upload metadata to the store: {e}")
+    _graph_stored(local_graph, crate_url)
+    await run_in_threadpool(index_crate, filename, crate_url, crate_file)
+    await run_in_threadpool(summarize_crate, filename, crate_url, local_graph)
+    await _index_lineage(local_graph)
+    return crate_url
+
+
+ingest_queue = IngestQueue(
+    ingest_crate,
+    workers=settings.upload_workers,
+    max_size=settings.upload_queue_size,
+    max_jobs=settings.upload_max_jobs,
+)
+
+
+def _parse_metadata(crate_file, loc):
+    metadata_filename = "ro-crate-metadata.json"
+    local_graph = None
+
+    # only the central directory and the metadata file entry are read
+    try:
+        zip_ref = zipfile.ZipFile(crate_file, 'r')
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="Not a valid zip file.")
+    with zip_ref:
+        for zip_info in zip_ref.infolist():
+            if os.path.basename(zip_info.filename) == metadata_filename:
+                if zip_info.file_size > 50_000_000:
+                    raise HTTPException(status_code=413, detail="Metadata file exceeds size limit (50 MB)")
+
+                local_graph = Graph()
+                try:
+                    with timed("parse", "crate-metadata") as timing, zip_ref.open(zip_info) as src:
+                        local_graph.parse(src, format="json-ld", publicID=loc)
+                        timing.bytes = zip_info.file_size
+                except Exception as e:
+                    # corrupt zip entries, invalid JSON, invalid JSON-LD...
+                    raise HTTPException(status_code=400, detail=f"Invalid crate metadata: {e}")
+
+                logging.info("Parsed metadata file: %s", zip_info.filename)
+                break
+
+    if local_graph is None:
+        raise HTTPException(status_code=422, detail="ro-crate-metadata.json not found in the zip file")
+
+    return local_graph
@@ -0,0 +1,266 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from provstor_api.config import settings
+
+CRATE = "crate"
+# suffix of the file holding the response headers of an entry
+HEADERS = ".headers"
+
+
+def _digest(s):
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+class _Fill:
+
+    def __init__(self, cache, rel, size, headers):
+        self.cache = cache
+        self.rel = rel
+        self.size = size
+        self.headers = headers
+        self.cancelled = False
+        path = cache.dir / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+        self.file = open(self.tmp, "wb")
+        self.written = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.written += len(data)
+
+    def commit(self):
+        self.file.close()
+        self.cache._commit(self)
+
+    def abort(self):
+        self.file.close()
+        self.cache._abort(self)
+
+
+class CrateCache:
+    """\
+    Size-bounded on-disk LRU cache of whole crates and of crate members,
+    keyed by crate URL (and member name).
+
+    Each crate gets a directory named after the hash of its URL, holding the
+    crate ("crate") and/or extracted members ("m-{hash of the name}"), so
+    that all the entries of a crate can be dropped at once. The response
+    headers given when filling an entry (e.g. the content type and the
+    upstream validators) are stored next to it, in a "{name}.headers" JSON
+    file not counted in the cache size. An entry is
+    written to a temporary file by a single filler at a time, and moved into
+    place only if complete. Concurrent requests for an entry being filled
+    are served from the store meanwhile.
+
+    The directory must not be shared by different processes.
+    """
+
+    def __init__(self, directory, max_size, max_entry_size):
+        self.dir = Path(directory)
+        self.max_size = max_size
+        self.max_entry_size = min(max_entry_size, max_size)
+        self.size = 0
+        self.hits = self.misses = self.fills = self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._filling = {}
+        self._load()
+
+    @staticmethod
+    def _rel(crate_url, member=None):
+        name = CRATE if member is None else f"m-{_digest(member)}"
+        return f"{_digest(crate_url)}/{name}"
+
+    def _load(self):
+        # pick up what was cached before a restart, oldest first
+        if not self.dir.is_dir():
+            return
+        found = []
+        for path in self.dir.glob("*/*"):
+            if path.suffix == ".tmp":
+                path.unlink(missing_ok=True)
+                continue
+            if path.suffix == HEADERS:
+                continue
+            st = path.stat()
+            found.append((st.st_mtime, path.relative_to(self.dir).as_posix(), st.st_size))
+        with self._lock:
+            for _, rel, size in sorted(found):
+                self._entries[rel] = size
+                self.size += size
+            self._evict()
+
+    def open(self, crate_url, member=None):
+        """\
+        Return the cached crate (or member) as an open binary file, or None
+        if it is not in the cache.
+        """
+        rel = self._rel(crate_url, member)
+        with self._lock:
+            if rel in self._entries:
+                try:
+                    f = open(self.dir / rel, "rb")
+                except FileNotFoundError:
+                    self.size -= self._entries.pop(rel)
+                else:
+                    self._entries.move_to_end(rel)
+                    self.hits += 1
+                    return f
+            self.misses += 1
+        return None
+
+    def headers(self, crate_url, member=None):
+        """\
+        Return the headers stored with the cached crate (or member), or an
+        empty dict if there are none.
+        """
+        path = self.dir / f"{self._rel(crate_url, member)}{HEADERS}"
+        try:
+            return json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def filler(self, crate_url, member=None, size=None, headers=None):
+        """\
+        Start caching the crate (or member), whose size in bytes must be
+        known in advance, along with the given headers. Return an object
+        with write, commit and abort methods, or None if the entry is not to
+        be cached (too large, or already cached or being cached).
+        """
+        if size is None or size > self.max_entry_size:
+            return None
+        rel = self._rel(crate_url, member)
+        with self._lock:
+            if rel in self._entries or rel in self._filling:
+                return None
+            try:
+                fill = _Fill(self, rel, size, headers or {})
+            except OSError as e:
+                logging.warning("cannot cache %s: %s", crate_url, e)
+                return None
+            self._filling[rel] = fill
+        return fill
+
+    def _commit(self, fill):
+        with self._lock:
+            del self._filling[fill.rel]
+            if fill.cancelled or fill.written != fill.size:
+                fill.tmp.unlink(missing_ok=True)
+                return
+            path = self.dir / fill.rel
+            path.with_name(f"{path.name}{HEADERS}").write_text(json.dumps(fill.headers))
+            os.replace(fill.tmp, path)
+            self.size -= self._entries.pop(fill.rel, 0)
+            self._entries[fill.rel] = fill.size
+            self.size += fill.size
+            self.fills += 1
+            self._evict()
+
+    def _abort(self, fill):
+        with self._lock:
+            self._filling.pop(fill.rel, None)
+        fill.tmp.unlink(missing_ok=True)
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            rel, size = self._entries.popitem(last=False)
+            self._unlink(rel)
+            self.size -= size
+            self.evictions += 1
+
+    def _unlink(self, rel):
+        (self.dir / rel).unlink(missing_ok=True)
+        (self.dir / f"{rel}{HEADERS}").unlink(missing_ok=True)
+
+    def invalidate(self, crate_url):
+        """\
+        Drop all the cached entries of a crate, and make ongoing fills for
+        it fail. Call when the crate is deleted or replaced.
+        """
+        prefix = f"{_digest(crate_url)}/"
+        with self._lock:
+            for rel in [_ for _ in self._entries if _.startswith(prefix)]:
+                self._unlink(rel)
+                self.size -= self._entries.pop(rel)
+            for rel, fill in self._filling.items():
+                if rel.startswith(prefix):
+                    fill.cancelled = True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "fills": self.fills,
+                "evictions": self.evictions,
+            }
+
+
+async def cached_chunks(fill, chunks):
+    """\
+    Relay the async iterator chunks, writing them to the cache filler fill.
+    The entry is committed only if the iteration completes.
+    """
+    completed = False
+    try:
+        async for chunk in chunks:
+            # small sequential writes to a local file, fine on the event loop
+            fill.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        if completed:
+            fill.commit()
+        else:
+            fill.abort()
+
+
+def iter_file(f, chunk_size=1024 * 1024):
+    try:
+        while chunk := f.read(chunk_size):
+            yield chunk
+    finally:
+        f.close()
+
+
+_crate_cache = None
+_crate_cache_lock = threading.Lock()
+
+
+def get_crate_cache():
+    global _crate_cache
+    if _crate_cache is None:
+        with _crate_cache_lock:
+            if _crate_cache is None:
+                directory = settings.crate_cache_dir or os.path.join(tempfile.gettempdir(), "provstor-crate-cache")
+                _crate_cache = CrateCache(directory, settings.crate_cache_size, settings.crate_cache_max_entry_size)
+    return _crate_cache
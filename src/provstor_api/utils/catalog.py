@@ -0,0 +1,113 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Crate catalog.
+
+Finding crates by their metadata descriptor means matching every
+CreativeWork in the store against "ro-crate-metadata.json", so at ingest
+the few triples that identify a crate are also copied to a named graph of
+their own, the catalog: the descriptor's schema:about and the root data
+entity's schema:url, schema:mainEntity and schema:mentions. Cross-graph
+queries join through it, using the store's indexes. Since the triples are
+copies, the union default graph is unaffected.
+"""
+
+import asyncio
+import logging
+
+from rdflib import Graph
+
+from provstor_api.utils.lookup import query_cache
+from provstor_api.utils.query import arun_update, crate_base_url, run_select, run_update
+from provstor_api.utils.queries import (
+    CATALOG_BACKFILL_UPDATE, CATALOG_CONSTRUCT_QUERY, CATALOG_GRAPH_COUNT_QUERY, CATALOG_GRAPHS_QUERY
+)
+from provstor_api.utils.templates import Query
+
+CATALOG_GRAPH = "urn:provstor:catalog"
+# seconds between attempts to backfill the catalog, doubled after each failure
+BACKFILL_RETRY_DELAY = 1.0
+BACKFILL_MAX_RETRY_DELAY = 60.0
+
+
+def catalog_graph(*local_graphs):
+    """\
+    Return the catalog entries of the crates whose metadata graphs are given.
+    """
+    catalog = Graph()
+    for local_graph in local_graphs:
+        for triple in local_graph.query(CATALOG_CONSTRUCT_QUERY):
+            catalog.add(triple)
+    return catalog
+
+
+def rebuild_catalog():
+    """\
+    Rebuild the catalog from the crate graphs in the store. Blocking.
+    """
+    run_update(f"DROP SILENT GRAPH <{CATALOG_GRAPH}> ;\n{CATALOG_BACKFILL_UPDATE}")
+
+
+async def backfill_catalog(delay=BACKFILL_RETRY_DELAY, max_delay=BACKFILL_MAX_RETRY_DELAY):
+    """\
+    Add the crates in the store that are missing from the catalog, e.g.,
+    when upgrading a store whose crates were loaded before the catalog
+    existed. Adding the entries of crates already in the catalog changes
+    nothing, so this runs at every startup. The store might not be up yet:
+    retry, with exponential backoff, until it answers.
+    """
+    while True:
+        try:
+            await arun_update(CATALOG_BACKFILL_UPDATE)
+            break
+        except Exception as e:
+            logging.warning("could not backfill the catalog graph, retrying in %gs: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, max_delay)
+    # lookups cached while the catalog was incomplete are stale
+    query_cache.bump()
+    logging.info("catalog graph backfilled")
+
+
+def list_catalog_graphs(prefix=None, cursor=None, limit=None):
+    """\
+    List the crate graphs in the catalog, ordered by graph name, with their
+    root data entities.
+
+    Only graphs whose name starts with prefix are listed; a prefix that is
+    not a URL is taken as the start of a crate name. Keyset pagination: only
+    graphs after cursor, a graph name, are listed, at most limit of them.
+
+    Return the (graph, root data entity) pairs, the number of graphs that
+    match prefix and the cursor for the next page (None if this is the last).
+    Results are cached until the next upload.
+    """
+    if prefix and not prefix.startswith("http://"):
+        prefix = crate_base_url() + prefix
+    prefix = prefix or ""
+    query = CATALOG_GRAPHS_QUERY.bind(prefix=prefix, cursor=cursor or "")
+    if limit is not None:
+        # one more row tells whether there is a next page
+        query = Query(query.name, f"{query}LIMIT {limit + 1}\n", query.params)
+    rows = query_cache.get_or_compute(query, lambda: run_select(query))
+    count_query = CATALOG_GRAPH_COUNT_QUERY.bind(prefix=prefix)
+    total = query_cache.get_or_compute(count_query, lambda: int(run_select(count_query)[0][0]))
+    if limit is None or len(rows) <= limit:
+        return rows, total, None
+    rows = rows[:limit]
+    return rows, total, rows[-1][0]
@@ -16,24 +16,78 @@
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
 
+from provstor_api.config import settings
 from provstor_api.utils.queries import (
     ACTIONS_FOR_RESULT_QUERY,
+    LINEAGE_LEVEL_QUERY,
     OBJECTS_FOR_ACTION_QUERY,
     RESULTS_FOR_ACTION_QUERY
 )
-from provstor_api.utils.query import run_query
+from provstor_api.utils.lookup import query_cache
+from provstor_api.utils.query import run_select
+
+
+def _fetch_column(query):
+    # cross-graph, cached until the next upload
+    return query_cache.get_or_compute(query, lambda: [_[0] for _ in run_select(query)])
 
 
 def fetch_actions_for_result(result_id):
-    query_res = run_query(ACTIONS_FOR_RESULT_QUERY % result_id)
-    return [str(_[0]) for _ in query_res]
+    return _fetch_column(ACTIONS_FOR_RESULT_QUERY.bind(result=result_id))
 
 
 def fetch_objects_for_action(action_id):
-    query_res = run_query(OBJECTS_FOR_ACTION_QUERY % {"action": action_id})
-    return [str(_[0]) for _ in query_res]
+    return _fetch_column(OBJECTS_FOR_ACTION_QUERY.bind(action=action_id))
 
 
 def fetch_results_for_action(action_id):
-    query_res = run_query(RESULTS_FOR_ACTION_QUERY % {"action": action_id})
-    return [str(_[0]) for _ in query_res]
+    return _fetch_column(RESULTS_FOR_ACTION_QUERY.bind(action=action_id))
+
+
+def chunked(items, size=None):
+    size = size or settings.sparql_batch_size
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def fetch_for_ids(query, ids):
+    """\
+    Run a batched lookup query (see e.g. ACTIONS_FOR_RESULTS_QUERY) for the
+    given ids, once per chunk of ids. Return a dict that maps each id to the
+    list of values found for it, in the order returned by the store.
+    """
+    # dicts with None values work as insertion-ordered sets
+    found = {_: {} for _ in ids}
+    for batch in chunked(found):
+        for id_, value in run_select(query.bind(ids=batch)):
+            found[id_][value] = None
+    return {k: list(v) for k, v in found.items()}
+
+
+def fetch_lineage_level(result_ids):
+    """\
+    Get the actions that have any of the given ids as a result, together with
+    their objects and results, using one query per batch of ids.
+
+    Return three dicts: result id -> actions, action -> objects and action ->
+    results. Lists preserve the order in which items are returned by the
+    store and contain no duplicates.
+    """
+    # dicts with None values work as insertion-ordered sets
+    actions_for_result = {}
+    objects_for_action = {}
+    results_for_action = {}
+    for batch in chunked(result_ids):
+        for target, action, role, entity in run_select(LINEAGE_LEVEL_QUERY.bind(ids=batch)):
+            actions_for_result.setdefault(target, {})[action] = None
+            objects = objects_for_action.setdefault(action, {})
+            results = results_for_action.setdefault(action, {})
+            if role == "object":
+                objects[entity] = None
+            elif role == "result":
+                results[entity] = None
+    return tuple(
+        {k: list(v) for k, v in d.items()}
+        for d in (actions_for_result, objects_for_action, results_for_action)
+    )
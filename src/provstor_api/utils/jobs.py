@@ -0,0 +1,154 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import shutil
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+
+class Job:
+
+    def __init__(self, filename, crate_file):
+        self.id = str(uuid.uuid4())
+        self.filename = filename
+        self.crate_file = crate_file
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.crate_url = None
+        self.status_code = None
+        self.detail = None
+
+    def to_dict(self):
+        d = {
+            "job_id": self.id,
+            "status": self.status,
+            "filename": self.filename,
+            "created": self.created,
+            "finished": self.finished,
+        }
+        if self.status == "done":
+            d["crate_url"] = self.crate_url
+        elif self.status == "failed":
+            d["status_code"] = self.status_code
+            d["detail"] = self.detail
+        return d
+
+
+class IngestQueue:
+    """\
+    In-process queue of crate uploads, ingested in the background by a fixed
+    number of asyncio workers.
+
+    ingest is a coroutine function called as ingest(filename, crate_file) and
+    returning the crate URL; it reports failures by raising HTTPException.
+    Queued crates live in temporary files, so they are lost if the process
+    exits before they are ingested. Only the last max_jobs jobs are kept for
+    status queries.
+    """
+
+    def __init__(self, ingest, workers=4, max_size=100, max_jobs=1000):
+        self.ingest = ingest
+        self.n_workers = workers
+        self.max_size = max_size
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()
+        self._queue = None
+        self._workers = []
+        # slots taken by submissions that are still copying their file
+        self._reserved = 0
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.n_workers)]
+
+    async def stop(self):
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        while self._queue is not None and not self._queue.empty():
+            job = self._queue.get_nowait()
+            logging.warning("discarding upload job %s (%s)", job.id, job.filename)
+            job.crate_file.close()
+        self._queue = None
+
+    async def submit(self, filename, fileobj):
+        """\
+        Copy fileobj to a temporary file and queue it for ingestion. Raise a
+        503 error if the queue is full.
+        """
+        self.start()
+        # the slot is reserved before the copy, which yields to other submits
+        if self.max_size > 0 and self._queue.qsize() + self._reserved >= self.max_size:
+            raise HTTPException(status_code=503, detail="Upload queue is full, try again later.")
+        self._reserved += 1
+        crate_file = tempfile.TemporaryFile()
+        try:
+            fileobj.seek(0)
+            await run_in_threadpool(shutil.copyfileobj, fileobj, crate_file)
+        except BaseException:
+            crate_file.close()
+            raise
+        finally:
+            self._reserved -= 1
+        job = Job(filename, crate_file)
+        self._queue.put_nowait(job)
+        self.jobs[job.id] = job
+        self._prune()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _prune(self):
+        for job_id in list(self.jobs):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[job_id].status in ("done", "failed"):
+                del self.jobs[job_id]
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                job.crate_file.seek(0)
+                job.crate_url = await self.ingest(job.filename, job.crate_file)
+                job.status = "done"
+            except HTTPException as e:
+                job.status, job.status_code, job.detail = "failed", e.status_code, e.detail
+            except Exception as e:
+                logging.exception("upload job %s failed", job.id)
+                job.status, job.status_code, job.detail = "failed", 500, str(e)
+            finally:
+                job.finished = time.time()
+                job.crate_file.close()
+                self._queue.task_done()
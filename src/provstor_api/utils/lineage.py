@@ -0,0 +1,243 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+from array import array
+import logging
+import threading
+
+from starlette.concurrency import run_in_threadpool
+
+from provstor_api.utils.query import run_query
+from provstor_api.utils.queries import (
+    LINEAGE_EDGES_QUERY,
+    LINEAGE_MENTIONED_ACTIONS_QUERY,
+    LINEAGE_MOVE_ACTIONS_QUERY,
+)
+
+
+class LineageDelta:
+    """\
+    Lineage facts extracted from a graph: (action, role, entity) edges, where
+    role is "object" or "result", plus the subsets of entities that are files
+    or directories, of actions mentioned by a crate's root data entity and of
+    actions that represent a move.
+    """
+
+    def __init__(self, edges=(), typed=(), mentioned=(), moves=()):
+        self.edges = list(edges)
+        self.typed = set(typed)
+        self.mentioned = set(mentioned)
+        self.moves = set(moves)
+
+    @classmethod
+    def from_queries(cls, run):
+        """\
+        Extract lineage facts by running the lineage queries with run, which
+        can be either run_query (the whole store) or the query method of a
+        local rdflib graph (a single crate).
+        """
+        delta = cls()
+        for row in run(LINEAGE_EDGES_QUERY):
+            action, role, entity = str(row.action), str(row.role), str(row.entity)
+            delta.edges.append((action, role, entity))
+            if str(row.typed) == "true":
+                delta.typed.add(entity)
+        delta.mentioned.update(str(row.action) for row in run(LINEAGE_MENTIONED_ACTIONS_QUERY))
+        delta.moves.update(str(row.action) for row in run(LINEAGE_MOVE_ACTIONS_QUERY))
+        return delta
+
+
+class _LineageData:
+
+    def __init__(self):
+        self.ids = []
+        self.id_map = {}
+        self.object_actions = {}
+        self.result_actions = {}
+        self.action_objects = {}
+        self.action_results = {}
+        self.typed = set()
+        self.mentioned = set()
+        self.moves = set()
+
+    def intern(self, id_):
+        n = self.id_map.get(id_)
+        if n is None:
+            n = self.id_map[id_] = len(self.ids)
+            self.ids.append(id_)
+        return n
+
+    @staticmethod
+    def link(adjacency, src, dest):
+        neighbors = adjacency.get(src)
+        if neighbors is None:
+            adjacency[src] = array("L", [dest])
+        elif dest not in neighbors:
+            neighbors.append(dest)
+
+    def apply(self, delta):
+        for action, role, entity in delta.edges:
+            a, e = self.intern(action), self.intern(entity)
+            if role == "object":
+                self.link(self.action_objects, a, e)
+                self.link(self.object_actions, e, a)
+            else:
+                self.link(self.action_results, a, e)
+                self.link(self.result_actions, e, a)
+        self.typed.update(self.intern(_) for _ in delta.typed)
+        self.mentioned.update(self.intern(_) for _ in delta.mentioned)
+        self.moves.update(self.intern(_) for _ in delta.moves)
+
+    def names(self, nums, typed_only=True):
+        return [self.ids[_] for _ in nums if not typed_only or _ in self.typed]
+
+    def facts(self):
+        facts = set()
+        for adjacency, role in (self.action_objects, "object"), (self.action_results, "result"):
+            for a, entities in adjacency.items():
+                facts.update((self.ids[a], role, self.ids[e]) for e in entities)
+        facts.update(("typed", self.ids[_]) for _ in self.typed)
+        facts.update(("mentioned", self.ids[_]) for _ in self.mentioned)
+        facts.update(("move", self.ids[_]) for _ in self.moves)
+        return facts
+
+
+class LineageIndex:
+    """\
+    In-memory index of the object -> action -> result graph formed by the
+    CreateAction entities in the store.
+
+    Ids are interned to integers and adjacency lists are stored as arrays, so
+    that lineage traversals run in-process without querying the store.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = _LineageData()
+        self._pending = None
+        self.ready = False
+
+    def __len__(self):
+        return len(self._data.ids)
+
+    @property
+    def building(self):
+        return self._pending is not None
+
+    def add(self, delta):
+        with self._lock:
+            self._data.apply(delta)
+            if self._pending is not None:
+                self._pending.append(delta)
+
+    def rebuild(self, run):
+        """\
+        Rebuild the index from the store. Deltas added while the store is
+        being read are replayed onto the new index before it is swapped in.
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            data = _LineageData()
+            data.apply(LineageDelta.from_queries(run))
+            with self._lock:
+                for delta in self._pending:
+                    data.apply(delta)
+                self._data = data
+                self.ready = True
+        finally:
+            with self._lock:
+                self._pending = None
+        logging.info("lineage index built: %d ids", len(self))
+
+    def lineage(self, result_id):
+        """\
+        Return the lineage reachable from result_id in the same form as
+        get_utils.fetch_lineage_level: result -> actions, action -> objects
+        and action -> results.
+        """
+        actions_for_result = {}
+        objects_for_action = {}
+        results_for_action = {}
+        with self._lock:
+            d = self._data
+            start = d.id_map.get(result_id)
+            frontier = [] if start is None else [start]
+            seen = set(frontier)
+            while frontier:
+                next_frontier = []
+                for r in frontier:
+                    actions = [_ for _ in d.result_actions.get(r, ()) if _ in d.mentioned]
+                    if not actions:
+                        continue
+                    actions_for_result[d.ids[r]] = d.names(actions, typed_only=False)
+                    for a in actions:
+                        objects = d.action_objects.get(a, ())
+                        objects_for_action[d.ids[a]] = d.names(objects)
+                        results_for_action[d.ids[a]] = d.names(d.action_results.get(a, ()))
+                        for o in objects:
+                            if o in d.typed and o not in seen:
+                                seen.add(o)
+                                next_frontier.append(o)
+                frontier = next_frontier
+        return actions_for_result, objects_for_action, results_for_action
+
+    def move_dest(self, path_id):
+        """\
+        Return the destinations of the moves that have path_id as source.
+        """
+        with self._lock:
+            d = self._data
+            src = d.id_map.get(path_id)
+            if src is None or src not in d.typed:
+                return []
+            dests = {}
+            for a in d.object_actions.get(src, ()):
+                if a in d.moves:
+                    dests.update(dict.fromkeys(d.names(d.action_results.get(a, ()))))
+            return list(dests)
+
+    def check(self, run, max_diffs=10):
+        """\
+        Compare the index with the contents of the store.
+        """
+        data = _LineageData()
+        data.apply(LineageDelta.from_queries(run))
+        expected = data.facts()
+        with self._lock:
+            actual = self._data.facts()
+        missing, extra = expected - actual, actual - expected
+        return {
+            "ready": self.ready,
+            "consistent": not (missing or extra),
+            "ids": len(self),
+            "facts": len(actual),
+            "n_missing": len(missing),
+            "missing": [list(_) for _ in sorted(missing)[:max_diffs]],
+            "n_extra": len(extra),
+            "extra": [list(_) for _ in sorted(extra)[:max_diffs]],
+        }
+
+
+lineage_index = LineageIndex()
+
+
+async def build_lineage_index():
+    try:
+        await run_in_threadpool(lineage_index.rebuild, run_query)
+    except Exception as e:
+        logging.error("could not build the lineage index, lineage queries will go to the store: %s", e)
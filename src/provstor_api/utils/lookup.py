@@ -0,0 +1,196 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+In-process memoization of lookups whose answer never changes once known,
+such as the URL of the crate a root data entity comes from, and of query
+output.
+"""
+
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from provstor_api.config import settings
+from provstor_api.utils.query import arun_select
+from provstor_api.utils.queries import CRATE_URLS_QUERY
+
+
+class LookupCache:
+    """\
+    Bounded, thread-safe LRU memo for write-once lookups. Only positive
+    answers should be stored: a key that is not found now might be added
+    later.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "size": self.size, "hits": self.hits, "misses": self.misses}
+
+
+def _nbytes(obj):
+    # rough, but good enough to keep memory use in check
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_nbytes(_) for _ in obj)
+    return sys.getsizeof(obj)
+
+
+class QueryCache:
+    """\
+    LRU cache of query output, bounded by an estimate of its memory use and
+    by a time to live (no expiry if ttl is 0).
+
+    A graph never changes once loaded, so output computed from a single
+    graph stays valid. Output computed across graphs is only valid until the
+    next upload: it is tagged with the generation at which it was computed,
+    and is discarded on access if the generation has been bumped since.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.generation = 0
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (value, generation or None if per graph, expiry time, size)
+        self._data = OrderedDict()
+
+    def bump(self):
+        """\
+        Invalidate all the cross-graph entries. Call when a graph is added.
+        """
+        with self._lock:
+            self.generation += 1
+
+    def _drop(self, key):
+        self.size -= self._data.pop(key)[3]
+
+    def get_or_compute(self, key, compute, per_graph=False):
+        """\
+        Return the output cached for key, or compute it by calling compute.
+        Set per_graph if the output depends on a single graph. Empty output
+        for a single graph is not cached, the graph might not be loaded yet.
+        """
+        now = time.monotonic()
+        with self._lock:
+            generation = self.generation
+            item = self._data.get(key)
+            if item is not None:
+                value, gen, expires, _ = item
+                if now < expires and gen in (None, generation):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._drop(key)
+            self.misses += 1
+        value = compute()
+        if per_graph and not value:
+            return value
+        nbytes = _nbytes(key) + _nbytes(value)
+        if nbytes > self.max_size:
+            return value
+        expires = now + self.ttl if self.ttl else float("inf")
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            # tagged with the generation read before computing, so output
+            # computed while a graph was being added is not kept
+            self._data[key] = (value, None if per_graph else generation, expires, nbytes)
+            self.size += nbytes
+            while self.size > self.max_size:
+                self._drop(next(iter(self._data)))
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "size": self.size,
+                "max_size": self.max_size,
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def rde_key(rde_id):
+    return rde_id.rstrip("/") + "/"
+
+
+# root data entity id -> crate URL
+crate_urls = LookupCache(settings.crate_url_cache_size)
+query_cache = QueryCache(settings.query_cache_size, settings.query_cache_ttl)
+
+
+async def prewarm_crate_urls():
+    """\
+    Fill crate_urls with the crates in the store, up to its size.
+    """
+    try:
+        rows = await arun_select(CRATE_URLS_QUERY)
+    except Exception as e:
+        logging.error("could not prewarm the crate URL cache: %s", e)
+        return
+    for rde, crate_url in rows:
+        if len(crate_urls) >= crate_urls.size:
+            break
+        crate_urls.put(rde_key(rde), crate_url)
+    logging.info("crate URL cache: %d entries", len(crate_urls))
@@ -0,0 +1,145 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Member index of zipped crates.
+
+At ingest, the member table of each crate is stored next to it in the
+object store, as a sidecar under .index/{crate name}.json. For each member, it records where the member's
+data starts in the zip (past the local header), its compressed and
+uncompressed sizes, compression method and CRC-32. With it, a member can be
+served with a single range request, without reading the zip's central
+directory first.
+"""
+
+import logging
+import struct
+import zipfile
+import zlib
+
+import httpx
+
+from provstor_api.config import settings
+from provstor_api.utils.sidecar import Sidecar
+from provstor_api.utils.storage import open_crate, stream_crate
+
+INDEX_VERSION = 1
+# compression methods that stream_member can decode
+STREAMABLE = {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED}
+
+_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+def build_member_index(crate_file):
+    """\
+    Return the member index of the zip in crate_file (a seekable binary
+    file), as a JSON-serializable dict.
+    """
+    members = {}
+    with zipfile.ZipFile(crate_file, "r") as zipf:
+        infos = sorted(zipf.infolist(), key=lambda _: _.header_offset)
+        for info in infos:
+            if info.is_dir() or info.flag_bits & 0x1:  # skip encrypted members
+                continue
+            crate_file.seek(info.header_offset)
+            header = _LOCAL_HEADER.unpack(crate_file.read(_LOCAL_HEADER.size))
+            if header[0] != _LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f"bad local file header for {info.filename}")
+            # the local extra field may differ from the central directory's one
+            data_offset = info.header_offset + _LOCAL_HEADER.size + header[9] + header[10]
+            members[info.filename] = [
+                data_offset, info.compress_size, info.file_size, info.compress_type, info.CRC
+            ]
+    return {"version": INDEX_VERSION, "members": members}
+
+
+member_indexes = Sidecar(".index", INDEX_VERSION, settings.member_index_cache_size, "member index")
+
+
+def index_crate(crate_name, crate_url, crate_file):
+    """\
+    Build and store the member index of a crate, logging (rather than
+    raising) any error: the index is an optimization, crates without one
+    are still served. Blocking.
+    """
+    try:
+        crate_file.seek(0)
+        member_indexes.save(crate_name, crate_url, build_member_index(crate_file))
+    except Exception:
+        logging.exception("failed to index the members of %s", crate_name)
+        member_indexes.discard(crate_name, crate_url)
+
+
+async def get_member_index(crate_url):
+    """\
+    Return the member index of the crate at crate_url, or None if it has
+    not been indexed (or the index cannot be read).
+    """
+    return await member_indexes.read(crate_url)
+
+
+async def stream_member(crate_url, name, entry):
+    """\
+    Stream the uncompressed data of the member with the given index entry,
+    fetching only its bytes from the crate with one range request. The
+    member's CRC-32 is checked when the stream ends.
+    """
+    data_offset, compress_size, file_size, compress_type, crc = entry
+    if compress_type not in STREAMABLE:
+        raise ValueError(f"unsupported compression method: {compress_type}")
+    if compress_size > 0:
+        _, _, chunks = await stream_crate(crate_url, byte_range=(data_offset, data_offset + compress_size - 1))
+    else:
+        chunks = None
+
+    async def member_chunks():
+        decompressor = zlib.decompressobj(-15) if compress_type == zipfile.ZIP_DEFLATED else None
+        actual_crc = 0
+        if chunks is not None:
+            async for chunk in chunks:
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                yield chunk
+        if decompressor:
+            chunk = decompressor.flush()
+            actual_crc = zlib.crc32(chunk, actual_crc)
+            if chunk:
+                yield chunk
+        if actual_crc != crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {name!r}")
+
+    return member_chunks()
+
+
+def rebuild_member_index(crate_urls):
+    """\
+    (Re)build the member index of the given crates, which are read with
+    range requests. Return the URLs of the crates that could not be
+    indexed. Blocking.
+    """
+    failed = []
+    for crate_url in crate_urls:
+        crate_name = crate_url.rsplit("/", 1)[-1]
+        try:
+            with open_crate(crate_url) as crate_file:
+                member_indexes.save(crate_name, crate_url, build_member_index(crate_file))
+        except (zipfile.BadZipFile, httpx.HTTPError, OSError):
+            logging.exception("failed to index the members of %s", crate_url)
+            failed.append(crate_url)
+    return failed
@@ -0,0 +1,264 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Request instrumentation.
+
+Calls to the triple store, the filer and S3, result parsing and response
+encoding are wrapped in timed(kind, name), where kind is one of "sparql",
+"filer", "s3", "parse" and "encode", and name identifies the operation
+(for SPARQL, the name of the query). Each call is recorded twice: in the
+process-wide metrics served at /metrics in the Prometheus text format, and
+in the timings of the current request, which MetricsMiddleware sends back
+in the Server-Timing response header. For streaming responses, the header
+only covers the work done before the body starts. If tracing is enabled,
+each timed operation is also a span (see tracing).
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import math
+import re
+import threading
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.responses import JSONResponse
+
+from provstor_api.utils.tracing import start_span
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# characters that cannot appear in a Server-Timing metric name
+NON_TOKEN = re.compile(r"[^\w!#$%&'*+.^`|~-]")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = (*buckets, math.inf)
+        # labels -> [count per bucket (not cumulative), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            counts = self._values.setdefault(labels, [[0] * len(self.buckets), 0.0])
+            counts[0][i] += 1
+            counts[1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _labels(self.labelnames, labels, [("le", _number(bound))])
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+REQUEST_DURATION = Histogram(
+    "provstor_http_request_duration_seconds", "Time to serve HTTP requests, by route.",
+    ("method", "route", "status"),
+)
+OPERATION_DURATION = Histogram(
+    "provstor_operation_duration_seconds", "Time spent in store, filer and S3 calls, parsing and encoding.",
+    ("kind", "name"),
+)
+OPERATION_BYTES = Counter(
+    "provstor_operation_bytes_total", "Bytes received from (or sent to) the store, the filer and S3.",
+    ("kind", "name"),
+)
+OPERATION_ROWS = Counter(
+    "provstor_operation_rows_total", "Rows (solutions or triples) in query results.", ("kind", "name"),
+)
+METRICS = [REQUEST_DURATION, OPERATION_DURATION, OPERATION_BYTES, OPERATION_ROWS]
+
+
+def render_metrics():
+    return "\n".join(line for metric in METRICS for line in metric.collect()) + "\n"
+
+
+class RequestTimings:
+    """\
+    Totals of the operations run while serving one request. Operations run
+    in the threadpool are added to the same instance, hence the lock.
+    """
+
+    def __init__(self):
+        # (kind, name) -> [calls, seconds, bytes, rows]
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, duration, nbytes=None, rows=None):
+        with self._lock:
+            entry = self.entries.setdefault((kind, name), [0, 0.0, 0, 0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += nbytes or 0
+            entry[3] += rows or 0
+
+    def server_timing(self, total):
+        with self._lock:
+            entries = sorted(self.entries.items(), key=lambda _: -_[1][1])
+        metrics = []
+        for (kind, name), (calls, seconds, nbytes, rows) in entries:
+            desc = [f"{calls} calls" if calls > 1 else "1 call"]
+            if rows:
+                desc.append(f"{rows} rows")
+            if nbytes:
+                desc.append(f"{nbytes} bytes")
+            metrics.append(f'{NON_TOKEN.sub("-", f"{kind}.{name}")};dur={seconds * 1000:.1f};desc="{" / ".join(desc)}"')
+        metrics.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+_request_timings = ContextVar("request_timings", default=None)
+
+
+class Timing:
+    """\
+    Set bytes and rows of the operation being timed, if known.
+    """
+    __slots__ = ("bytes", "rows")
+
+    def __init__(self):
+        self.bytes = self.rows = None
+
+
+def record(kind, name, duration, nbytes=None, rows=None):
+    labels = (kind, name)
+    OPERATION_DURATION.observe(labels, duration)
+    if nbytes is not None:
+        OPERATION_BYTES.inc(labels, nbytes)
+    if rows is not None:
+        OPERATION_ROWS.inc(labels, rows)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(kind, name, duration, nbytes, rows)
+
+
+@contextmanager
+def timed(kind, name):
+    timing = Timing()
+    with start_span(f"{kind} {name}", {"kind": kind, "name": name}) as span:
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            record(kind, name, time.perf_counter() - start, timing.bytes, timing.rows)
+            if span is not None:
+                span.attributes.update(bytes=timing.bytes, rows=timing.rows)
+
+
+class TimedJSONResponse(JSONResponse):
+    """\
+    JSONResponse that records the time spent encoding the body.
+    """
+
+    def render(self, content):
+        with timed("encode", "json") as timing:
+            body = super().render(content)
+            timing.bytes = len(body)
+        return body
+
+
+class MetricsMiddleware:
+    """\
+    Time each request, by route, and report the operations it ran in the
+    Server-Timing header (unless server_timing is False).
+    """
+
+    def __init__(self, app, server_timing=True):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", timings.server_timing(time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _request_timings.reset(token)
+            # the route's path template, not the actual path, to bound the number of series
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            REQUEST_DURATION.observe((scope["method"], route_path, str(status)), time.perf_counter() - start)
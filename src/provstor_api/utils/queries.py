@@ -15,8 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
+from provstor_api.utils.templates import Query, QueryTemplate
 
-RDE_QUERY = """\
+
+RDE_QUERY = Query("rde", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?rde
@@ -25,49 +27,44 @@ WHERE {
   FILTER(contains(str(?md), "ro-crate-metadata.json")) .
   ?md schema:about ?rde
 }
-"""
+""")
 
-# The parameter must be replaced by a root data entity id
-CRATE_URL_QUERY = """\
+CRATE_URL_QUERY = QueryTemplate("crate-url", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?crate_url
 WHERE {
-  <%s> schema:url ?crate_url
+  $iri{rde} schema:url ?crate_url
 }
-"""
+""")
 
 
-GRAPH_ID_FOR_FILE_QUERY = """\
+# Cross-graph queries find crates through the catalog graph (see
+# utils/catalog.py), which holds, for each crate, the metadata descriptor
+# and the root data entity's url, mainEntity and mentions.
+GRAPH_ID_FOR_FILE_QUERY = QueryTemplate("graph-id-for-file", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?url
 WHERE {
-  ?md a schema:CreativeWork .
-  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
-  ?md schema:about ?rde .
-  ?rde schema:url ?url .
-  ?rde schema:hasPart <%s> .
+  ?rde schema:hasPart $iri{file} .
+  GRAPH <urn:provstor:catalog> { ?rde schema:url ?url }
 }
-"""
+""")
 
 
-GRAPH_ID_FOR_RESULT_QUERY = """\
+GRAPH_ID_FOR_RESULT_QUERY = QueryTemplate("graph-id-for-result", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?url
 WHERE {
-  ?md a schema:CreativeWork .
-  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
-  ?md schema:about ?rde .
-  ?rde schema:url ?url .
-  ?rde schema:mentions ?action .
+  ?action schema:result $iri{result} .
   ?action a schema:CreateAction .
-  ?action schema:result <%s> .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action ; schema:url ?url }
 }
-"""
+""")
 
-WORKFLOW_QUERY = """\
+WORKFLOW_QUERY = Query("workflow", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?workflow
@@ -77,9 +74,9 @@ WHERE {
   ?md schema:about ?rde .
   ?rde schema:mainEntity ?workflow .
 }
-"""
+""")
 
-WFRUN_RESULTS_QUERY = """\
+WFRUN_RESULTS_QUERY = Query("wfrun-results", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?result
@@ -92,9 +89,9 @@ WHERE {
   ?action schema:result ?result .
   { ?result a schema:MediaObject } UNION { ?result a schema:Dataset }
 }
-"""
+""")
 
-WFRUN_OBJECTS_QUERY = """\
+WFRUN_OBJECTS_QUERY = Query("wfrun-objects", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?object
@@ -107,73 +104,167 @@ WHERE {
   ?action schema:object ?object .
   { ?object a schema:MediaObject } UNION { ?object a schema:Dataset }
 }
-"""
+""")
 
 
-ACTIONS_FOR_RESULT_QUERY = """\
+ACTIONS_FOR_RESULT_QUERY = QueryTemplate("actions-for-result", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?action
 WHERE {
-  ?md a schema:CreativeWork .
-  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
-  ?md schema:about ?rde .
-  ?rde schema:mentions ?action .
+  ?action schema:result $iri{result} .
   ?action a schema:CreateAction .
-  ?action schema:result <%s> .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action }
 }
-"""
+""")
 
 
-OBJECTS_FOR_ACTION_QUERY = """\
+OBJECTS_FOR_ACTION_QUERY = QueryTemplate("objects-for-action", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?object
 WHERE {
-  ?md a schema:CreativeWork .
-  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
-  ?md schema:about ?rde .
-  ?rde schema:mentions <%(action)s> .
-  <%(action)s> a schema:CreateAction .
-  <%(action)s> schema:object ?object .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions $iri{action} }
+  $iri{action} a schema:CreateAction .
+  $iri{action} schema:object ?object .
   { ?object a schema:MediaObject } UNION { ?object a schema:Dataset }
 }
-"""
+""")
 
 
-RESULTS_FOR_ACTION_QUERY = """\
+RESULTS_FOR_ACTION_QUERY = QueryTemplate("results-for-action", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?result
 WHERE {
-  ?md a schema:CreativeWork .
-  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
-  ?md schema:about ?rde .
-  ?rde schema:mentions <%(action)s> .
-  <%(action)s> a schema:CreateAction .
-  <%(action)s> schema:result ?result .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions $iri{action} }
+  $iri{action} a schema:CreateAction .
+  $iri{action} schema:result ?result .
   { ?result a schema:MediaObject } UNION { ?result a schema:Dataset }
 }
-"""
+""")
 
 
-OBJECTS_FOR_RESULT_QUERY = """\
+# Batched versions of the lookups above, for any number of ids; each row
+# pairs one of them (?id) with a value.
+GRAPH_IDS_FOR_FILES_QUERY = QueryTemplate("graph-ids-for-files", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?id ?url
+WHERE {
+  VALUES ?id { $iris{ids} }
+  ?rde schema:hasPart ?id .
+  GRAPH <urn:provstor:catalog> { ?rde schema:url ?url }
+}
+""")
+
+GRAPH_IDS_FOR_RESULTS_QUERY = QueryTemplate("graph-ids-for-results", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?id ?url
+WHERE {
+  VALUES ?id { $iris{ids} }
+  ?action schema:result ?id .
+  ?action a schema:CreateAction .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action ; schema:url ?url }
+}
+""")
+
+ACTIONS_FOR_RESULTS_QUERY = QueryTemplate("actions-for-results", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?id ?action
+WHERE {
+  VALUES ?id { $iris{ids} }
+  ?action schema:result ?id .
+  ?action a schema:CreateAction .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action }
+}
+""")
+
+OBJECTS_FOR_RESULTS_QUERY = QueryTemplate("objects-for-results", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?id ?object
+WHERE {
+  VALUES ?id { $iris{ids} }
+  ?action schema:result ?id .
+  ?action a schema:CreateAction .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action }
+  ?action schema:object ?object .
+  { ?object a schema:MediaObject } UNION { ?object a schema:Dataset }
+}
+""")
+
+OBJECTS_FOR_ACTIONS_QUERY = QueryTemplate("objects-for-actions", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?id ?object
+WHERE {
+  VALUES ?id { $iris{ids} }
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?id }
+  ?id a schema:CreateAction .
+  ?id schema:object ?object .
+  { ?object a schema:MediaObject } UNION { ?object a schema:Dataset }
+}
+""")
+
+RESULTS_FOR_ACTIONS_QUERY = QueryTemplate("results-for-actions", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?id ?result
+WHERE {
+  VALUES ?id { $iris{ids} }
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?id }
+  ?id a schema:CreateAction .
+  ?id schema:result ?result .
+  { ?result a schema:MediaObject } UNION { ?result a schema:Dataset }
+}
+""")
+
+
+# Expands one level of the lineage graph from the given ids. Each row links
+# a target to an action that has it as a result; the role is "object"
+# or "result" for the action's inputs and outputs, and "action" (with no
+# entity) to report actions that have neither.
+LINEAGE_LEVEL_QUERY = QueryTemplate("lineage-level", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?target ?action ?role ?entity
+WHERE {
+  VALUES ?target { $iris{ids} }
+  ?action schema:result ?target .
+  ?action a schema:CreateAction .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action }
+  {
+    BIND("action" AS ?role)
+  } UNION {
+    ?action schema:object ?entity .
+    { ?entity a schema:MediaObject } UNION { ?entity a schema:Dataset }
+    BIND("object" AS ?role)
+  } UNION {
+    ?action schema:result ?entity .
+    { ?entity a schema:MediaObject } UNION { ?entity a schema:Dataset }
+    BIND("result" AS ?role)
+  }
+}
+""")
+
+
+OBJECTS_FOR_RESULT_QUERY = QueryTemplate("objects-for-result", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT DISTINCT ?object
 WHERE {
-  ?md a schema:CreativeWork .
-  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
-  ?md schema:about ?rde .
-  ?rde schema:mentions ?action .
+  ?action schema:result $iri{result} .
   ?action a schema:CreateAction .
+  GRAPH <urn:provstor:catalog> { ?rde schema:mentions ?action }
   ?action schema:object ?object .
-  ?action schema:result <%s> .
   { ?object a schema:MediaObject } UNION { ?object a schema:Dataset }
 }
-"""
+""")
 
-WFRUN_PARAMS_QUERY = """\
+WFRUN_PARAMS_QUERY = Query("wfrun-params", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT ?name ?value
@@ -188,43 +279,142 @@ WHERE {
   ?object schema:name ?name .
   ?object schema:value ?value .
 }
-"""
+""")
 
-GRAPHS_QUERY = """\
+RUN_TIMES_QUERY = Query("run-times", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT (MIN(?start) AS ?start_time) (MAX(?end) AS ?end_time)
+WHERE {
+  ?md a schema:CreativeWork .
+  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+  ?md schema:about ?rde .
+  ?rde schema:mainEntity ?workflow .
+  ?action schema:instrument ?workflow .
+  OPTIONAL { ?action schema:startTime ?start }
+  OPTIONAL { ?action schema:endTime ?end }
+}
+""")
+
+ACTION_COUNT_QUERY = Query("action-count", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT (COUNT(DISTINCT ?action) AS ?actions)
+WHERE {
+  ?md a schema:CreativeWork .
+  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+  ?md schema:about ?rde .
+  ?rde schema:mentions ?action .
+  ?action a schema:CreateAction .
+}
+""")
+
+GRAPHS_QUERY = Query("graphs", """\
 SELECT DISTINCT ?g
 WHERE {
   GRAPH ?g { ?s ?p ?o }
+  FILTER(?g != <urn:provstor:catalog>)
 }
 ORDER BY ?g
-"""
+""")
+
+# Crate graphs whose name starts with prefix, after cursor. A LIMIT can be
+# appended. One row per graph, so that the pages match the keyset (and the
+# count) even if a graph has several root data entities.
+CATALOG_GRAPHS_QUERY = QueryTemplate("catalog-graphs", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT ?g (SAMPLE(?root) AS ?rde)
+WHERE {
+  GRAPH <urn:provstor:catalog> {
+    ?md schema:about ?root .
+    ?root schema:url ?url .
+  }
+  FILTER(STRSTARTS(STR(?url), $literal{prefix}) && STR(?url) > $literal{cursor})
+  # crate graphs are named after the crate URL
+  BIND(IRI(?url) AS ?g)
+}
+GROUP BY ?g ?url
+ORDER BY ?url
+""")
+
+CATALOG_GRAPH_COUNT_QUERY = QueryTemplate("catalog-graph-count", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT (COUNT(DISTINCT ?url) AS ?n)
+WHERE {
+  GRAPH <urn:provstor:catalog> {
+    ?md schema:about ?rde .
+    ?rde schema:url ?url .
+  }
+  FILTER(STRSTARTS(STR(?url), $literal{prefix}))
+}
+""")
+
+CRATE_URLS_QUERY = Query("crate-urls", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?rde ?crate_url
+WHERE {
+  GRAPH <urn:provstor:catalog> { ?rde schema:url ?crate_url }
+}
+""")
+
+# Catalog entries of a crate, from its metadata graph
+CATALOG_CONSTRUCT_QUERY = Query("catalog-construct", """\
+PREFIX schema: <http://schema.org/>
+
+CONSTRUCT {
+  ?md schema:about ?rde .
+  ?rde schema:url ?url .
+  ?rde schema:mainEntity ?workflow .
+  ?rde schema:mentions ?action .
+}
+WHERE {
+  ?md a schema:CreativeWork .
+  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+  ?md schema:about ?rde .
+  ?rde schema:url ?url .
+  { } UNION { ?rde schema:mainEntity ?workflow } UNION { ?rde schema:mentions ?action }
+}
+""")
 
-RDE_GRAPH_QUERY = """\
+# Add the catalog entries of all the crates in the store
+CATALOG_BACKFILL_UPDATE = Query("catalog-backfill", """\
 PREFIX schema: <http://schema.org/>
 
-SELECT DISTINCT ?g ?rde
+INSERT {
+  GRAPH <urn:provstor:catalog> {
+    ?md schema:about ?rde .
+    ?rde schema:url ?url .
+    ?rde schema:mainEntity ?workflow .
+    ?rde schema:mentions ?action .
+  }
+}
 WHERE {
   GRAPH ?g {
     ?md a schema:CreativeWork .
     FILTER(contains(str(?md), "ro-crate-metadata.json")) .
     ?md schema:about ?rde .
-    FILTER(STRSTARTS(STR(?md), "arcp://uuid,"))
+    ?rde schema:url ?url .
+    { } UNION { ?rde schema:mainEntity ?workflow } UNION { ?rde schema:mentions ?action }
   }
+  FILTER(?g != <urn:provstor:catalog>)
 }
-ORDER BY ?g
-"""
+""")
 
-IS_FILE_OR_DIR_QUERY = """\
+IS_FILE_OR_DIR_QUERY = QueryTemplate("is-file-or-dir", """\
 PREFIX schema: <http://schema.org/>
 
 SELECT ?f
 WHERE {
   { ?f a schema:MediaObject } UNION { ?f a schema:Dataset } .
-  FILTER(?f = <%s>)
+  FILTER(?f = $iri{id})
 }
-"""
+""")
 
 
-MOVE_DEST_QUERY = """\
+MOVE_DEST_QUERY = QueryTemplate("move-dest", """\
 PREFIX schema: <http://schema.org/>
 SELECT DISTINCT ?dest
 WHERE {
@@ -234,13 +424,60 @@ WHERE {
   ?a schema:object ?src .
   ?a schema:result ?dest .
   ?a schema:instrument <https://w3id.org/ro/terms/provstor#MoveTool> .
-  FILTER(?src = <%s>)
+  FILTER(?src = $iri{src})
 }
-"""
+""")
+
+
+# Queries used to build the in-memory lineage index
+LINEAGE_EDGES_QUERY = Query("lineage-edges", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?action ?role ?entity ?typed
+WHERE {
+  ?action a schema:CreateAction .
+  {
+    ?action schema:object ?entity .
+    BIND("object" AS ?role)
+  } UNION {
+    ?action schema:result ?entity .
+    BIND("result" AS ?role)
+  }
+  BIND(EXISTS { { ?entity a schema:MediaObject } UNION { ?entity a schema:Dataset } } AS ?typed)
+}
+""")
 
+LINEAGE_MENTIONED_ACTIONS_QUERY = Query("lineage-mentioned-actions", """\
+PREFIX schema: <http://schema.org/>
 
-INSERT_QUERY = """
+SELECT DISTINCT ?action
+WHERE {
+  ?md a schema:CreativeWork .
+  FILTER(contains(str(?md), "ro-crate-metadata.json")) .
+  ?md schema:about ?rde .
+  ?rde schema:mentions ?action .
+  ?action a schema:CreateAction .
+}
+""")
+
+LINEAGE_MOVE_ACTIONS_QUERY = Query("lineage-move-actions", """\
+PREFIX schema: <http://schema.org/>
+
+SELECT DISTINCT ?action
+WHERE {
+  ?action a schema:CreateAction .
+  ?action schema:instrument <https://w3id.org/ro/terms/provstor#MoveTool> .
+}
+""")
+
+# The parameter must be replaced by one or more GRAPH_BLOCKs
+INSERT_GRAPHS_QUERY = """
 INSERT DATA {
 %s
 }
 """
+
+GRAPH_BLOCK = """\
+GRAPH %s {
+%s
+}"""
@@ -15,20 +15,420 @@
 # You should have received a copy of the GNU General Public License
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
+from contextlib import contextmanager
+from io import BytesIO
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
 
+import httpx
+from rdflib.query import Result
 from rdflib.term import URIRef
-from rdflib.plugins.stores.sparqlstore import SPARQLUpdateStore
 
 from provstor_api.config import settings
+from provstor_api.utils.metrics import Timing, timed
+from provstor_api.utils.tracing import APROPAGATE_HOOKS, PROPAGATE_HOOKS
+
+
+RESULTS_ACCEPT = "application/sparql-results+json, application/rdf+xml;q=0.9"
+ROWS_ACCEPT = "application/sparql-results+json, text/tab-separated-values;q=0.9"
+TSV = "text/tab-separated-values"
+NTRIPLES = "application/n-triples"
+NQUADS = "application/n-quads"
+CHUNK_SIZE = 1024 * 1024
+# how much of a slow query is logged: values of each parameter, query text
+LOGGED_VALUES = 5
+LOGGED_TEXT = 500
+
+slow_query_log = logging.getLogger("provstor_api.slow_queries")
+
+
+def _query_request(query, default_graph=None, accept=RESULTS_ACCEPT):
+    params = {}
+    if default_graph is not None:
+        params["default-graph-uri"] = str(default_graph)
+    return {
+        "params": params,
+        "content": query.encode(),
+        "headers": {"Accept": accept, "Content-Type": "application/sparql-query"},
+    }
+
+
+def _update_request(update):
+    return {
+        "content": update.encode(),
+        "headers": {"Content-Type": "application/sparql-update; charset=UTF-8"},
+    }
+
+
+def _graph_store_request(graph_uri, content_type):
+    return {
+        "params": {"graph": str(graph_uri)} if graph_uri is not None else {},
+        "headers": {"Content-Type": content_type},
+    }
+
+
+async def _aiter_file(f):
+    while chunk := f.read(CHUNK_SIZE):
+        yield chunk
+
+
+def _parse_results(response):
+    response.raise_for_status()
+    content_type = response.headers.get("Content-Type", "application/sparql-results+xml")
+    return Result.parse(BytesIO(response.content), content_type=content_type.split(";")[0])
+
+
+# N-Triples string escapes, as used in SPARQL TSV results
+ESCAPE = re.compile(r"\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))")
+ECHARS = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f", '"': '"', "'": "'", "\\": "\\"}
+
+
+def _unescape(m):
+    code = m.group(1) or m.group(2)
+    return chr(int(code, 16)) if code else ECHARS.get(m.group(3), m.group(0))
+
+
+def tsv_value(term):
+    """\
+    Return the string value of an RDF term as written in SPARQL TSV results
+    (the same as str() of the rdflib term), or None if it is empty (unbound).
+    """
+    if not term:
+        return None
+    if term[0] == "<":
+        return term[1:-1]
+    if term[0] == '"':
+        # the lexical form, without language tag or datatype
+        value = term[1:term.rindex('"')]
+        return ESCAPE.sub(_unescape, value) if "\\" in value else value
+    if term.startswith("_:"):
+        return term[2:]
+    # numbers and booleans are written as they are
+    return term
+
+
+def _json_rows(content):
+    results = json.loads(content)
+    names = results["head"]["vars"]
+    return [
+        tuple(b[n]["value"] if n in b else None for n in names)
+        for b in results["results"]["bindings"]
+    ]
+
+
+def _tsv_rows(content):
+    lines = content.decode("utf-8").split("\n")
+    if not lines[-1]:
+        lines.pop()
+    return [tuple(tsv_value(t) for t in line.rstrip("\r").split("\t")) for line in lines[1:]]
+
+
+def _parse_rows(response):
+    response.raise_for_status()
+    if response.headers.get("Content-Type", "").startswith(TSV):
+        return _tsv_rows(response.content)
+    return _json_rows(response.content)
+
+
+def _query_name(query, default="adhoc"):
+    # named queries are reported by name in timings and metrics
+    return getattr(query, "name", None) or default
+
+
+def _content_size(content):
+    return len(content) if isinstance(content, bytes) else None
+
+
+def _logged_params(params):
+    # VALUES blocks can hold hundreds of ids
+    return {
+        k: [*v[:LOGGED_VALUES], f"... {len(v)} values"] if isinstance(v, list) and len(v) > LOGGED_VALUES else v
+        for k, v in params.items()
+    }
+
+
+@contextmanager
+def _logged(query, default_graph=None, name=None):
+    """\
+    Log the call if it takes longer than settings.slow_query_threshold
+    seconds (0 disables the log). Set rows on the yielded object to have
+    them logged too.
+    """
+    call = Timing()
+    start = time.perf_counter()
+    try:
+        yield call
+    finally:
+        elapsed = time.perf_counter() - start
+        if 0 < settings.slow_query_threshold <= elapsed:
+            name = name or _query_name(query)
+            params = getattr(query, "params", None)
+            if params:
+                details = f"params {_logged_params(params)}"
+            elif name == "adhoc":
+                details = f"query {query[:LOGGED_TEXT]!r}"
+            else:
+                details = "no params"
+            slow_query_log.warning(
+                "slow query %s: %.3fs, %s rows, graph %s, %s", name, elapsed,
+                "?" if call.rows is None else call.rows, default_graph or "default", details
+            )
+
+
+def _http_client_args(pool_size, timeout, connect_timeout, transport, event_hooks):
+    return {
+        "limits": httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        "timeout": httpx.Timeout(timeout, connect=connect_timeout),
+        "transport": transport,
+        # pass the trace context on to the store
+        "event_hooks": event_hooks,
+    }
+
+
+class SPARQLClient:
+    """\
+    Client for the SPARQL 1.1 protocol endpoints of a Fuseki dataset.
+
+    Requests share a pool of HTTP keep-alive connections, so the client is
+    meant to be long-lived and shared by all requests in the process.
+    """
+
+    def __init__(self, base_url, dataset, pool_size=10, timeout=30.0,
+                 connect_timeout=5.0, transport=None):
+        self.query_endpoint = f"{base_url}/{dataset}/sparql"
+        self.update_endpoint = f"{base_url}/{dataset}/update"
+        self.data_endpoint = f"{base_url}/{dataset}/data"
+        self.http = httpx.Client(**_http_client_args(pool_size, timeout, connect_timeout, transport, PROPAGATE_HOOKS))
+
+    def _query(self, query, default_graph, accept, parse):
+        name = _query_name(query)
+        with _logged(query, default_graph) as call:
+            with timed("sparql", name) as timing:
+                response = self.http.post(self.query_endpoint, **_query_request(query, default_graph, accept=accept))
+                timing.bytes = len(response.content)
+            with timed("parse", name) as timing:
+                result = parse(response)
+                call.rows = timing.rows = len(result)
+        return result
+
+    def query(self, query, default_graph=None):
+        return self._query(query, default_graph, RESULTS_ACCEPT, _parse_results)
+
+    def select(self, query, default_graph=None):
+        """\
+        Run a SELECT query and return the solutions as tuples of strings (None
+        for unbound variables), in the order of the query's variables.
+
+        Much cheaper than query() for large results, since no rdflib terms
+        are built.
+        """
+        return self._query(query, default_graph, ROWS_ACCEPT, _parse_rows)
+
+    def update(self, update):
+        name = _query_name(update, "update")
+        with _logged(update, name=name), timed("sparql", name) as timing:
+            timing.bytes = len(update.encode())
+            response = self.http.post(self.update_endpoint, **_update_request(update))
+            response.raise_for_status()
+
+    def close(self):
+        self.http.close()
+
+
+class AsyncSPARQLClient:
+    """\
+    Asyncio counterpart of SPARQLClient, for use in ``async def`` routes.
+    """
+
+    def __init__(self, base_url, dataset, pool_size=10, timeout=30.0,
+                 connect_timeout=5.0, transport=None):
+        self.query_endpoint = f"{base_url}/{dataset}/sparql"
+        self.update_endpoint = f"{base_url}/{dataset}/update"
+        self.data_endpoint = f"{base_url}/{dataset}/data"
+        self.http = httpx.AsyncClient(
+            **_http_client_args(pool_size, timeout, connect_timeout, transport, APROPAGATE_HOOKS)
+        )
+
+    async def _query(self, query, default_graph, accept, parse):
+        name = _query_name(query)
+        with _logged(query, default_graph) as call:
+            with timed("sparql", name) as timing:
+                response = await self.http.post(self.query_endpoint,
+                                                **_query_request(query, default_graph, accept=accept))
+                timing.bytes = len(response.content)
+            with timed("parse", name) as timing:
+                result = parse(response)
+                call.rows = timing.rows = len(result)
+        return result
+
+    async def query(self, query, default_graph=None):
+        return await self._query(query, default_graph, RESULTS_ACCEPT, _parse_results)
+
+    async def select(self, query, default_graph=None):
+        return await self._query(query, default_graph, ROWS_ACCEPT, _parse_rows)
+
+    async def stream(self, query, accept, default_graph=None):
+        """\
+        Start running query, asking for results in the accept format.
+
+        Return the response headers and an async iterator over the body
+        chunks, which are relayed as the store produces them. The connection
+        is released when the iterator is exhausted or closed. Only the time to
+        the response headers is recorded.
+        """
+        request = self.http.build_request("POST", self.query_endpoint,
+                                          **_query_request(query, default_graph, accept=accept))
+        with _logged(query, default_graph), timed("sparql", _query_name(query)):
+            response = await self.http.send(request, stream=True)
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError:
+                # the store's error message is more useful than the status alone
+                await response.aread()
+                await response.aclose()
+                raise
+
+        async def chunks():
+            try:
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+            finally:
+                await response.aclose()
+
+        return response.headers, chunks()
+
+    async def update(self, update):
+        name = _query_name(update, "update")
+        with _logged(update, name=name), timed("sparql", name) as timing:
+            timing.bytes = len(update.encode())
+            response = await self.http.post(self.update_endpoint, **_update_request(update))
+            response.raise_for_status()
+
+    async def load_graph(self, graph_uri, source, content_type=NTRIPLES):
+        """\
+        Add the triples in source (bytes or a binary file, which is streamed)
+        to the named graph graph_uri via the Graph Store HTTP Protocol.
+        """
+        content = _aiter_file(source) if hasattr(source, "read") else source
+        name = "load-graph" if graph_uri else "load-quads"
+        with _logged(None, graph_uri, name=name), timed("sparql", name) as timing:
+            timing.bytes = _content_size(content)
+            response = await self.http.post(self.data_endpoint, content=content,
+                                            **_graph_store_request(graph_uri, content_type))
+            response.raise_for_status()
+
+    async def load_quads(self, source):
+        """\
+        Add the N-Quads in source to the dataset in a single request, so that
+        several named graphs are loaded in one transaction.
+        """
+        await self.load_graph(None, source, content_type=NQUADS)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+def _client_kwargs():
+    return {
+        "pool_size": settings.fuseki_pool_size,
+        "timeout": settings.fuseki_timeout,
+        "connect_timeout": settings.fuseki_connect_timeout,
+    }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_sparql_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SPARQLClient(settings.fuseki_base_url, settings.fuseki_dataset, **_client_kwargs())
+    return _client
+
+
+# async clients are bound to the event loop they were created in
+_async_client = None
+_async_client_loop = None
+
+
+def get_async_sparql_client():
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = AsyncSPARQLClient(settings.fuseki_base_url, settings.fuseki_dataset, **_client_kwargs())
+        _async_client_loop = loop
+    return _async_client
+
+
+def close_sparql_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+async def aclose_sparql_client():
+    global _async_client, _async_client_loop
+    if _async_client is not None and _async_client_loop is asyncio.get_running_loop():
+        await _async_client.aclose()
+    _async_client = _async_client_loop = None
+
+
+def crate_base_url():
+    return f"http://{settings.seaweedfs_filer}/buckets/{settings.seaweedfs_bucket}/"
+
+
+def resolve_graph_id(graph_id):
+    if not graph_id.startswith("http://"):
+        graph_id = f"{crate_base_url()}{graph_id}.zip"
+    return URIRef(graph_id)
 
 
 def run_query(query, graph_id=None):
-    store = SPARQLUpdateStore()
-    query_endpoint = f"{settings.fuseki_base_url}/{settings.fuseki_dataset}/sparql"
-    store.open(query_endpoint)
     if graph_id:
-        if not graph_id.startswith("http://"):
-            graph_id = f"http://{settings.seaweedfs_filer}/buckets/{settings.seaweedfs_bucket}/{graph_id}.zip"
-        graph_id = URIRef(graph_id)
-    qres = store.query(query, queryGraph=graph_id)
-    return qres
+        graph_id = resolve_graph_id(graph_id)
+    return get_sparql_client().query(query, default_graph=graph_id)
+
+
+def run_select(query, graph_id=None):
+    if graph_id:
+        graph_id = resolve_graph_id(graph_id)
+    return get_sparql_client().select(query, default_graph=graph_id)
+
+
+def run_update(update):
+    get_sparql_client().update(update)
+
+
+async def arun_query(query, graph_id=None):
+    if graph_id:
+        graph_id = resolve_graph_id(graph_id)
+    return await get_async_sparql_client().query(query, default_graph=graph_id)
+
+
+async def arun_select(query, graph_id=None):
+    if graph_id:
+        graph_id = resolve_graph_id(graph_id)
+    return await get_async_sparql_client().select(query, default_graph=graph_id)
+
+
+async def astream_query(query, accept, graph_id=None):
+    if graph_id:
+        graph_id = resolve_graph_id(graph_id)
+    return await get_async_sparql_client().stream(query, accept, default_graph=graph_id)
+
+
+async def arun_update(update):
+    await get_async_sparql_client().update(update)
+
+
+async def aload_quads(source):
+    await get_async_sparql_client().load_quads(source)
@@ -0,0 +1,95 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Sidecars: small JSON documents computed from a crate at ingest and stored
+next to it in the object store, under {prefix}/{crate name}.json, so that
+they can be served without reading the crate or querying the SPARQL store.
+"""
+
+import io
+import json
+import logging
+
+import httpx
+
+from provstor_api.utils.lookup import LookupCache
+from provstor_api.utils.storage import get_filer_client, get_object_store
+
+
+class Sidecar:
+    """\
+    One kind of sidecar, e.g., member indexes. Documents carry a "version"
+    field: those with a different version are ignored. Documents read or
+    saved are cached by crate URL; misses are not, so that rebuilt
+    documents are picked up.
+    """
+
+    def __init__(self, prefix, version, cache_size, description):
+        self.prefix = prefix
+        self.version = version
+        self.description = description
+        self.cache = LookupCache(cache_size)
+
+    def key(self, crate_name):
+        return f"{self.prefix}/{crate_name}.json"
+
+    def url(self, crate_url):
+        base, crate_name = crate_url.rsplit("/", 1)
+        return f"{base}/{self.key(crate_name)}"
+
+    def save(self, crate_name, crate_url, document):
+        """\
+        Store the document of crate_name in the object store. Blocking.
+        """
+        data = json.dumps(document, separators=(",", ":")).encode()
+        get_object_store().put(self.key(crate_name), io.BytesIO(data))
+        self.cache.put(crate_url, document)
+
+    def discard(self, crate_name, crate_url):
+        """\
+        Remove the document of crate_name, e.g., after failing to compute it:
+        one left over from a previous version of the crate is wrong. Errors
+        are logged. Blocking.
+        """
+        self.cache.pop(crate_url)
+        try:
+            get_object_store().delete(self.key(crate_name))
+        except Exception:
+            logging.exception("failed to remove the %s of %s", self.description, crate_name)
+
+    async def read(self, crate_url):
+        """\
+        Return the document of the crate at crate_url, or None if it has not
+        been stored (or cannot be read).
+        """
+        document = self.cache.get(crate_url)
+        if document is not None:
+            return document
+        try:
+            response = await get_filer_client().get(self.url(crate_url))
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+            document = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logging.warning("cannot read the %s of %s: %s", self.description, crate_url, e)
+            return None
+        if document.get("version") != self.version:
+            return None
+        self.cache.put(crate_url, document)
+        return document
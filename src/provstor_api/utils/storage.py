@@ -0,0 +1,408 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import io
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+from provstor_api.config import settings
+from provstor_api.utils.metrics import record, timed
+from provstor_api.utils.tracing import begin_span, end_span, inject
+
+
+# maximum size of a zip end of central directory record (with comment)
+ZIP_TAIL_SIZE = 65536 + 22
+# byte ranges and lengths must refer to the stored bytes
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+class S3ObjectStore:
+    """\
+    Crate storage on an S3-compatible service (SeaweedFS).
+
+    boto3 clients are thread-safe, so one instance is shared by all requests.
+    The bucket is created by the first upload and assumed to exist from then
+    on, until an upload fails.
+    """
+
+    def __init__(self, endpoint_url, access_key, secret_key, bucket, client=None):
+        self.bucket = bucket
+        self.client = client or boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+        self._bucket_exists = False
+        self._lock = threading.Lock()
+
+    def ensure_bucket(self):
+        if self._bucket_exists:
+            return
+        with self._lock:
+            if self._bucket_exists:
+                return
+            try:
+                self.client.create_bucket(Bucket=self.bucket)
+            except (self.client.exceptions.BucketAlreadyExists,
+                    self.client.exceptions.BucketAlreadyOwnedByYou):
+                pass
+            else:
+                logging.info('created bucket "%s"', self.bucket)
+            self._bucket_exists = True
+
+    def put(self, key, fileobj):
+        self.ensure_bucket()
+        # multipart upload: memory use is bounded by chunk size * concurrency
+        config = TransferConfig(
+            multipart_threshold=settings.s3_multipart_threshold,
+            multipart_chunksize=settings.s3_multipart_chunksize,
+            max_concurrency=settings.s3_max_concurrency,
+        )
+        try:
+            self.client.upload_fileobj(fileobj, self.bucket, key, Config=config)
+        except Exception:
+            # the bucket might have been removed: check again next time
+            self._bucket_exists = False
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def delete_many(self, keys):
+        self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+        )
+
+    def close(self):
+        self.client.close()
+
+
+class LocalObjectStore:
+    """\
+    Crate storage in a local directory, with one subdirectory per bucket.
+    Stands in for SeaweedFS in tests and benchmarks.
+    """
+
+    def __init__(self, root, bucket):
+        self.bucket = bucket
+        self.path = Path(root) / bucket
+
+    def ensure_bucket(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def put(self, key, fileobj):
+        dest = self.path / key
+        # keys may contain "/", like S3 ones
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.tmp")
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+        os.replace(tmp, dest)
+
+    def delete(self, key):
+        (self.path / key).unlink(missing_ok=True)
+
+    def delete_many(self, keys):
+        for k in keys:
+            self.delete(k)
+
+    def close(self):
+        pass
+
+
+_object_store = None
+_object_store_lock = threading.Lock()
+
+
+def get_object_store():
+    global _object_store
+    if _object_store is None:
+        with _object_store_lock:
+            if _object_store is None:
+                _object_store = S3ObjectStore(
+                    f"http://{settings.seaweedfs_store}",
+                    settings.seaweedfs_access_key,
+                    settings.seaweedfs_secret_key,
+                    settings.seaweedfs_bucket,
+                )
+    return _object_store
+
+
+def set_object_store(store):
+    global _object_store
+    with _object_store_lock:
+        _object_store = store
+
+
+def close_object_store():
+    global _object_store
+    with _object_store_lock:
+        if _object_store is not None:
+            _object_store.close()
+            _object_store = None
+
+
+def _put_crates(items):
+    """\
+    Upload (key, fileobj) items in parallel. Return the exception raised by
+    each upload, or None if it succeeded.
+    """
+    store = get_object_store()
+    store.ensure_bucket()
+    with ThreadPoolExecutor(max_workers=settings.s3_batch_concurrency) as executor:
+        futures = [executor.submit(store.put, key, fileobj) for key, fileobj in items]
+    return [f.exception() for f in futures]
+
+
+def _uploaded_size(fileobj):
+    # uploads read the file to the end
+    try:
+        return fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+# the object store is blocking: run its calls in the threadpool to keep the
+# event loop free
+async def put_crate(key, fileobj):
+    with timed("s3", "put") as timing:
+        await run_in_threadpool(get_object_store().put, key, fileobj)
+        timing.bytes = _uploaded_size(fileobj)
+
+
+async def put_crates(items):
+    with timed("s3", "put-many"):
+        return await run_in_threadpool(_put_crates, items)
+
+
+async def delete_crate(key):
+    with timed("s3", "delete"):
+        await run_in_threadpool(get_object_store().delete, key)
+
+
+async def delete_crates(keys):
+    with timed("s3", "delete-many"):
+        await run_in_threadpool(get_object_store().delete_many, keys)
+
+
+# filer requests are timed up to the response headers, the size is taken
+# from Content-Length, since bodies are often streamed
+def _filer_operation(request):
+    return "get-range" if "Range" in request.headers else request.method.lower()
+
+
+def _start_timing(request):
+    span = begin_span(f"filer {_filer_operation(request)}", {"kind": "filer", "url": str(request.url)})
+    inject(request.headers, span)
+    request.extensions["provstor_span"] = span
+    request.extensions["provstor_start"] = time.perf_counter()
+
+
+def _record_timing(response):
+    request = response.request
+    length = response.headers.get("Content-Length", "")
+    nbytes = int(length) if length.isdigit() else None
+    record("filer", _filer_operation(request), time.perf_counter() - request.extensions["provstor_start"], nbytes)
+    span = request.extensions["provstor_span"]
+    if span is not None:
+        span.attributes.update(status=response.status_code, bytes=nbytes)
+        end_span(span)
+
+
+async def _astart_timing(request):
+    _start_timing(request)
+
+
+async def _arecord_timing(response):
+    _record_timing(response)
+
+
+# async clients are bound to the event loop they were created in
+_filer_client = None
+_filer_client_loop = None
+
+
+def get_filer_client():
+    global _filer_client, _filer_client_loop
+    loop = asyncio.get_running_loop()
+    if _filer_client is None or _filer_client_loop is not loop:
+        _filer_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.seaweedfs_timeout),
+            event_hooks={"request": [_astart_timing], "response": [_arecord_timing]},
+        )
+        _filer_client_loop = loop
+    return _filer_client
+
+
+async def aclose_filer_client():
+    global _filer_client, _filer_client_loop
+    if _filer_client is not None and _filer_client_loop is asyncio.get_running_loop():
+        await _filer_client.aclose()
+    _filer_client = _filer_client_loop = None
+
+
+async def stream_crate(crate_url, byte_range=None, request_headers=None):
+    """\
+    Start downloading the crate at crate_url from the SeaweedFS filer, or
+    only the (first, last) byte_range of it, inclusive. request_headers
+    (e.g., a client's Range and If-Range) are sent along with the request.
+
+    Return the response status code, the response headers and an async
+    iterator over the body chunks. The connection is released when the
+    iterator is exhausted or closed.
+    """
+    http = get_filer_client()
+    headers = {**IDENTITY, **(request_headers or {})}
+    if byte_range:
+        headers["Range"] = "bytes=%d-%d" % byte_range
+    response = await http.send(http.build_request("GET", crate_url, headers=headers), stream=True)
+    try:
+        response.raise_for_status()
+        if byte_range and response.status_code != 206:
+            raise ValueError(f"range request not honored for {crate_url}")
+    except (httpx.HTTPStatusError, ValueError):
+        await response.aclose()
+        raise
+
+    async def chunks():
+        try:
+            async for chunk in response.aiter_bytes():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    return response.status_code, response.headers, chunks()
+
+
+_filer_sync_client = None
+_filer_sync_client_lock = threading.Lock()
+
+
+def get_filer_sync_client():
+    global _filer_sync_client
+    if _filer_sync_client is None:
+        with _filer_sync_client_lock:
+            if _filer_sync_client is None:
+                _filer_sync_client = httpx.Client(
+                    timeout=httpx.Timeout(settings.seaweedfs_timeout),
+                    event_hooks={"request": [_start_timing], "response": [_record_timing]},
+                )
+    return _filer_sync_client
+
+
+def close_filer_sync_client():
+    global _filer_sync_client
+    with _filer_sync_client_lock:
+        if _filer_sync_client is not None:
+            _filer_sync_client.close()
+            _filer_sync_client = None
+
+
+class RangeReader(io.RawIOBase):
+    """\
+    Seekable, read-only view of a remote file that fetches the bytes being
+    read with HTTP Range requests.
+
+    The first request fetches the file size and its last tail_size bytes,
+    which are kept in memory: that is where a zip archive keeps its end of
+    central directory record (and, for small archives, the whole central
+    directory). If the server does not support ranges, the whole file ends
+    up in the tail.
+    """
+
+    def __init__(self, http, url, tail_size=ZIP_TAIL_SIZE):
+        self.http = http
+        self.url = url
+        self.pos = 0
+        response = self._get(f"bytes=-{tail_size}")
+        if response.status_code == 416:
+            # empty file
+            self.size = int(response.headers.get("Content-Range", "*/0").rsplit("/", 1)[-1])
+            self.tail = b""
+        elif response.status_code == 206:
+            self.size = int(response.headers["Content-Range"].rsplit("/", 1)[-1])
+            self.tail = response.content
+        else:
+            self.tail = response.content
+            self.size = len(self.tail)
+        self.tail_start = self.size - len(self.tail)
+
+    def _get(self, byte_range):
+        response = self.http.get(self.url, headers={**IDENTITY, "Range": byte_range})
+        if response.status_code != 416:
+            response.raise_for_status()
+        return response
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"negative seek position: {pos}")
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        if self.pos >= self.tail_start:
+            start = self.pos - self.tail_start
+            data = self.tail[start:start + n]
+        else:
+            end = min(self.pos + n, self.tail_start)
+            data = self._get(f"bytes={self.pos}-{end - 1}").content[:n]
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+def open_crate(crate_url):
+    """\
+    Open the crate at crate_url as a seekable binary file that downloads only
+    the parts being read. Blocking: call it (and read from the file) in the
+    threadpool.
+    """
+    reader = RangeReader(get_filer_sync_client(), crate_url)
+    return io.BufferedReader(reader, buffer_size=settings.seaweedfs_read_buffer_size)
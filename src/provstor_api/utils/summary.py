@@ -0,0 +1,105 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Run summary of crates.
+
+At ingest, what the UI shows about a workflow run (workflow, inputs,
+outputs, parameters, start and end times, number of actions) is computed
+from the crate's metadata and stored next to the crate in the object
+store, as a sidecar under .summary/{crate name}.json, so that it can be
+served without querying the SPARQL store.
+"""
+
+import logging
+
+from provstor_api.config import settings
+from provstor_api.utils.query import run_query
+from provstor_api.utils.queries import (
+    ACTION_COUNT_QUERY, RUN_TIMES_QUERY, WFRUN_OBJECTS_QUERY, WFRUN_PARAMS_QUERY,
+    WFRUN_RESULTS_QUERY, WORKFLOW_QUERY
+)
+from provstor_api.utils.sidecar import Sidecar
+
+SUMMARY_VERSION = 1
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def build_run_summary(run):
+    """\
+    Compute the run summary of a crate by running queries with run, which
+    can be either the query method of the crate's local rdflib graph or a
+    function that runs them on the crate's graph in the store.
+    """
+    times = list(run(RUN_TIMES_QUERY))
+    start_time, end_time = (_str(times[0].start_time), _str(times[0].end_time)) if times else (None, None)
+    counts = list(run(ACTION_COUNT_QUERY))
+    return {
+        "version": SUMMARY_VERSION,
+        "workflow": [str(_[0]) for _ in run(WORKFLOW_QUERY)],
+        "results": [str(_[0]) for _ in run(WFRUN_RESULTS_QUERY)],
+        "objects": [str(_[0]) for _ in run(WFRUN_OBJECTS_QUERY)],
+        "params": [(str(_.name), str(_.value)) for _ in run(WFRUN_PARAMS_QUERY)],
+        "start_time": start_time,
+        "end_time": end_time,
+        "actions": int(counts[0].actions) if counts else 0,
+    }
+
+
+run_summaries = Sidecar(".summary", SUMMARY_VERSION, settings.run_summary_cache_size, "run summary")
+
+
+def summarize_crate(crate_name, crate_url, local_graph):
+    """\
+    Build and store the run summary of a crate from its metadata graph,
+    logging (rather than raising) any error: crates without a summary are
+    served from the SPARQL store. Blocking.
+    """
+    try:
+        run_summaries.save(crate_name, crate_url, build_run_summary(local_graph.query))
+    except Exception:
+        logging.exception("failed to summarize %s", crate_name)
+        run_summaries.discard(crate_name, crate_url)
+
+
+async def read_run_summary(crate_url):
+    """\
+    Return the run summary of the crate at crate_url, or None if it has not
+    been stored (or cannot be read).
+    """
+    return await run_summaries.read(crate_url)
+
+
+def rebuild_run_summary(crate_urls):
+    """\
+    (Re)build the run summary of the given crates from their graphs in the
+    store. Return the URLs of the crates that could not be summarized.
+    Blocking.
+    """
+    failed = []
+    for crate_url in crate_urls:
+        crate_name = crate_url.rsplit("/", 1)[-1]
+        try:
+            summary = build_run_summary(lambda q: run_query(q, graph_id=crate_url))
+            run_summaries.save(crate_name, crate_url, summary)
+        except Exception:
+            logging.exception("failed to summarize %s", crate_url)
+            failed.append(crate_url)
+    return failed
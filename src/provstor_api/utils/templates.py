@@ -0,0 +1,101 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+SPARQL query templates.
+
+Values are bound to the placeholders of a template as SPARQL terms, never
+as raw text: ``$iri{name}`` takes an IRI, ``$iris{name}`` any number of
+IRIs (e.g., the ids in a VALUES block) and ``$literal{name}`` a string. A
+template is parsed once, when it is defined, so binding only has to join
+strings. Queries carry the name of their template and the values bound
+to it, for logs and metrics.
+"""
+
+import re
+
+
+PLACEHOLDER = re.compile(r"\$(iri|iris|literal)\{(\w+)\}")
+# characters that cannot appear in a SPARQL IRIREF
+IRI_FORBIDDEN = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+STRING_ESCAPES = str.maketrans({"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+
+
+class InvalidTermError(ValueError):
+    pass
+
+
+def iri(value):
+    value = str(value)
+    if not value or IRI_FORBIDDEN.search(value):
+        raise InvalidTermError(f"Invalid IRI: {value!r}")
+    return f"<{value}>"
+
+
+def iris(values):
+    return " ".join(iri(_) for _ in values)
+
+
+def literal(value):
+    return '"' + str(value).translate(STRING_ESCAPES) + '"'
+
+
+TERMS = {"iri": iri, "iris": iris, "literal": literal}
+
+
+class Query(str):
+    """\
+    The text of a SPARQL query, named after the query (or template) it
+    comes from. params holds the values bound to the template, if any.
+    """
+
+    def __new__(cls, name, text, params=None):
+        query = super().__new__(cls, text)
+        query.name = name
+        query.params = params
+        return query
+
+
+class QueryTemplate:
+    """\
+    A named SPARQL query with placeholders, filled in by bind.
+    """
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        # text chunks alternate with (term function, parameter name) pairs
+        parts = PLACEHOLDER.split(text)
+        self._chunks = parts[::3]
+        self._slots = [(TERMS[kind], param) for kind, param in zip(parts[1::3], parts[2::3])]
+        self.params = frozenset(param for _, param in self._slots)
+
+    def bind(self, **values):
+        """\
+        Return the query with the given values in place of the placeholders.
+        Raise InvalidTermError if a value cannot be written as its term.
+        """
+        if values.keys() != self.params:
+            raise TypeError(f"{self.name} takes parameters {sorted(self.params)}, got {sorted(values)}")
+        out = [self._chunks[0]]
+        for (term, param), chunk in zip(self._slots, self._chunks[1:]):
+            out.append(term(values[param]))
+            out.append(chunk)
+        return Query(self.name, "".join(out), values)
+
+    def __repr__(self):
+        return f"QueryTemplate({self.name!r})"
@@ -0,0 +1,229 @@
+# Copyright © 2024-2026 CRS4
+# Copyright © 2025-2026 BSC
+#
+# This file is part of ProvStor.
+#
+# ProvStor is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# ProvStor is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
+
+"""\
+Request tracing.
+
+Spans follow the OpenTelemetry model: each has a trace id shared by all the
+spans of a request, its own span id and the id of its parent. The request's
+span is started by TracingMiddleware (as a child of the caller's span, if
+the request has a W3C traceparent header), and every timed operation (see
+metrics.timed) and filer request is a child span, so that the store, filer
+and S3 calls made to serve a request can be told apart. The traceparent
+header is passed on to Fuseki and the filer.
+
+Finished spans are handed to the exporter. The default one discards them,
+and then no spans are created at all; set TRACING_EXPORTER=log to write
+them, as JSON, to the "provstor_api.tracing" logger.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import re
+import secrets
+import time
+
+
+TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}")
+
+# a span of another process, e.g., the caller's
+RemoteSpan = namedtuple("RemoteSpan", ["trace_id", "span_id"])
+
+
+class Span:
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "end": self.end,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class NoopExporter:
+
+    enabled = False
+
+    def export(self, span):
+        pass
+
+
+class LogExporter:
+
+    enabled = True
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("provstor_api.tracing")
+
+    def export(self, span):
+        self.logger.info(json.dumps(span.to_dict(), default=str))
+
+
+EXPORTERS = {"": NoopExporter, "none": NoopExporter, "log": LogExporter}
+
+_exporter = NoopExporter()
+_current_span = ContextVar("current_span", default=None)
+
+
+def get_exporter():
+    return _exporter
+
+
+def set_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def exporter_from_name(name):
+    try:
+        return EXPORTERS[name.lower()]()
+    except KeyError:
+        raise ValueError(f"Unknown tracing exporter: {name!r} (expected one of {sorted(EXPORTERS)})")
+
+
+def current_span():
+    return _current_span.get()
+
+
+def begin_span(name, attributes=None, parent=None):
+    """\
+    Start a span, as a child of parent (by default, the current span), and
+    return it. Return None if tracing is disabled. The span does not become
+    the current one: use start_span for that.
+    """
+    if not _exporter.enabled:
+        return None
+    parent = parent or _current_span.get()
+    if parent is None:
+        return Span(name, secrets.token_hex(16), attributes=attributes)
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def end_span(span, error=None):
+    if span is None:
+        return
+    span.end = time.time_ns()
+    if error is not None:
+        span.error = repr(error)
+    _exporter.export(span)
+
+
+@contextmanager
+def start_span(name, attributes=None):
+    span = begin_span(name, attributes)
+    if span is None:
+        yield None
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        end_span(span, e)
+        raise
+    else:
+        end_span(span)
+    finally:
+        _current_span.reset(token)
+
+
+def inject(headers, span=None):
+    """\
+    Add the traceparent header of span (by default, the current span) to the
+    headers of an outgoing request.
+    """
+    span = span or _current_span.get()
+    if span is not None:
+        headers["traceparent"] = span.traceparent
+
+
+def _propagate(request):
+    inject(request.headers)
+
+
+async def _apropagate(request):
+    inject(request.headers)
+
+
+# event hooks for httpx clients
+PROPAGATE_HOOKS = {"request": [_propagate]}
+APROPAGATE_HOOKS = {"request": [_apropagate]}
+
+
+class TracingMiddleware:
+    """\
+    Run each request in a span, named after its route once it is known.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _exporter.enabled:
+            await self.app(scope, receive, send)
+            return
+        parent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                m = TRACEPARENT.fullmatch(value.decode("latin-1").strip())
+                if m:
+                    parent = RemoteSpan(*m.groups())
+                break
+        span = begin_span(scope["method"], {"http.method": scope["method"], "http.target": scope["path"]}, parent)
+        token = _current_span.set(span)
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                span.attributes["http.status_code"] = message["status"]
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive, send_with_status)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                span.name = f"{scope['method']} {route.path}"
+                span.attributes["http.route"] = route.path
+            end_span(span, error)
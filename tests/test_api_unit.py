@@ -15,20 +15,46 @@
 # You should have received a copy of the GNU General Public License
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import io
+import json
+import re
+import time
 import zipfile
+import zlib
+import httpx
 import pytest
-from rdflib import URIRef
+from rdflib import Dataset, Graph, RDF, URIRef
 from types import SimpleNamespace
 
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 from provstor_api.main import app
-from provstor_api.utils.queries import IS_FILE_OR_DIR_QUERY
+from provstor_api.utils.catalog import CATALOG_GRAPH, catalog_graph
+from provstor_api.utils.jobs import IngestQueue
+from provstor_api.utils.lineage import LineageDelta, LineageIndex
+from provstor_api.utils.queries import (
+    ACTIONS_FOR_RESULT_QUERY, CATALOG_BACKFILL_UPDATE, GRAPH_ID_FOR_RESULT_QUERY, GRAPHS_QUERY,
+    IS_FILE_OR_DIR_QUERY
+)
+from provstor_api.utils.query import AsyncSPARQLClient, SPARQLClient
+from provstor_api.utils.templates import InvalidTermError, QueryTemplate
 import provstor_api.routes.upload as upload
 import provstor_api.routes.query as query
 import provstor_api.routes.backtrack as backtrack
 import provstor_api.routes.get as get
 import provstor_api.routes.pathops as pathops
+import provstor_api.routes.admin as admin
+import provstor_api.utils.catalog as catalog
+import provstor_api.utils.get_utils as get_utils
+import provstor_api.utils.lookup as lookup
+import provstor_api.utils.members as members
+import provstor_api.utils.metrics as metrics
+import provstor_api.utils.sidecar as sidecar
+import provstor_api.utils.storage as storage
+import provstor_api.utils.summary as summary
+import provstor_api.utils.tracing as tracing
+import provstor_api.utils.cache as crate_cache_mod
 
 
 # Test Constants
@@ -110,6 +136,18 @@ TC = TestConstants
 client = TestClient(app)
 
 
+def as_async(fn):
+    """Wrap a plain function into a coroutine function."""
+    async def wrapper(*args, **kwargs):
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+async def aiter_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
 def make_zip(with_metadata=True, metadata_name=TC.METADATA_JSON):
     """Return a BytesIO containing a zip file."""
     buf = io.BytesIO()
@@ -131,29 +169,48 @@ def make_zip_bytes(files: dict[str, bytes]) -> bytes:
     return buf.getvalue()
 
 
-@pytest.fixture
-def mock_client(monkeypatch):
-    class MockClient:
-        def __init__(self, *args, **kw):
-            pass
+def select_rows(graph, query):
+    # query results as returned by run_select
+    return [tuple(None if _ is None else str(_) for _ in row) for row in graph.query(query)]
 
-        def create_bucket(self, **kw):
-            pass
 
-        def put_object(self, **kw):
-            pass
+@pytest.fixture(autouse=True)
+def crate_cache(monkeypatch, tmp_path):
+    # a fresh cache per test, so that responses are not served from earlier tests
+    cache = crate_cache_mod.CrateCache(tmp_path / "crate-cache", 1024 * 1024, 64 * 1024)
+    monkeypatch.setattr(crate_cache_mod, "_crate_cache", cache)
+    return cache
+
 
-    class MockStore:
-        def open(self, endpoints):
-            self.endpoints = endpoints
+@pytest.fixture(autouse=True)
+def clear_lookups(monkeypatch):
+    lookup.crate_urls.clear()
+    lookup.query_cache.clear()
+    summary.run_summaries.cache.clear()
+    # no run summaries unless a test provides them
+    monkeypatch.setattr(get, "read_run_summary", as_async(lambda url: None))
+    yield
+    lookup.crate_urls.clear()
+    lookup.query_cache.clear()
+    summary.run_summaries.cache.clear()
 
+
+@pytest.fixture
+def object_store(monkeypatch, tmp_path):
+    store = storage.LocalObjectStore(tmp_path, TC.SEAWEEDFS_BUCKET)
+    monkeypatch.setattr(storage, "_object_store", store)
+    return store
+
+
+@pytest.fixture
+def mock_client(monkeypatch, object_store):
     class MockGraph:
         def __init__(self, store=None, identifier=None):
             self.store = store
             self.identifier = identifier
 
-        def parse(self, path, publicID=None):
-            self.parsed = (path, publicID)
+        def parse(self, source, format=None, publicID=None):
+            self.parsed = (source.read(), format, publicID)
 
         def query(self, _):
             return [(URIRef(TC.EXAMPLE_RDE_URI),)]
@@ -161,16 +218,20 @@ def mock_client(monkeypatch):
         def add(self, triple):
             self.added = triple
 
-        def serialize(self, format="nt"):
-            return "Lorem Ipsum"
+        def subjects(self, predicate=None, object=None):
+            return [self.added[0]]
 
-        def update(self, insert_query):
-            self.insert_query = insert_query
+        def serialize(self, destination=None, format="nt", encoding=None):
+            if destination is None:
+                return b"Lorem Ipsum"
+            destination.write(b"Lorem Ipsum")
 
-    monkeypatch.setattr(upload.boto3, "client", MockClient)
-    monkeypatch.setattr(upload, "SPARQLUpdateStore", MockStore)
     monkeypatch.setattr(upload, "Graph", MockGraph)
-    monkeypatch.setattr(upload, "run_query", lambda q: [])
+    monkeypatch.setattr(upload, "arun_select", as_async(lambda q: []))
+    monkeypatch.setattr(upload, "arun_update", as_async(lambda q: None))
+    monkeypatch.setattr(upload, "aload_quads", as_async(lambda f: None))
+    monkeypatch.setattr(upload, "catalog_graph", lambda *graphs: Graph())
+    monkeypatch.setattr(upload, "summarize_crate", lambda name, url, graph: None)
     monkeypatch.setattr(upload.arcp, "arcp_location", lambda url: TC.ARCP_LOCATION)
 
     upload.settings.seaweedfs_store = TC.SEAWEEDFS_STORE
@@ -202,6 +263,17 @@ def test_rejects_empty_file(mock_client):
     assert r.json()["detail"] == "Empty file uploaded."
 
 
+def test_rejects_invalid_crate_name(mock_client):
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": ("a> { <x> <y> <z> } } ; DROP ALL ; #.zip", buf.getvalue(),
+                                               TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 400
+    assert r.json()["detail"].startswith("Invalid crate name")
+    with pytest.raises(InvalidTermError):
+        asyncio.run(upload.store_graphs({"http://x/a>.zip": Graph()}))
+
+
 def test_rejects_missing_metadata(mock_client):
     buf = make_zip(with_metadata=False)
     r = mock_client.post("/upload/crate/",
@@ -222,61 +294,598 @@ def test_correct_path(mock_client):
 
 def test_upload_existing_result(mock_client, monkeypatch):
     buf = make_zip(with_metadata=True)
-    monkeypatch.setattr(upload, "run_query", lambda q: [(URIRef(TC.EXAMPLE_RDE_URI),)])
+    monkeypatch.setattr(upload, "arun_select", as_async(lambda q: [(TC.EXAMPLE_RDE_URI,)]))
     r = mock_client.post("/upload/crate/",
                          files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
     assert r.status_code == 422
     assert r.json()["detail"] == f"these results already exist: {{'{TC.EXAMPLE_RDE_URI}'}}"
 
 
-# Tests for list-graphs
-def test_list_graphs_ok(monkeypatch):
+def test_upload_checks_only_new_results(mock_client, monkeypatch):
+    queries = []
 
-    def mock_run_query(q):
-        return [(TC.EXAMPLE_GRAPH_URI_1,), (TC.EXAMPLE_GRAPH_URI_2,)]
+    async def mock_arun_query(q):
+        queries.append(q)
+        return []
 
-    monkeypatch.setattr(query, "run_query", mock_run_query)
+    monkeypatch.setattr(upload, "arun_select", mock_arun_query)
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 200
+    assert len(queries) == 1
+    assert f"VALUES ?f {{ <{TC.EXAMPLE_RDE_URI}> }}" in queries[0]
 
-    r = client.get("/query/list-graphs/")
+
+def test_upload_loads_graph_store(mock_client, monkeypatch):
+    loaded = []
+    catalog = Graph()
+    catalog.add((URIRef(TC.EXAMPLE_RDE_URI), URIRef(TC.EXAMPLE_URI), URIRef(TC.FILE_URI_A)))
+
+    async def mock_aload_quads(nq_file):
+        loaded.append(nq_file.read())
+
+    monkeypatch.setattr(upload, "aload_quads", mock_aload_quads)
+    monkeypatch.setattr(upload, "catalog_graph", lambda *graphs: catalog)
+    monkeypatch.setattr(upload, "arun_update", None)
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
     assert r.status_code == 200
-    assert r.json() == {"result": [TC.EXAMPLE_GRAPH_URI_1, TC.EXAMPLE_GRAPH_URI_2]}
+    # the crate's graph and its catalog entries are loaded together
+    assert loaded == [
+        f"Lorem Ipsum <{r.json()['crate_url']}> .\n"
+        f"<{TC.EXAMPLE_RDE_URI}> <{TC.EXAMPLE_URI}> <{TC.FILE_URI_A}> <{CATALOG_GRAPH}> .\n".encode()
+    ]
 
 
-def test_list_graphs_empty(monkeypatch):
-    monkeypatch.setattr(query, "run_query", lambda q: [])
+def test_upload_insert_data(mock_client, monkeypatch):
+    updates = []
+    monkeypatch.setattr(upload.settings, "fuseki_graph_store", False)
+    monkeypatch.setattr(upload, "aload_quads", None)
+    monkeypatch.setattr(upload, "arun_update", as_async(updates.append))
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 200
+    assert len(updates) == 1
+    assert f"GRAPH <{r.json()['crate_url']}>" in updates[0]
+    assert f"GRAPH <{CATALOG_GRAPH}>" in updates[0]
+    assert "Lorem Ipsum" in updates[0]
 
-    r = client.get("/query/list-graphs/")
+
+def test_upload_graph_store_error(mock_client, monkeypatch):
+    deleted = []
+
+    async def mock_aload_quads(nq_file):
+        raise httpx.HTTPStatusError("Bad Request", request=None, response=None)
+
+    monkeypatch.setattr(upload, "aload_quads", mock_aload_quads)
+    monkeypatch.setattr(upload, "delete_crate", as_async(deleted.append))
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 500
+    assert r.json()["detail"].startswith("Failed to upload metadata to the store")
+    assert deleted == [TC.CRATE_ZIP]
+
+
+def test_upload_async_mode(mock_client, monkeypatch):
+    monkeypatch.setattr(upload.settings, "lineage_index", False)
+    buf = make_zip(with_metadata=True)
+    with TestClient(app) as c:
+        r = c.post("/upload/crate/", params={"async_mode": True},
+                   files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+        assert r.status_code == 202
+        job_id = r.json()["job_id"]
+        for _ in range(100):
+            job = c.get(f"/upload/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.05)
+    assert job["status"] == "done"
+    assert job["filename"] == TC.CRATE_ZIP
+    assert job["crate_url"].endswith(f"/{TC.CRATE_ZIP}")
+
+
+def test_upload_job_not_found():
+    r = client.get("/upload/jobs/foobar")
+    assert r.status_code == 404
+
+
+def test_upload_crates(mock_client, monkeypatch):
+    queries, loaded, uploaded = [], [], []
+
+    def mock_prepare_crate(filename, crate_file):
+        results = {"a.zip": {TC.FILE_URI_A}, "b.zip": {TC.FILE_URI_B}, "c.zip": {TC.FILE_URI_A}, "d.zip": set()}
+        return f"http://x/{filename}", Graph(), results[filename]
+
+    async def mock_arun_query(q):
+        queries.append(q)
+        return [(TC.FILE_URI_B,)]
+
+    async def mock_put_crates(items):
+        uploaded.extend((key, f.read()) for key, f in items)
+        return [None] * len(items)
+
+    async def mock_aload_quads(nq_file):
+        loaded.append(nq_file.read())
+
+    monkeypatch.setattr(upload, "_prepare_crate", mock_prepare_crate)
+    monkeypatch.setattr(upload, "arun_select", mock_arun_query)
+    monkeypatch.setattr(upload, "put_crates", mock_put_crates)
+    monkeypatch.setattr(upload, "aload_quads", mock_aload_quads)
+    files = [("crate_paths", (name, name.encode(), TC.CONTENT_TYPE_ZIP)) for name in ("a.zip", "b.zip", "c.zip")]
+    files.append(("crate_paths", ("e.txt", b"e", TC.CONTENT_TYPE_PLAIN)))
+    files.append(("crate_paths", ("d.zip", b"d", TC.CONTENT_TYPE_ZIP)))
+    files.append(("crate_paths", ("d.zip", b"d", TC.CONTENT_TYPE_ZIP)))
+    r = mock_client.post("/upload/crates/", files=files)
     assert r.status_code == 200
-    assert r.json() == {"result": []}
+    res = r.json()
+    assert res["result"] == "error"
+    assert [c["filename"] for c in res["crates"]] == ["a.zip", "b.zip", "c.zip", "e.txt", "d.zip", "d.zip"]
+    assert [c["result"] for c in res["crates"]] == ["success", "error", "error", "error", "success", "error"]
+    assert res["crates"][0]["crate_url"] == "http://x/a.zip"
+    assert [c.get("status_code") for c in res["crates"]] == [None, 422, 422, 415, None, 422]
+    assert len(queries) == 1
+    assert uploaded == [("a.zip", b"a.zip"), ("d.zip", b"d")]
+    assert len(loaded) == 1
+
+
+def test_upload_crates_store_error(mock_client, monkeypatch):
+    deleted = []
+
+    async def mock_aload_quads(nq_file):
+        raise httpx.HTTPStatusError("Bad Request", request=None, response=None)
+
+    monkeypatch.setattr(upload, "_prepare_crate", lambda f, c: (f"http://x/{f}", Graph(), set()))
+    monkeypatch.setattr(upload, "put_crates", as_async(lambda items: [None] * len(items)))
+    monkeypatch.setattr(upload, "aload_quads", mock_aload_quads)
+    monkeypatch.setattr(upload, "delete_crates", as_async(deleted.extend))
+    files = [("crate_paths", (name, b"x", TC.CONTENT_TYPE_ZIP)) for name in ("a.zip", "b.zip")]
+    r = mock_client.post("/upload/crates/", files=files)
+    assert r.status_code == 200
+    assert [c["status_code"] for c in r.json()["crates"]] == [500, 500]
+    assert deleted == ["a.zip", "b.zip"]
 
 
-# Tests for list-rde-graphs
-def test_list_rde_graphs_ok(monkeypatch):
+def test_upload_crates_invalid(mock_client, monkeypatch):
+    # real metadata parsing, errors must be reported per crate
+    monkeypatch.setattr(upload, "Graph", Graph)
+
+    def metadata(*rdes):
+        return json.dumps({"@context": {"@vocab": "http://schema.org/"}, "@graph": [
+            {"@id": "ro-crate-metadata.json", "@type": "CreativeWork", "about": [{"@id": _} for _ in rdes]},
+            *({"@id": _, "@type": "Dataset"} for _ in rdes),
+        ]}).encode()
+
+    crates = {
+        "good.zip": make_zip_bytes({TC.METADATA_JSON: metadata("./")}),
+        "text.zip": b"not a zip file",
+        "bad-json.zip": make_zip_bytes({TC.METADATA_JSON: b"{not json"}),
+        "two-rdes.zip": make_zip_bytes({TC.METADATA_JSON: metadata("./", "other/")}),
+    }
+    files = [("crate_paths", (name, data, TC.CONTENT_TYPE_ZIP)) for name, data in crates.items()]
+    r = mock_client.post("/upload/crates/", files=files)
+    assert r.status_code == 200
+    outcomes = r.json()["crates"]
+    assert [c["result"] for c in outcomes] == ["success", "error", "error", "error"]
+    assert [c.get("status_code") for c in outcomes] == [None, 400, 400, 400]
+    assert outcomes[1]["detail"] == "Not a valid zip file."
+    assert outcomes[2]["detail"].startswith("Invalid crate metadata")
+    assert outcomes[3]["detail"] == "Expected one root data entity, found 2"
+
+
+def test_upload_crates_invalid_result(mock_client, monkeypatch):
+    # the JSON-LD parser drops most malformed IRIs, build the graphs directly
+    def metadata(result):
+        g = Graph().parse(format="turtle", publicID=TC.ARCP_LOCATION, data=f"""\
+@prefix schema: <http://schema.org/> .
+<{TC.METADATA_JSON}> a schema:CreativeWork ; schema:about <./> .
+<./> a schema:Dataset .
+<#run> a schema:CreateAction .
+""")
+        g.add((URIRef(TC.ARCP_LOCATION + "#run"), URIRef("http://schema.org/result"), URIRef(result)))
+        g.add((URIRef(result), RDF.type, URIRef("http://schema.org/MediaObject")))
+        return g
+
+    graphs = {b"good": metadata(TC.FILE_URI_A), b"bad": metadata("file:/a/b c.txt")}
+    monkeypatch.setattr(upload, "_parse_metadata", lambda crate_file, loc: graphs[crate_file.read()])
+    lookups = []
+    monkeypatch.setattr(upload, "arun_select", as_async(lambda q: lookups.append(q.params) or []))
+    files = [("crate_paths", (f"{_}.zip", _, TC.CONTENT_TYPE_ZIP)) for _ in (b"bad", b"good")]
+    r = mock_client.post("/upload/crates/", files=files)
+    assert r.status_code == 200
+    outcomes = r.json()["crates"]
+    assert [c["result"] for c in outcomes] == ["error", "success"]
+    assert outcomes[0]["status_code"] == 400
+    assert outcomes[0]["detail"] == "Invalid result id: 'file:/a/b c.txt'"
+    assert lookups == [{"ids": [TC.FILE_URI_A]}]
+
+
+def test_store_graphs(monkeypatch):
+    loaded, updates = [], []
+    g1, g2 = Graph(), Graph()
+    g1.add((URIRef(TC.EXAMPLE_RDE_URI), URIRef(TC.EXAMPLE_URI), URIRef(TC.FILE_URI_A)))
+    g2.add((URIRef(TC.EXAMPLE_RDE_URI), URIRef(TC.EXAMPLE_URI), URIRef(TC.FILE_URI_B)))
+    graphs = {TC.EXAMPLE_GRAPH_URI_1: g1, TC.EXAMPLE_GRAPH_URI_2: g2}
+    monkeypatch.setattr(upload, "aload_quads", as_async(lambda f: loaded.append(f.read().decode())))
+    monkeypatch.setattr(upload, "arun_update", as_async(updates.append))
+    asyncio.run(upload.store_graphs(graphs))
+    assert loaded == [
+        f"<{TC.EXAMPLE_RDE_URI}> <{TC.EXAMPLE_URI}> <{TC.FILE_URI_A}> <{TC.EXAMPLE_GRAPH_URI_1}> .\n"
+        f"<{TC.EXAMPLE_RDE_URI}> <{TC.EXAMPLE_URI}> <{TC.FILE_URI_B}> <{TC.EXAMPLE_GRAPH_URI_2}> .\n"
+    ]
+    monkeypatch.setattr(upload.settings, "fuseki_graph_store", False)
+    asyncio.run(upload.store_graphs(graphs))
+    assert len(updates) == 1
+    assert f"GRAPH <{TC.EXAMPLE_GRAPH_URI_1}> {{\n<{TC.EXAMPLE_RDE_URI}>" in updates[0]
+    assert f"GRAPH <{TC.EXAMPLE_GRAPH_URI_2}> {{\n<{TC.EXAMPLE_RDE_URI}>" in updates[0]
+
+
+class MockS3Client:
+    exceptions = SimpleNamespace(BucketAlreadyExists=KeyError, BucketAlreadyOwnedByYou=KeyError)
+
+    def __init__(self):
+        self.buckets, self.keys = [], []
+
+    def create_bucket(self, Bucket):
+        self.buckets.append(Bucket)
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        if key == "bad.zip":
+            raise RuntimeError("upload failed")
+        self.keys.append(key)
+
+
+def test_put_crates(monkeypatch):
+    s3_client = MockS3Client()
+    store = storage.S3ObjectStore(None, None, None, TC.SEAWEEDFS_BUCKET, client=s3_client)
+    monkeypatch.setattr(storage, "_object_store", store)
+    items = [(name, io.BytesIO(b"x")) for name in ("a.zip", "bad.zip", "b.zip")]
+    errors = asyncio.run(storage.put_crates(items))
+    assert [str(e) if e else None for e in errors] == [None, "upload failed", None]
+    assert set(s3_client.buckets) == {TC.SEAWEEDFS_BUCKET}
+    assert sorted(s3_client.keys) == ["a.zip", "b.zip"]
+
+
+def test_s3_object_store_creates_bucket_once():
+    s3_client = MockS3Client()
+    store = storage.S3ObjectStore(None, None, None, TC.SEAWEEDFS_BUCKET, client=s3_client)
+    for name in "abc":
+        store.put(f"{name}.zip", io.BytesIO(b"x"))
+    assert s3_client.buckets == [TC.SEAWEEDFS_BUCKET]
+    # a failed upload makes the store check the bucket again
+    with pytest.raises(RuntimeError):
+        store.put("bad.zip", io.BytesIO(b"x"))
+    store.put("d.zip", io.BytesIO(b"x"))
+    assert s3_client.buckets == [TC.SEAWEEDFS_BUCKET] * 2
+    assert s3_client.keys == ["a.zip", "b.zip", "c.zip", "d.zip"]
+
+
+def test_upload_uses_object_store(mock_client, object_store):
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 200
+    assert (object_store.path / TC.CRATE_ZIP).read_bytes() == buf.getvalue()
+    index = json.loads((object_store.path / ".index" / f"{TC.CRATE_ZIP}.json").read_bytes())
+    assert list(index["members"]) == [f"crate/{TC.METADATA_JSON}"]
+    asyncio.run(storage.delete_crates([TC.CRATE_ZIP]))
+    assert not (object_store.path / TC.CRATE_ZIP).exists()
+
+
+def test_ingest_queue():
+    running = []
+    max_running = []
+
+    async def ingest(filename, crate_file):
+        running.append(filename)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(filename)
+        if filename == "bad.zip":
+            raise HTTPException(status_code=422, detail="invalid crate")
+        return f"http://example.org/{filename}:{crate_file.read().decode()}"
+
+    async def run():
+        q = IngestQueue(ingest, workers=2, max_size=10)
+        names = ["a.zip", "b.zip", "bad.zip", "c.zip", "d.zip"]
+        jobs = [await q.submit(name, io.BytesIO(name.encode())) for name in names]
+        await q._queue.join()
+        await q.stop()
+        return [q.get(job.id).to_dict() for job in jobs]
+
+    jobs = asyncio.run(run())
+    assert max(max_running) == 2
+    assert [job["status"] for job in jobs] == ["done", "done", "failed", "done", "done"]
+    assert jobs[0]["crate_url"] == "http://example.org/a.zip:a.zip"
+    assert jobs[2]["status_code"] == 422
+    assert jobs[2]["detail"] == "invalid crate"
+
+
+def test_ingest_queue_full():
+    async def run():
+        q = IngestQueue(as_async(lambda f, c: None), workers=1, max_size=1)
+        q.start()
+        q._workers[0].cancel()
+        await q.submit("a.zip", io.BytesIO(b"a"))
+        with pytest.raises(HTTPException) as exc_info:
+            await q.submit("b.zip", io.BytesIO(b"b"))
+        await q.stop()
+        return exc_info.value
+
+    assert asyncio.run(run()).status_code == 503
+
+
+def test_ingest_queue_concurrent_submits():
+    async def run():
+        q = IngestQueue(as_async(lambda f, c: None), workers=1, max_size=1)
+        q.start()
+        q._workers[0].cancel()
+        outcomes = await asyncio.gather(
+            *(q.submit(name, io.BytesIO(b"x")) for name in ("a.zip", "b.zip", "c.zip")), return_exceptions=True
+        )
+        queued = q._queue.qsize()
+        await q.stop()
+        return outcomes, queued, q
+
+    outcomes, queued, q = asyncio.run(run())
+    assert queued == 1
+    assert [type(_).__name__ for _ in outcomes] == ["Job", "HTTPException", "HTTPException"]
+    assert [_.status_code for _ in outcomes[1:]] == [503, 503]
+    assert list(q.jobs) == [outcomes[0].id]
+    assert q._reserved == 0
+
+
+def test_ingest_queue_keeps_max_jobs():
+    async def run():
+        q = IngestQueue(as_async(lambda f, c: f), workers=1, max_jobs=2)
+        for name in "abcd":
+            await q.submit(name, io.BytesIO(b""))
+            await q._queue.join()
+        await q.stop()
+        return q
+
+    assert [job.filename for job in asyncio.run(run()).jobs.values()] == ["c", "d"]
+
+
+def test_find_existing_results_no_results(monkeypatch):
+    monkeypatch.setattr(upload, "arun_select", None)
+    assert asyncio.run(upload.find_existing_results(set())) == set()
+
+
+# Tests for the SPARQL client
+def test_sparql_client_reuses_connection_pool():
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        body = {
+            "head": {"vars": ["s"]},
+            "results": {"bindings": [{"s": {"type": "uri", "value": TC.EXAMPLE_RDE_URI}}]},
+        }
+        return httpx.Response(200, json=body, headers={"Content-Type": "application/sparql-results+json"})
+
+    sparql_client = SPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET, transport=httpx.MockTransport(handler))
+    http = sparql_client.http
+    for _ in range(3):
+        qres = sparql_client.query(TC.QUERY_SELECT_ALL, default_graph=TC.EXAMPLE_GRAPH_URI_1)
+        assert [str(r[0]) for r in qres] == [TC.EXAMPLE_RDE_URI]
+    assert sparql_client.http is http
+    assert len(seen) == 3
+    request = seen[0]
+    assert str(request.url).startswith(f"{TC.FUSEKI_URL}/{TC.FUSEKI_DATASET}/sparql")
+    assert request.url.params["default-graph-uri"] == TC.EXAMPLE_GRAPH_URI_1
+    assert request.content.decode() == TC.QUERY_SELECT_ALL
+    sparql_client.close()
+
+
+def test_sparql_client_update():
+    seen = {}
+
+    def handler(request):
+        seen["url"] = str(request.url)
+        seen["body"] = request.content.decode()
+        return httpx.Response(204)
+
+    sparql_client = SPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET, transport=httpx.MockTransport(handler))
+    sparql_client.update("INSERT DATA {}")
+    assert seen == {"url": f"{TC.FUSEKI_URL}/{TC.FUSEKI_DATASET}/update", "body": "INSERT DATA {}"}
+    sparql_client.close()
+
+
+def test_async_sparql_client_load_graph():
+    seen = {}
+
+    async def handler(request):
+        seen["url"] = request.url
+        seen["content_type"] = request.headers["Content-Type"]
+        seen["body"] = await request.aread()
+        return httpx.Response(201)
+
+    async def load():
+        sparql_client = AsyncSPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET,
+                                          transport=httpx.MockTransport(handler))
+        await sparql_client.load_graph(TC.EXAMPLE_GRAPH_URI_1, io.BytesIO(ntriples))
+        await sparql_client.aclose()
+
+    ntriples = b"<http://a> <http://b> <http://c> .\n" * 10
+    asyncio.run(load())
+    assert str(seen["url"]).startswith(f"{TC.FUSEKI_URL}/{TC.FUSEKI_DATASET}/data")
+    assert seen["url"].params["graph"] == TC.EXAMPLE_GRAPH_URI_1
+    assert seen["content_type"] == "application/n-triples"
+    assert seen["body"] == ntriples
+
+
+def test_sparql_client_select():
+    seen = {}
+    json_body = {
+        "head": {"vars": ["s", "o"]},
+        "results": {"bindings": [
+            {"s": {"type": "uri", "value": "http://a"}, "o": {"type": "literal", "value": "x", "xml:lang": "en"}},
+            {"s": {"type": "bnode", "value": "b0"}},
+        ]},
+    }
+    tsv_body = '?s\t?o\n<http://a>\t"x\\ty\\u00e9"@en\n_:b0\t\n\t42\n'.encode()
+
+    def handler(request):
+        seen["accept"] = request.headers["Accept"]
+        if b"tsv" in request.content:
+            return httpx.Response(200, content=tsv_body, headers={"Content-Type": "text/tab-separated-values"})
+        return httpx.Response(200, json=json_body, headers={"Content-Type": "application/sparql-results+json"})
+
+    sparql_client = SPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET, transport=httpx.MockTransport(handler))
+    assert sparql_client.select("json") == [("http://a", "x"), ("b0", None)]
+    assert seen["accept"].startswith("application/sparql-results+json")
+    assert sparql_client.select("tsv") == [("http://a", "x\tyé"), ("b0", None), (None, "42")]
+    sparql_client.close()
+
+
+def test_async_sparql_client_stream():
+    seen = {}
+    csv_body = b"s,o\r\n" + b"http://a,x\r\n" * 1000
+
+    async def handler(request):
+        seen["accept"] = request.headers["Accept"]
+        if b"bad" in await request.aread():
+            return httpx.Response(400, text="Parse error")
+        return httpx.Response(200, content=csv_body, headers={"Content-Type": "text/csv"})
+
+    async def stream():
+        sparql_client = AsyncSPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET,
+                                          transport=httpx.MockTransport(handler))
+        headers, chunks = await sparql_client.stream(TC.QUERY_SELECT_ALL, "text/csv")
+        body = b"".join([_ async for _ in chunks])
+        with pytest.raises(httpx.HTTPStatusError) as exc_info:
+            await sparql_client.stream("bad", "text/csv")
+        await sparql_client.aclose()
+        return headers, body, exc_info.value.response.text
+
+    headers, body, error = asyncio.run(stream())
+    assert seen["accept"] == "text/csv"
+    assert headers["Content-Type"] == "text/csv"
+    assert body == csv_body
+    assert error == "Parse error"
+
+
+def test_async_sparql_client_load_quads():
+    seen = {}
+
+    async def handler(request):
+        seen["url"] = request.url
+        seen["content_type"] = request.headers["Content-Type"]
+        return httpx.Response(204)
+
+    async def load():
+        sparql_client = AsyncSPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET,
+                                          transport=httpx.MockTransport(handler))
+        await sparql_client.load_quads(b"<http://a> <http://b> <http://c> <http://g> .\n")
+        await sparql_client.aclose()
+
+    asyncio.run(load())
+    assert str(seen["url"]) == f"{TC.FUSEKI_URL}/{TC.FUSEKI_DATASET}/data"
+    assert seen["content_type"] == "application/n-quads"
+
+
+# Tests for list-graphs
+@pytest.fixture
+def catalog_store(monkeypatch):
+    # the catalog of five crates, queried as the store does
+    ds = Dataset(default_union=True)
+    catalog_g = ds.graph(URIRef(CATALOG_GRAPH))
+    for name in ["a1", "a2", "b1", "b2", "c1"]:
+        crate = Graph()
+        crate.parse(data=LINEAGE_TTL.replace("c1", name), format="turtle")
+        for triple in catalog_graph(crate):
+            catalog_g.add(triple)
+    # a graph with two root data entities is still listed once
+    catalog_g.parse(format="turtle", data="""\
+@prefix schema: <http://schema.org/> .
+<arcp://uuid,a1-bis/ro-crate-metadata.json> schema:about <arcp://uuid,a1-bis/> .
+<arcp://uuid,a1-bis/> schema:url "http://x/a1.zip" .
+""")
+    queries = []
 
     def mock_run_query(q):
-        return [
-            (TC.EXAMPLE_RDE_1, "rde1"),
-            (TC.EXAMPLE_RDE_2, "rde2")
-        ]
+        queries.append(q)
+        return select_rows(ds, q)
+
+    monkeypatch.setattr(catalog, "run_select", mock_run_query)
+    return queries
 
-    monkeypatch.setattr(query, "run_query", mock_run_query)
 
-    r = client.get("/query/list-RDE-graphs/")
+def test_list_graphs_ok(catalog_store):
+    r = client.get("/query/list-graphs/")
     assert r.status_code == 200
     assert r.json() == {
-        "result": [
-            [TC.EXAMPLE_RDE_1, 'rde1'],
-            [TC.EXAMPLE_RDE_2, 'rde2']
-        ]
+        "result": [f"http://x/{_}.zip" for _ in ["a1", "a2", "b1", "b2", "c1"]],
+        "total": 5,
+        "next_cursor": None,
     }
 
 
-def test_list_rde_graphs_empty(monkeypatch):
-    monkeypatch.setattr(query, "run_query", lambda q: [])
+def test_list_graphs_paginated(catalog_store):
+    graphs = []
+    params = {"limit": 2}
+    while True:
+        r = client.get("/query/list-graphs/", params=params)
+        assert r.status_code == 200
+        assert r.json()["total"] == 5
+        graphs.append(r.json()["result"])
+        if not r.json()["next_cursor"]:
+            break
+        params["cursor"] = r.json()["next_cursor"]
+    assert graphs == [
+        ["http://x/a1.zip", "http://x/a2.zip"],
+        ["http://x/b1.zip", "http://x/b2.zip"],
+        ["http://x/c1.zip"],
+    ]
+
+
+def test_list_graphs_prefix(catalog_store):
+    r = client.get("/query/list-graphs/", params={"prefix": "http://x/b"})
+    assert r.json() == {"result": ["http://x/b1.zip", "http://x/b2.zip"], "total": 2, "next_cursor": None}
+    r = client.get("/query/list-graphs/", params={"prefix": "http://x/\"z"})
+    assert r.json() == {"result": [], "total": 0, "next_cursor": None}
+
+
+def test_list_graphs_crate_name_prefix(monkeypatch):
+    seen = []
+    monkeypatch.setattr(catalog, "run_select", lambda q: seen.append(q) or ([(0,)] if "COUNT" in q else []))
+    client.get("/query/list-graphs/", params={"prefix": "b"})
+    assert all(f'"{catalog.crate_base_url()}b"' in q for q in seen)
+
+
+def test_list_graphs_cached(catalog_store):
+    client.get("/query/list-graphs/")
+    client.get("/query/list-graphs/")
+    assert len(catalog_store) == 2
+    lookup.query_cache.bump()
+    client.get("/query/list-graphs/")
+    assert len(catalog_store) == 4
 
-    r = client.get("/query/list-RDE-graphs/")
+
+def test_list_graphs_empty(monkeypatch):
+    monkeypatch.setattr(catalog, "run_select", lambda q: [(0,)] if "COUNT" in q else [])
+
+    r = client.get("/query/list-graphs/")
     assert r.status_code == 200
-    assert r.json() == {"result": []}
+    assert r.json() == {"result": [], "total": 0, "next_cursor": None}
+
+
+# Tests for list-rde-graphs
+def test_list_rde_graphs_ok(catalog_store):
+    r = client.get("/query/list-RDE-graphs/", params={"limit": 2, "prefix": "http://x/a"})
+    assert r.status_code == 200
+    assert r.json() == {
+        "result": [
+            ["http://x/a1.zip", "arcp://uuid,a1/"],
+            ["http://x/a2.zip", "arcp://uuid,a2/"],
+        ],
+        "total": 2,
+        "next_cursor": None,
+    }
 
 
 # Tests for run query sparql
@@ -320,44 +929,125 @@ def test_run_query_with_graph_param(monkeypatch):
     assert called["graph"] == TC.EXAMPLE_GRAPH_URI_1
 
 
-# Tests for backtrack endpoint
-def test_backtrack(monkeypatch):
-    actions_for_result_query_results = [
-        [TC.ACTION_ID_1],
-        [TC.ACTION_ID_2],
-    ]
+def test_run_query_paginated(monkeypatch):
+    queries = []
+    rows = [(str(i),) for i in range(5)]
 
-    def mock_fetch_actions_for_result(rid):
-        try:
-            return actions_for_result_query_results.pop()
-        except IndexError:
-            return []
+    def mock_run_query(q, graph):
+        queries.append(q)
+        limit = int(re.search(r"LIMIT (\d+)", q).group(1))
+        offset = re.search(r"OFFSET (\d+)", q)
+        offset = int(offset.group(1)) if offset else 0
+        return rows[offset:offset + limit]
 
-    objects_for_action_query_results = [
-        [TC.OBJECT_ID_1],
-        [TC.OBJECT_ID_2],
-    ]
+    monkeypatch.setattr(query, "run_query", mock_run_query)
+    files = {"query_file": ("query.txt", TC.QUERY_SELECT_ALL.encode(), TC.CONTENT_TYPE_PLAIN)}
 
-    def mock_fetch_objects_for_action(aid):
-        try:
-            return objects_for_action_query_results.pop()
-        except IndexError:
-            return []
+    r = client.post("/query/run-query/", files=files, params={"limit": 3})
+    assert r.status_code == 200
+    assert r.json()["result"] == [["0"], ["1"], ["2"]]
+    assert queries[-1].endswith("LIMIT 4")
+    cursor = r.json()["next_cursor"]
+    r = client.post("/query/run-query/", files=files, params={"limit": 3, "cursor": cursor})
+    assert r.status_code == 200
+    assert r.json() == {"result": [["3"], ["4"]], "next_cursor": None}
+    assert queries[-1].endswith("LIMIT 4\nOFFSET 3")
+
+    other = {"query_file": ("query.txt", TC.QUERY_CONSTRUCT.encode(), TC.CONTENT_TYPE_PLAIN)}
+    r = client.post("/query/run-query/", files=other, params={"limit": 3, "cursor": cursor})
+    assert r.status_code == 400
+    r = client.post("/query/run-query/", files=files, params={"limit": 3, "cursor": "xyz"})
+    assert r.status_code == 400
+    limited = {"query_file": ("query.txt", TC.QUERY_SELECT_ALL + " LIMIT 10", TC.CONTENT_TYPE_PLAIN)}
+    r = client.post("/query/run-query/", files=limited, params={"limit": 3})
+    assert r.status_code == 422
 
-    results_for_action_query_results = [
-        [TC.RESULT_ID_7],
-        [TC.RESULT_ID_8],
+
+def test_run_query_ndjson(monkeypatch):
+    called = {}
+    tsv = (
+        b"?person\t?name\t?email\n"
+        b"<http://x/p1>\t\"Simone Leo\"\t\n"
+        b"<http://x/p2>\t\"Josiah\\tCarberry\"@en\t\"j@x\"\n"
+    )
+
+    async def mock_astream_query(q, accept, graph_id=None):
+        called.update(query=q, accept=accept, graph=graph_id)
+
+        async def chunks():
+            # split rows across chunks, as the store may do
+            for i in range(0, len(tsv), 7):
+                yield tsv[i:i + 7]
+        return {}, chunks()
+
+    monkeypatch.setattr(query, "astream_query", mock_astream_query)
+    r = client.post(
+        "/query/run-query/",
+        files={"query_file": ("query.txt", TC.QUERY_SELECT_ALL.encode(), TC.CONTENT_TYPE_PLAIN)},
+        params={"format": "ndjson", "limit": 2},
+    )
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(_) for _ in r.text.splitlines()] == [
+        {"person": "http://x/p1", "name": "Simone Leo", "email": None},
+        {"person": "http://x/p2", "name": "Josiah\tCarberry", "email": "j@x"},
     ]
+    assert called["accept"] == "text/tab-separated-values"
+    assert called["query"].endswith("LIMIT 2")
+    assert "x-next-cursor" in r.headers
+
+
+def test_run_query_construct(monkeypatch):
+    triples = [("http://x/p1", "http://schema.org/name", "Simone Leo")]
+    monkeypatch.setattr(query, "run_query", lambda q, graph: triples)
+    monkeypatch.setattr(query, "astream_query", None)
+    construct = "PREFIX schema: <http://schema.org/>\nCONSTRUCT { ?p schema:name ?n } WHERE { ?p schema:name ?n }"
+    files = {"query_file": ("query.txt", construct.encode(), TC.CONTENT_TYPE_PLAIN)}
+    r = client.post("/query/run-query/", files=files)
+    assert r.status_code == 200
+    assert r.json() == {"result": [list(_) for _ in triples]}
+    # streaming formats assume SELECT results
+    for format in "ndjson", "csv", "tsv":
+        r = client.post("/query/run-query/", files=files, params={"format": format})
+        assert r.status_code == 400
+        assert r.json()["detail"] == f"Format {format} is only available for SELECT queries"
+
+
+def test_run_query_csv_error(monkeypatch):
+
+    async def mock_astream_query(q, accept, graph_id=None):
+        response = httpx.Response(400, text="Parse error", request=httpx.Request("POST", TC.FUSEKI_URL))
+        raise httpx.HTTPStatusError("bad query", request=response.request, response=response)
+
+    monkeypatch.setattr(query, "astream_query", mock_astream_query)
+    r = client.post(
+        "/query/run-query/",
+        files={"query_file": ("query.txt", b"SELECT", TC.CONTENT_TYPE_PLAIN)},
+        params={"format": "csv"},
+    )
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Parse error"
 
-    def mock_fetch_results_for_action(aid):
-        try:
-            return results_for_action_query_results.pop()
-        except IndexError:
-            return []
 
-    monkeypatch.setattr(backtrack, "fetch_actions_for_result", mock_fetch_actions_for_result)
-    monkeypatch.setattr(backtrack, "fetch_objects_for_action", mock_fetch_objects_for_action)
-    monkeypatch.setattr(backtrack, "fetch_results_for_action", mock_fetch_results_for_action)
+# Tests for backtrack endpoint
+def test_backtrack(monkeypatch):
+    lineage = {
+        TC.RESULT_ID_42: [(TC.ACTION_ID_2, [TC.OBJECT_ID_2, TC.OBJECT_ID_1], [TC.RESULT_ID_42, TC.RESULT_ID_8])],
+        TC.OBJECT_ID_2: [(TC.ACTION_ID_1, [TC.OBJECT_ID_1], [TC.OBJECT_ID_2, TC.RESULT_ID_7])],
+    }
+    levels = []
+
+    def mock_fetch_lineage_level(result_ids):
+        levels.append(list(result_ids))
+        actions_for_result, objects_for_action, results_for_action = {}, {}, {}
+        for rid in result_ids:
+            for action, objects, results in lineage.get(rid, []):
+                actions_for_result.setdefault(rid, []).append(action)
+                objects_for_action[action] = objects
+                results_for_action[action] = results
+        return actions_for_result, objects_for_action, results_for_action
+
+    monkeypatch.setattr(backtrack, "fetch_lineage_level", mock_fetch_lineage_level)
 
     r = client.get(
         "/backtrack/",
@@ -367,21 +1057,139 @@ def test_backtrack(monkeypatch):
     assert r.json() == {"result": [
         {
             "action": TC.ACTION_ID_2,
-            "objects": [TC.OBJECT_ID_2],
-            "results": [TC.RESULT_ID_8],
+            "objects": [TC.OBJECT_ID_2, TC.OBJECT_ID_1],
+            "results": [TC.RESULT_ID_42, TC.RESULT_ID_8],
         },
         {
             "action": TC.ACTION_ID_1,
             "objects": [TC.OBJECT_ID_1],
-            "results": [TC.RESULT_ID_7],
+            "results": [TC.OBJECT_ID_2, TC.RESULT_ID_7],
         },
     ]}
+    # one query per lineage level
+    assert levels == [[TC.RESULT_ID_42], [TC.OBJECT_ID_2, TC.OBJECT_ID_1]]
+
+
+def test_fetch_lineage_level_batches_ids(monkeypatch):
+    queries = []
+
+    def mock_run_query(q):
+        queries.append(q)
+        if f"<{TC.RESULT_ID_7}>" not in q:
+            return []
+        return [
+            (TC.RESULT_ID_7, TC.ACTION_ID_1, "action", None),
+            (TC.RESULT_ID_7, TC.ACTION_ID_1, "object", TC.OBJECT_ID_1),
+            (TC.RESULT_ID_7, TC.ACTION_ID_1, "result", TC.RESULT_ID_7),
+            (TC.RESULT_ID_8, TC.ACTION_ID_1, "object", TC.OBJECT_ID_1),
+            (TC.RESULT_ID_8, TC.ACTION_ID_1, "result", TC.RESULT_ID_8),
+        ]
+
+    monkeypatch.setattr(get_utils, "run_select", mock_run_query)
+    monkeypatch.setattr(get_utils.settings, "sparql_batch_size", 2)
+    level = get_utils.fetch_lineage_level([TC.RESULT_ID_7, TC.RESULT_ID_8, TC.RESULT_ID_42])
+    assert len(queries) == 2
+    assert f"VALUES ?target {{ <{TC.RESULT_ID_7}> <{TC.RESULT_ID_8}> }}" in queries[0]
+    assert level == (
+        {TC.RESULT_ID_7: [TC.ACTION_ID_1], TC.RESULT_ID_8: [TC.ACTION_ID_1]},
+        {TC.ACTION_ID_1: [TC.OBJECT_ID_1]},
+        {TC.ACTION_ID_1: [TC.RESULT_ID_7, TC.RESULT_ID_8]},
+    )
+
+
+LINEAGE_TTL = """\
+@prefix schema: <http://schema.org/> .
+<arcp://uuid,c1/ro-crate-metadata.json> a schema:CreativeWork ; schema:about <arcp://uuid,c1/> .
+<arcp://uuid,c1/> schema:url "http://x/c1.zip" ; schema:mentions <arcp://uuid,c1/#a1>, <arcp://uuid,c1/#a2> .
+<arcp://uuid,c1/#a1> a schema:CreateAction ; schema:object <file:/in.txt> ; schema:result <file:/mid.txt> .
+<arcp://uuid,c1/#a2> a schema:CreateAction ;
+    schema:object <file:/mid.txt>, <arcp://uuid,c1/#param> ;
+    schema:result <file:/out.txt> .
+<file:/in.txt> a schema:MediaObject .
+<file:/mid.txt> a schema:MediaObject .
+<file:/out.txt> a schema:MediaObject .
+<arcp://uuid,c1/#param> a schema:PropertyValue .
+<arcp://uuid,c2/#mv> a schema:CreateAction ;
+    schema:instrument <https://w3id.org/ro/terms/provstor#MoveTool> ;
+    schema:object <file:/out.txt> ;
+    schema:result <file:/moved.txt> .
+<file:/moved.txt> a schema:MediaObject .
+"""
+
+
+@pytest.fixture
+def lineage_graph():
+    # crate graphs plus the catalog, queried as the store does
+    ds = Dataset(default_union=True)
+    crate = ds.graph(URIRef("http://x/c1.zip"))
+    crate.parse(data=LINEAGE_TTL, format="turtle")
+    catalog = ds.graph(URIRef(CATALOG_GRAPH))
+    for triple in catalog_graph(crate):
+        catalog.add(triple)
+    return ds
+
+
+def test_lineage_index(lineage_graph):
+    index = LineageIndex()
+    assert not index.ready
+    index.rebuild(lineage_graph.query)
+    assert index.ready
+    assert index.lineage("file:/out.txt") == (
+        {"file:/out.txt": ["arcp://uuid,c1/#a2"], "file:/mid.txt": ["arcp://uuid,c1/#a1"]},
+        {"arcp://uuid,c1/#a2": ["file:/mid.txt"], "arcp://uuid,c1/#a1": ["file:/in.txt"]},
+        {"arcp://uuid,c1/#a2": ["file:/out.txt"], "arcp://uuid,c1/#a1": ["file:/mid.txt"]},
+    )
+    assert index.lineage("file:/not/there") == ({}, {}, {})
+    assert index.move_dest("file:/out.txt") == ["file:/moved.txt"]
+    assert index.move_dest("file:/moved.txt") == []
+    assert index.check(lineage_graph.query)["consistent"]
+    index.add(LineageDelta(edges=[("arcp://uuid,c3/#mv", "object", "file:/moved.txt")]))
+    check = index.check(lineage_graph.query)
+    assert not check["consistent"]
+    assert check["n_missing"] == 0
+    assert check["extra"] == [["arcp://uuid,c3/#mv", "object", "file:/moved.txt"]]
+
+
+def test_lineage_index_matches_store_queries(monkeypatch, lineage_graph):
+    monkeypatch.setattr(get_utils, "run_select", lambda q: select_rows(lineage_graph, q))
+    index = LineageIndex()
+    index.rebuild(lineage_graph.query)
+    monkeypatch.setattr(backtrack, "lineage_index", index)
+    r = client.get("/backtrack/", params={"result_id": "file:/out.txt"})
+    assert r.status_code == 200
+    assert r.json() == {"result": backtrack.backtrack_lineage("file:/out.txt")}
+    assert [_["action"] for _ in r.json()["result"]] == ["arcp://uuid,c1/#a2", "arcp://uuid,c1/#a1"]
+
+
+def test_movechain_from_lineage_index(monkeypatch, lineage_graph):
+    index = LineageIndex()
+    index.rebuild(lineage_graph.query)
+    monkeypatch.setattr(pathops, "lineage_index", index)
+    monkeypatch.setattr(pathops, "run_query", None)
+    r = client.get("/pathops/movechain/", params={"path_id": "file:/out.txt"})
+    assert r.status_code == 200
+    assert r.json() == {"result": ["file:/moved.txt"]}
+
+
+def test_admin_lineage_index(monkeypatch, lineage_graph):
+    index = LineageIndex()
+    monkeypatch.setattr(admin, "lineage_index", index)
+    monkeypatch.setattr(admin, "run_query", lambda q: lineage_graph.query(q))
+    r = client.get("/admin/lineage-index/check")
+    assert r.status_code == 200
+    assert r.json()["result"]["ready"] is False
+    assert r.json()["result"]["consistent"] is False
+    r = client.post("/admin/lineage-index/rebuild")
+    assert r.status_code == 200
+    assert r.json() == {"result": "success", "ids": len(index)}
+    r = client.get("/admin/lineage-index/check")
+    assert r.json()["result"]["consistent"] is True
 
 
 # Tests for get crate
 def test_get_crate_not_found(monkeypatch):
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "SELECT ... %s ...")
-    monkeypatch.setattr(get, "run_query", lambda q: [])
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "SELECT ... $iri{rde} ..."))
+    monkeypatch.setattr(get, "arun_select", as_async(lambda q: []))
 
     r = client.get("/get/crate/", params={"rde_id": TC.RESULT_ID_123})
     assert r.status_code == 404
@@ -390,56 +1198,36 @@ def test_get_crate_not_found(monkeypatch):
 
 def test_get_crate_ok_with_content_type(monkeypatch):
     called = {}
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "Q:%s")
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
 
     def mock_run_query(q):
         called["query"] = q
         return [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]
 
-    monkeypatch.setattr(get, "run_query", mock_run_query)
-
-    class MockResp:
-        def __init__(self):
-            self.headers = {"Content-Type": TC.CONTENT_TYPE_ZIP}
-
-        def read(self):
-            return TC.ZIP_DATA
+    monkeypatch.setattr(get, "arun_select", as_async(mock_run_query))
 
-        def __enter__(self):
-            return self
+    async def mock_stream_crate(url, request_headers=None):
+        return 200, {"Content-Type": TC.CONTENT_TYPE_ZIP}, aiter_chunks(TC.ZIP_DATA[:3], TC.ZIP_DATA[3:])
 
-        def __exit__(self, *args):
-            return False
-
-    monkeypatch.setattr(get, "urlopen", lambda url: MockResp())
+    monkeypatch.setattr(get, "stream_crate", mock_stream_crate)
 
     r = client.get("/get/crate/", params={"rde_id": TC.RESULT_ID_123})
     assert r.status_code == 200
     assert r.content == TC.ZIP_DATA
     assert r.headers["Content-Disposition"] == f"attachment; filename={TC.CRATE_ZIP}"
     assert r.headers["content-type"] == TC.CONTENT_TYPE_ZIP
-    assert called["query"] == f"Q:{TC.RESULT_ID_123}/"
+    assert called["query"] == f"Q:<{TC.RESULT_ID_123}/>"
 
 
 def test_get_crate_ok_defaults_content_type(monkeypatch):
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "Q:%s")
-    monkeypatch.setattr(get, "run_query",
-                        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.ANOTHER_ZIP}",)])
-
-    class MockRespNoCT:
-        def __init__(self):
-            self.headers = {}
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.ANOTHER_ZIP}",)]))
 
-        def read(self):
-            return TC.GENERIC_DATA
+    async def mock_stream_crate(url, request_headers=None):
+        return 200, {}, aiter_chunks(TC.GENERIC_DATA)
 
-        def __enter__(self):
-            return self
-
-        def __exit__(self, *args):
-            return False
-
-    monkeypatch.setattr(get, "urlopen", lambda url: MockRespNoCT())
+    monkeypatch.setattr(get, "stream_crate", mock_stream_crate)
 
     r = client.get("/get/crate/", params={"rde_id": f"{TC.EXAMPLE_URI}/rde/42/"})
     assert r.status_code == 200
@@ -448,6 +1236,107 @@ def test_get_crate_ok_defaults_content_type(monkeypatch):
     assert r.headers["content-type"] == TC.CONTENT_TYPE_ZIP
 
 
+@pytest.mark.parametrize("byte_range, status_code, content", [
+    (None, 200, TC.ZIP_DATA),
+    ("bytes=2-4", 206, TC.ZIP_DATA[2:5]),
+    ("bytes=-3", 206, TC.ZIP_DATA[-3:]),
+])
+def test_get_crate_range(monkeypatch, byte_range, status_code, content):
+    seen = []
+
+    def filer(request):
+        response = range_filer(TC.ZIP_DATA, seen)(request)
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["ETag"] = '"abc"'
+        return response
+
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(filer))
+    monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]))
+    headers = {"Range": byte_range} if byte_range else {}
+    r = client.get("/get/crate/", params={"rde_id": TC.ARCP_RDE_1}, headers=headers)
+    assert r.status_code == status_code
+    assert r.content == content
+    assert r.headers["Content-Length"] == str(len(content))
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.headers["ETag"] == '"abc"'
+    assert seen == [byte_range]
+    if byte_range:
+        start = TC.ZIP_DATA.index(content)
+        assert r.headers["Content-Range"] == f"bytes {start}-{start + len(content) - 1}/{len(TC.ZIP_DATA)}"
+
+
+def test_get_crate_range_not_satisfiable(monkeypatch):
+    def filer(request):
+        return httpx.Response(416, headers={"Content-Range": f"bytes */{len(TC.ZIP_DATA)}"})
+
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(filer))
+    monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]))
+    r = client.get("/get/crate/", params={"rde_id": TC.ARCP_RDE_1}, headers={"Range": "bytes=100-"})
+    assert r.status_code == 416
+    assert r.headers["Content-Range"] == f"bytes */{len(TC.ZIP_DATA)}"
+
+
+# Tests for non-blocking I/O in async routes
+def test_slow_download_does_not_block_other_requests(monkeypatch):
+    crate_urls = {
+        f"{TC.ARCP_RDE_1}/": f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/slow.zip",
+        "arcp://rde-2/": f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/fast.zip",
+    }
+    zip_bytes = make_zip_bytes({"dir/file.txt": TC.FILE_CONTENT})
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "$iri{rde}"))
+
+    async def mock_arun_query(q):
+        await asyncio.sleep(0.01)
+        return [(crate_urls[q.strip("<>")],)]
+
+    monkeypatch.setattr(get, "arun_select", mock_arun_query)
+
+    # local stand-in for the SeaweedFS filer
+    async def filer(request):
+        if request.url.path.endswith("slow.zip"):
+            await asyncio.sleep(0.5)
+        return httpx.Response(200, content=zip_bytes, headers={"Content-Type": TC.CONTENT_TYPE_ZIP})
+
+    # member extraction reads the crate with blocking range requests
+    sync_filer_client = httpx.Client(transport=httpx.MockTransport(range_filer(zip_bytes, [])))
+    monkeypatch.setattr(storage, "get_filer_sync_client", lambda: sync_filer_client)
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: None))
+
+    async def main():
+        filer_client = httpx.AsyncClient(transport=httpx.MockTransport(filer))
+        monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+        finished = {}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://api") as api:
+
+            async def fetch(name, path, params):
+                r = await api.get(path, params=params)
+                finished[name] = time.monotonic()
+                return r
+
+            slow = asyncio.create_task(fetch("slow", "/get/crate/", {"rde_id": TC.ARCP_RDE_1}))
+            await asyncio.sleep(0.05)
+            responses = await asyncio.gather(
+                *[fetch(f"crate{i}", "/get/crate/", {"rde_id": "arcp://rde-2"}) for i in range(3)],
+                *[fetch(f"file{i}", "/get/file/", {"file_uri": "arcp://rde-2/dir/file.txt"}) for i in range(3)],
+            )
+            responses.append(await slow)
+        await filer_client.aclose()
+        return finished, responses
+
+    finished, responses = asyncio.run(main())
+    assert [r.status_code for r in responses] == [200] * 7
+    assert responses[-1].content == zip_bytes
+    assert responses[3].content == TC.FILE_CONTENT
+    assert all(t < finished["slow"] for name, t in finished.items() if name != "slow")
+
+
 # Tests for get file
 def test_get_file_unsupported_protocol():
     r = client.get("/get/file/", params={"file_uri": TC.EXAMPLE_FILE_URI})
@@ -456,8 +1345,8 @@ def test_get_file_unsupported_protocol():
 
 
 def test_get_file_crate_not_found(monkeypatch):
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "Q:%s")
-    monkeypatch.setattr(get, "run_query", lambda q: [])
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(lambda q: []))
 
     r = client.get("/get/file/", params={"file_uri": TC.ARCP_FILE_TXT})
     assert r.status_code == 404
@@ -465,55 +1354,32 @@ def test_get_file_crate_not_found(monkeypatch):
 
 
 def test_get_file_ok_with_mapped_content_type(monkeypatch):
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "Q:%s")
-    monkeypatch.setattr(get, "run_query",
-                        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)])
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]))
     monkeypatch.setattr(get, "content_type_map", {"txt": TC.CONTENT_TYPE_PLAIN})
 
     zip_bytes = make_zip_bytes({"dir/file.txt": TC.FILE_CONTENT})
-
-    class MockResp:
-        headers = {}
-
-        def read(self):
-            return zip_bytes
-
-        def __enter__(self):
-            return self
-
-        def __exit__(self, *args):
-            return False
-
-    monkeypatch.setattr(get, "urlopen", lambda url: MockResp())
+    monkeypatch.setattr(get, "open_crate", lambda url: io.BytesIO(zip_bytes))
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: None))
 
     r = client.get("/get/file/", params={"file_uri": TC.ARCP_FILE_TXT})
     assert r.status_code == 200
     assert r.content == TC.FILE_CONTENT
+    assert r.headers["Content-Length"] == str(len(TC.FILE_CONTENT))
     assert r.headers["Content-Disposition"] == "attachment; filename=file.txt"
     assert r.headers["content-type"] == f"{TC.CONTENT_TYPE_PLAIN}; charset=utf-8"
 
 
 def test_get_file_ok_default_content_type(monkeypatch):
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "Q:%s")
-    monkeypatch.setattr(get, "run_query",
-                        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.ANOTHER_ZIP}",)])
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.ANOTHER_ZIP}",)]))
     monkeypatch.setattr(get, "content_type_map", {"txt": TC.CONTENT_TYPE_PLAIN})
 
     zip_bytes = make_zip_bytes({"x/y/file.dat": TC.BINARY_CONTENT})
-
-    class MockResp:
-        headers = {}
-
-        def read(self):
-            return zip_bytes
-
-        def __enter__(self):
-            return self
-
-        def __exit__(self, *args):
-            return False
-
-    monkeypatch.setattr(get, "urlopen", lambda url: MockResp())
+    monkeypatch.setattr(get, "open_crate", lambda url: io.BytesIO(zip_bytes))
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: None))
 
     r = client.get("/get/file/", params={"file_uri": TC.ARCP_FILE_DAT})
     assert r.status_code == 200
@@ -523,41 +1389,241 @@ def test_get_file_ok_default_content_type(monkeypatch):
 
 
 def test_get_file_member_missing(monkeypatch):
-    monkeypatch.setattr(get, "CRATE_URL_QUERY", "Q:%s")
-    monkeypatch.setattr(get, "run_query",
-                        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/miss.zip",)])
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/miss.zip",)]))
 
     zip_bytes = make_zip_bytes({"dir/other.txt": b"nope"})
+    monkeypatch.setattr(get, "open_crate", lambda url: io.BytesIO(zip_bytes))
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: None))
+
+    r = client.get("/get/file/", params={"file_uri": TC.ARCP_FILE_MISSING})
+    assert r.status_code == 404
+    assert r.json()["detail"] == "File 'dir/missing.txt' not found in the crate"
 
-    class MockResp:
-        headers = {}
 
-        def read(self):
-            return zip_bytes
+def range_filer(data, seen, support_ranges=True):
+    """Return a MockTransport handler serving data, with Range support."""
+    def handler(request):
+        byte_range = request.headers.get("Range")
+        seen.append(byte_range)
+        if not support_ranges or byte_range is None:
+            return httpx.Response(200, content=data)
+        start, end = byte_range.removeprefix("bytes=").split("-")
+        if not data:
+            return httpx.Response(416, headers={"Content-Range": "bytes */0"})
+        if start:
+            start, end = int(start), min(int(end), len(data) - 1)
+        else:
+            start, end = max(len(data) - int(end), 0), len(data) - 1
+        return httpx.Response(206, content=data[start:end + 1],
+                              headers={"Content-Range": f"bytes {start}-{end}/{len(data)}"})
+    return handler
+
+
+def test_range_reader():
+    data = bytes(range(256)) * 1000
+    seen = []
+    http = httpx.Client(transport=httpx.MockTransport(range_filer(data, seen)))
+    reader = storage.RangeReader(http, TC.EXAMPLE_URI, tail_size=1000)
+    assert reader.size == len(data)
+    assert seen == ["bytes=-1000"]
+    reader.seek(-10, io.SEEK_END)
+    assert reader.read(100) == data[-10:]
+    assert len(seen) == 1
+    reader.seek(5000)
+    assert reader.read(300) == data[5000:5300]
+    assert seen[-1] == "bytes=5000-5299"
+    # raw reads stop at the start of the tail
+    reader.seek(len(data) - 1500)
+    assert reader.read(1000) == data[-1500:-1000]
+    assert seen[-1] == f"bytes={len(data) - 1500}-{len(data) - 1001}"
+    assert reader.read(10) == data[-1000:-990]
+    assert reader.read() == data[-990:]
+    assert reader.read(10) == b""
+
+
+def test_range_reader_no_ranges():
+    data = b"abcdef"
+    seen = []
+    http = httpx.Client(transport=httpx.MockTransport(range_filer(data, seen, support_ranges=False)))
+    reader = storage.RangeReader(http, TC.EXAMPLE_URI)
+    reader.seek(2)
+    assert reader.read(3) == b"cde"
+    assert len(seen) == 1
+
+
+def test_range_reader_empty():
+    http = httpx.Client(transport=httpx.MockTransport(range_filer(b"", [])))
+    reader = storage.RangeReader(http, TC.EXAMPLE_URI)
+    assert reader.size == 0
+    assert reader.read() == b""
+
+
+def test_open_crate_reads_only_member(monkeypatch):
+    big = io.BytesIO()
+    with zipfile.ZipFile(big, "w", compression=zipfile.ZIP_STORED) as z:
+        z.writestr("dir/file.txt", TC.FILE_CONTENT)
+        z.writestr("big.bin", b"\0" * 8 * 1024 * 1024)
+    data = big.getvalue()
+    seen = []
+    http = httpx.Client(transport=httpx.MockTransport(range_filer(data, seen)))
+    monkeypatch.setattr(storage, "get_filer_sync_client", lambda: http)
+    monkeypatch.setattr(get, "open_crate", storage.open_crate)
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: None))
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]))
+    r = client.get("/get/file/", params={"file_uri": TC.ARCP_FILE_TXT})
+    assert r.status_code == 200
+    assert r.content == TC.FILE_CONTENT
+    # the tail and the member's local header and data
+    assert len(seen) == 2
+    start, end = map(int, seen[1].removeprefix("bytes=").split("-"))
+    assert end - start < storage.settings.seaweedfs_read_buffer_size
 
-        def __enter__(self):
-            return self
 
-        def __exit__(self, *args):
-            return False
+def make_indexed_zip_bytes():
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("dir/", b"")
+        z.writestr("dir/file.txt", TC.FILE_CONTENT * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr("x/y/file.dat", TC.BINARY_CONTENT, compress_type=zipfile.ZIP_STORED)
+        z.writestr("x/empty.txt", b"", compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr("x/y/file.bz2", TC.BINARY_CONTENT, compress_type=zipfile.ZIP_BZIP2)
+    return buf.getvalue()
 
-    monkeypatch.setattr(get, "urlopen", lambda url: MockResp())
 
+def test_build_member_index():
+    data = make_indexed_zip_bytes()
+    index = members.build_member_index(io.BytesIO(data))
+    assert index["version"] == members.INDEX_VERSION
+    assert list(index["members"]) == ["dir/file.txt", "x/y/file.dat", "x/empty.txt", "x/y/file.bz2"]
+    offset, csize, size, method, crc = index["members"]["dir/file.txt"]
+    assert method == zipfile.ZIP_DEFLATED
+    assert size == len(TC.FILE_CONTENT) * 1000
+    assert zlib.decompress(data[offset:offset + csize], -15) == TC.FILE_CONTENT * 1000
+    assert crc == zlib.crc32(TC.FILE_CONTENT * 1000)
+    offset, csize, size, method, crc = index["members"]["x/y/file.dat"]
+    assert data[offset:offset + csize] == TC.BINARY_CONTENT
+
+
+@pytest.mark.parametrize("zip_member, content", [
+    ("dir/file.txt", TC.FILE_CONTENT * 1000),
+    ("x/y/file.dat", TC.BINARY_CONTENT),
+    ("x/empty.txt", b""),
+    ("x/y/file.bz2", TC.BINARY_CONTENT),
+], ids=["deflated", "stored", "empty", "bzip2"])
+def test_get_file_from_member_index(monkeypatch, zip_member, content):
+    data = make_indexed_zip_bytes()
+    index = members.build_member_index(io.BytesIO(data))
+    seen = []
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(range_filer(data, seen)))
+    monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: index))
+    monkeypatch.setattr(get, "open_crate", lambda url: io.BytesIO(data))
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]))
+    r = client.get("/get/file/", params={"file_uri": f"{TC.ARCP_RDE_1}/{zip_member}"})
+    assert r.status_code == 200
+    assert r.content == content
+    assert r.headers["Content-Length"] == str(len(content))
+    if zip_member.endswith(".bz2"):
+        # not streamable, read via zipfile
+        assert seen == []
+    elif content:
+        offset, csize = index["members"][zip_member][:2]
+        assert seen == [f"bytes={offset}-{offset + csize - 1}"]
+
+
+def test_get_file_not_in_member_index(monkeypatch):
+    index = members.build_member_index(io.BytesIO(make_indexed_zip_bytes()))
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: index))
+    monkeypatch.setattr(get, "open_crate", None)
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(
+        lambda q: [(f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}",)]))
     r = client.get("/get/file/", params={"file_uri": TC.ARCP_FILE_MISSING})
     assert r.status_code == 404
     assert r.json()["detail"] == "File 'dir/missing.txt' not found in the crate"
 
 
+def test_stream_member_bad_crc(monkeypatch):
+    data = make_indexed_zip_bytes()
+    index = members.build_member_index(io.BytesIO(data))
+    entry = index["members"]["x/y/file.dat"][:4] + [0]
+
+    async def read():
+        filer_client = httpx.AsyncClient(transport=httpx.MockTransport(range_filer(data, [])))
+        monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+        chunks = await members.stream_member(TC.EXAMPLE_URI, "x/y/file.dat", entry)
+        return [chunk async for chunk in chunks]
+
+    with pytest.raises(zipfile.BadZipFile):
+        asyncio.run(read())
+
+
+def test_get_member_index(monkeypatch):
+    crate_url = f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}"
+    index = {"version": members.INDEX_VERSION, "members": {}}
+    seen = []
+
+    def filer(request):
+        seen.append(str(request.url))
+        if request.url.path.endswith(f"/{TC.CRATE_ZIP}.json"):
+            return httpx.Response(200, json=index)
+        return httpx.Response(404)
+
+    async def get_indexes():
+        filer_client = httpx.AsyncClient(transport=httpx.MockTransport(filer))
+        monkeypatch.setattr(sidecar, "get_filer_client", lambda: filer_client)
+        return [await members.get_member_index(url) for url in (crate_url, crate_url, f"{crate_url}.old")]
+
+    monkeypatch.setattr(members.member_indexes, "cache", lookup.LookupCache(10))
+    assert asyncio.run(get_indexes()) == [index, index, None]
+    assert seen == [
+        f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/.index/{TC.CRATE_ZIP}.json",
+        f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/.index/{TC.CRATE_ZIP}.old.json",
+    ]
+
+
+def test_index_crate_removes_stale_index(object_store):
+    crate_url = f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}"
+    members.index_crate(TC.CRATE_ZIP, crate_url, io.BytesIO(make_indexed_zip_bytes()))
+    index_path = object_store.path / members.member_indexes.key(TC.CRATE_ZIP)
+    assert index_path.exists()
+    assert members.member_indexes.cache.get(crate_url) is not None
+    members.index_crate(TC.CRATE_ZIP, crate_url, io.BytesIO(b"not a zip"))
+    assert not index_path.exists()
+    assert members.member_indexes.cache.get(crate_url) is None
+
+
+def test_admin_rebuild_member_index(monkeypatch, object_store):
+    crates = {
+        f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}": make_indexed_zip_bytes(),
+        f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.ANOTHER_ZIP}": b"not a zip",
+    }
+    monkeypatch.setattr(admin, "run_query", lambda q: [(URIRef(_),) for _ in crates])
+    monkeypatch.setattr(members, "open_crate", lambda url: io.BytesIO(crates[url]))
+    r = client.post("/admin/member-index/rebuild")
+    assert r.status_code == 200
+    assert r.json() == {"result": "success", "indexed": 1, "failed": list(crates)[1:]}
+    assert (object_store.path / members.member_indexes.key(TC.CRATE_ZIP)).exists()
+    r = client.post("/admin/member-index/rebuild", params={"graph": "crate"})
+    assert r.json() == {"result": "success", "indexed": 1, "failed": []}
+
+
 # Tests for get graphs-for-file
 def test_graphs_for_file_ok(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q: [(TC.GRAPH_ID_1,), (TC.GRAPH_ID_2,)])
+    monkeypatch.setattr(get, "run_select", lambda q: [(TC.GRAPH_ID_1,), (TC.GRAPH_ID_2,)])
     r = client.get("/get/graphs-for-file/", params={"file_id": TC.FILE_ID_123})
     assert r.status_code == 200
     assert r.json() == {"result": [TC.GRAPH_ID_1, TC.GRAPH_ID_2]}
 
 
 def test_graphs_for_file_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q: [])
+    monkeypatch.setattr(get, "run_select", lambda q: [])
     r = client.get("/get/graphs-for-file/", params={"file_id": TC.FILE_ID_123})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -565,14 +1631,14 @@ def test_graphs_for_file_empty(monkeypatch):
 
 # Tests for get graphs-for-result
 def test_graphs_for_result_ok(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q: [("grA",), ("grB",)])
+    monkeypatch.setattr(get, "run_select", lambda q: [("grA",), ("grB",)])
     r = client.get("/get/graphs-for-result/", params={"result_id": TC.RESULT_ID_42})
     assert r.status_code == 200
     assert r.json() == {"result": ["grA", "grB"]}
 
 
 def test_graphs_for_result_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q: [])
+    monkeypatch.setattr(get, "run_select", lambda q: [])
     r = client.get("/get/graphs-for-result/", params={"result_id": TC.RESULT_ID_42})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -586,7 +1652,7 @@ def test_workflow_ok_and_graph_id_forwarded(monkeypatch):
         seen["graph_id"] = graph_id
         return [(TC.WORKFLOW_1,), (TC.WORKFLOW_2,)]
 
-    monkeypatch.setattr(get, "run_query", mock_run_query)
+    monkeypatch.setattr(get, "run_select", mock_run_query)
     r = client.get("/get/workflow/", params={"graph_id": TC.GRAPH_ID_1})
     assert r.status_code == 200
     assert r.json() == {"result": [TC.WORKFLOW_1, TC.WORKFLOW_2]}
@@ -594,7 +1660,7 @@ def test_workflow_ok_and_graph_id_forwarded(monkeypatch):
 
 
 def test_workflow_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q, graph_id=None: [])
+    monkeypatch.setattr(get, "run_select", lambda q, graph_id=None: [])
     r = client.get("/get/workflow/", params={"graph_id": TC.GRAPH_ID_1})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -608,7 +1674,7 @@ def test_run_results_ok(monkeypatch):
         seen["graph_id"] = graph_id
         return [("r1",), ("r2",)]
 
-    monkeypatch.setattr(get, "run_query", mock_run_query)
+    monkeypatch.setattr(get, "run_select", mock_run_query)
 
     r = client.get("/get/run-results/", params={"graph_id": TC.GRAPH_ID_2})
     assert r.status_code == 200
@@ -617,7 +1683,7 @@ def test_run_results_ok(monkeypatch):
 
 
 def test_run_results_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q, graph_id=None: [])
+    monkeypatch.setattr(get, "run_select", lambda q, graph_id=None: [])
     r = client.get("/get/run-results/", params={"graph_id": TC.GRAPH_ID_2})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -631,7 +1697,7 @@ def test_run_objects_ok(monkeypatch):
         seen["graph_id"] = graph_id
         return [("o1",), ("o2",)]
 
-    monkeypatch.setattr(get, "run_query", mock_run_query)
+    monkeypatch.setattr(get, "run_select", mock_run_query)
     r = client.get("/get/run-objects/", params={"graph_id": TC.GRAPH_ID_3})
     assert r.status_code == 200
     assert r.json() == {"result": ["o1", "o2"]}
@@ -639,7 +1705,7 @@ def test_run_objects_ok(monkeypatch):
 
 
 def test_run_objects_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q, graph_id=None: [])
+    monkeypatch.setattr(get, "run_select", lambda q, graph_id=None: [])
     r = client.get("/get/run-objects/", params={"graph_id": TC.GRAPH_ID_3})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -647,14 +1713,14 @@ def test_run_objects_empty(monkeypatch):
 
 # Tests for get objects-for-result
 def test_objects_for_result_ok(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q: [("objA",), ("objB",)])
+    monkeypatch.setattr(get, "run_select", lambda q: [("objA",), ("objB",)])
     r = client.get("/get/objects-for-result/", params={"result_id": TC.RESULT_ID_7})
     assert r.status_code == 200
     assert r.json() == {"result": ["objA", "objB"]}
 
 
 def test_objects_for_result_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q: [])
+    monkeypatch.setattr(get, "run_select", lambda q: [])
     r = client.get("/get/objects-for-result/", params={"result_id": TC.RESULT_ID_7})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -711,10 +1777,9 @@ def test_run_params_ok(monkeypatch):
 
     def mock_run_query(q, graph_id=None):
         seen["graph_id"] = graph_id
-        return [SimpleNamespace(name="p1", value="v1"),
-                SimpleNamespace(name="p2", value="v2")]
+        return [("p1", "v1"), ("p2", "v2")]
 
-    monkeypatch.setattr(get, "run_query", mock_run_query)
+    monkeypatch.setattr(get, "run_select", mock_run_query)
 
     r = client.get("/get/run-params/", params={"graph_id": TC.GRAPH_ID_9})
     assert r.status_code == 200
@@ -723,7 +1788,7 @@ def test_run_params_ok(monkeypatch):
 
 
 def test_run_params_empty(monkeypatch):
-    monkeypatch.setattr(get, "run_query", lambda q, graph_id=None: [])
+    monkeypatch.setattr(get, "run_select", lambda q, graph_id=None: [])
     r = client.get("/get/run-params/", params={"graph_id": TC.GRAPH_ID_9})
     assert r.status_code == 200
     assert r.json() == {"result": []}
@@ -760,7 +1825,7 @@ def test_cpmv_not_fileuri(op):
 
 @pytest.mark.parametrize("op", ["copy", "move"])
 def test_cpmv_missing_src(monkeypatch, op):
-    monkeypatch.setattr(pathops, "run_query", lambda q: [])
+    monkeypatch.setattr(pathops, "arun_query", as_async(lambda q: []))
     r = client.post(
         f"/pathops/{op}/",
         params={
@@ -776,7 +1841,7 @@ def test_cpmv_missing_src(monkeypatch, op):
 def test_cpmv_already_moved(monkeypatch, op):
     chain = ["file:///foo"]
     monkeypatch.setattr(pathops, "movechain", lambda p: {"result": chain})
-    monkeypatch.setattr(pathops, "run_query", lambda q: [(URIRef(TC.FILE_URI_A),)])
+    monkeypatch.setattr(pathops, "arun_query", as_async(lambda q: [(URIRef(TC.FILE_URI_A),)]))
     r = client.post(
         f"/pathops/{op}/",
         params={
@@ -792,11 +1857,11 @@ def test_cpmv_already_moved(monkeypatch, op):
 def test_cpmv_ok(monkeypatch, op):
 
     def mock_run_query(q):
-        if q == IS_FILE_OR_DIR_QUERY % TC.FILE_URI_A:
+        if q == IS_FILE_OR_DIR_QUERY.bind(id=TC.FILE_URI_A):
             return [(URIRef(TC.FILE_URI_A),)]
         return []
 
-    monkeypatch.setattr(pathops, "run_query", mock_run_query)
+    monkeypatch.setattr(pathops, "arun_query", as_async(mock_run_query))
 
     async def mock_load_crate_metadata(f):
         return {
@@ -841,3 +1906,689 @@ def test_movechain(monkeypatch):
     )
     assert r.status_code == 200
     assert r.json() == {"result": [TC.FILE_URI_B, TC.FILE_URI_C]}
+
+
+# Tests for the local crate cache
+CRATE_URL = f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}"
+
+
+def fill_cache(cache, crate_url, data, member=None, headers=None):
+    fill = cache.filler(crate_url, member, size=len(data), headers=headers)
+    fill.write(data)
+    fill.commit()
+
+
+def test_crate_cache_lru(tmp_path):
+    cache = crate_cache_mod.CrateCache(tmp_path, 10, 10)
+    assert cache.open("u1") is None
+    fill_cache(cache, "u1", b"12345")
+    fill_cache(cache, "u2", b"1234", member="m")
+    with cache.open("u1") as f:
+        assert f.read() == b"12345"
+    # u2/m is the least recently used one
+    fill_cache(cache, "u3", b"123")
+    assert cache.open("u2", "m") is None
+    assert cache.open("u1") is not None
+    assert cache.open("u3") is not None
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["size"] == 8
+    assert stats["evictions"] == 1
+    assert stats["fills"] == 3
+    # too large
+    assert cache.filler("u4", size=11) is None
+    assert cache.filler("u4") is None
+
+
+def test_crate_cache_fill_once(tmp_path):
+    cache = crate_cache_mod.CrateCache(tmp_path, 100, 100)
+    fill = cache.filler("u", size=3)
+    assert cache.filler("u", size=3) is None
+    fill.write(b"12")
+    fill.commit()
+    # incomplete, not cached
+    assert cache.open("u") is None
+    fill = cache.filler("u", size=3)
+    fill.write(b"123")
+    fill.abort()
+    assert cache.open("u") is None
+    assert list(tmp_path.glob("*/*")) == []
+
+
+def test_crate_cache_invalidate(tmp_path):
+    cache = crate_cache_mod.CrateCache(tmp_path, 100, 100)
+    fill_cache(cache, "u", b"123")
+    fill_cache(cache, "u", b"45", member="m")
+    fill_cache(cache, "v", b"67")
+    fill = cache.filler("u", "n", size=1)
+    cache.invalidate("u")
+    fill.write(b"8")
+    fill.commit()
+    assert cache.open("u") is None
+    assert cache.open("u", "m") is None
+    assert cache.open("u", "n") is None
+    assert cache.open("v") is not None
+    assert cache.headers("u") == {}
+    assert cache.stats()["size"] == 2
+    assert len(list(tmp_path.glob("*/*"))) == 2
+
+
+def test_crate_cache_reload(tmp_path):
+    cache = crate_cache_mod.CrateCache(tmp_path, 100, 100)
+    fill_cache(cache, "u", b"123", headers={"ETag": '"abc"'})
+    cache.filler("v", size=3).write(b"1")
+    cache = crate_cache_mod.CrateCache(tmp_path, 100, 100)
+    with cache.open("u") as f:
+        assert f.read() == b"123"
+    assert cache.headers("u") == {"ETag": '"abc"'}
+    assert cache.headers("v") == {}
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["size"] == 3
+    assert list(tmp_path.glob("*/*.tmp")) == []
+
+
+def test_cached_chunks_partial(tmp_path):
+    cache = crate_cache_mod.CrateCache(tmp_path, 100, 100)
+
+    async def chunks():
+        yield b"12"
+        raise httpx.ReadError("boom")
+
+    async def consume():
+        async for _ in crate_cache_mod.cached_chunks(cache.filler("u", size=4), chunks()):
+            pass
+
+    with pytest.raises(httpx.ReadError):
+        asyncio.run(consume())
+    assert cache.open("u") is None
+    assert cache.filler("u", size=4) is not None
+
+
+def test_get_crate_cached(monkeypatch, crate_cache):
+    seen = []
+    validators = {"ETag": '"abc"', "Last-Modified": "Thu, 01 Jan 2026 00:00:00 GMT"}
+
+    def filer(request):
+        response = range_filer(TC.ZIP_DATA, seen)(request)
+        response.headers.update({"Content-Type": "application/x-zip", "Accept-Ranges": "bytes", **validators})
+        return response
+
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(filer))
+    monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(lambda q: [(CRATE_URL,)]))
+    for _ in range(2):
+        r = client.get("/get/crate/", params={"rde_id": TC.ARCP_RDE_1})
+        assert r.status_code == 200
+        assert r.content == TC.ZIP_DATA
+        assert r.headers["Content-Length"] == str(len(TC.ZIP_DATA))
+        assert r.headers["Content-Type"] == "application/x-zip"
+        assert r.headers["Accept-Ranges"] == "bytes"
+        assert {k: r.headers.get(k) for k in validators} == validators
+    assert seen == [None]
+    # ranges are always served by the filer
+    r = client.get("/get/crate/", params={"rde_id": TC.ARCP_RDE_1}, headers={"Range": "bytes=0-1"})
+    assert r.status_code == 206
+    assert seen == [None, "bytes=0-1"]
+    assert crate_cache.stats()["hits"] == 1
+
+
+def test_get_file_cached(monkeypatch, crate_cache):
+    data = make_indexed_zip_bytes()
+    index = members.build_member_index(io.BytesIO(data))
+    seen = []
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(range_filer(data, seen)))
+    monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+    monkeypatch.setattr(get, "get_member_index", as_async(lambda url: index))
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    monkeypatch.setattr(get, "arun_select", as_async(lambda q: [(CRATE_URL,)]))
+    for _ in range(2):
+        r = client.get("/get/file/", params={"file_uri": f"{TC.ARCP_RDE_1}/x/y/file.dat"})
+        assert r.status_code == 200
+        assert r.headers["Content-Length"] == str(len(r.content))
+    assert len(seen) == 1
+    with crate_cache.open(CRATE_URL, "x/y/file.dat") as f:
+        assert f.read() == r.content
+
+
+def test_upload_invalidates_crate_cache(monkeypatch, mock_client, crate_cache):
+    crate_url = f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/{TC.CRATE_ZIP}"
+    fill_cache(crate_cache, crate_url, b"old")
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 200
+    assert crate_cache.open(crate_url) is None
+
+
+def test_crate_cache_stats(crate_cache):
+    fill_cache(crate_cache, "u", b"123")
+    r = client.get("/admin/crate-cache/stats")
+    assert r.status_code == 200
+    assert r.json()["result"]["entries"] == 1
+    assert r.json()["result"]["size"] == 3
+
+
+# Tests for the crate URL lookup cache
+def test_lookup_cache_lru():
+    cache = lookup.LookupCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"entries": 2, "size": 2, "hits": 2, "misses": 1}
+
+
+def test_get_crate_url_memoized(monkeypatch):
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(range_filer(TC.ZIP_DATA, [])))
+    monkeypatch.setattr(storage, "get_filer_client", lambda: filer_client)
+    monkeypatch.setattr(get, "CRATE_URL_QUERY", QueryTemplate("crate-url", "Q:$iri{rde}"))
+    queries = []
+
+    async def mock_arun_query(q):
+        queries.append(q)
+        return [(CRATE_URL,)] if q == f"Q:<{TC.ARCP_RDE_1}/>" else []
+
+    monkeypatch.setattr(get, "arun_select", mock_arun_query)
+    for rde_id in TC.ARCP_RDE_1, f"{TC.ARCP_RDE_1}/":
+        r = client.get("/get/crate/", params={"rde_id": rde_id})
+        assert r.status_code == 200
+    assert queries == [f"Q:<{TC.ARCP_RDE_1}/>"]
+    # misses are not remembered
+    for _ in range(2):
+        r = client.get("/get/crate/", params={"rde_id": "arcp://uuid,missing/"})
+        assert r.status_code == 404
+    assert len(queries) == 3
+
+
+def test_upload_remembers_crate_url(mock_client):
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 200
+    assert lookup.crate_urls.get(f"{TC.EXAMPLE_RDE_URI}/") == r.json()["crate_url"]
+
+
+def test_prewarm_crate_urls(monkeypatch):
+    rows = [(f"arcp://uuid,{i}", f"http://filer/{i}.zip") for i in range(3)]
+    monkeypatch.setattr(lookup, "arun_select", as_async(lambda q: rows))
+    monkeypatch.setattr(lookup, "crate_urls", lookup.LookupCache(2))
+    asyncio.run(lookup.prewarm_crate_urls())
+    assert len(lookup.crate_urls) == 2
+    assert lookup.crate_urls.get("arcp://uuid,0/") == "http://filer/0.zip"
+
+
+def test_prewarm_crate_urls_error(monkeypatch):
+    def fail(q):
+        raise httpx.ConnectError("down")
+
+    monkeypatch.setattr(lookup, "arun_select", as_async(fail))
+    asyncio.run(lookup.prewarm_crate_urls())
+    assert len(lookup.crate_urls) == 0
+
+
+# Tests for the query cache
+def test_query_cache_generation():
+    cache = lookup.QueryCache(1024 * 1024, 0)
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return value
+
+    assert cache.get_or_compute("q", lambda: compute(["a"])) == ["a"]
+    assert cache.get_or_compute(("q", "g"), lambda: compute(["b"]), per_graph=True) == ["b"]
+    assert cache.get_or_compute("q", lambda: compute(["x"])) == ["a"]
+    cache.bump()
+    assert cache.get_or_compute("q", lambda: compute(["c"])) == ["c"]
+    # per graph output is never invalidated
+    assert cache.get_or_compute(("q", "g"), lambda: compute(["x"]), per_graph=True) == ["b"]
+    assert calls == [["a"], ["b"], ["c"]]
+
+
+def test_query_cache_per_graph_empty_not_cached():
+    cache = lookup.QueryCache(1024 * 1024, 0)
+    assert cache.get_or_compute(("q", "g"), lambda: [], per_graph=True) == []
+    assert cache.get_or_compute(("q", "g"), lambda: ["a"], per_graph=True) == ["a"]
+    # cross-graph empty output is fine, it is invalidated by uploads
+    assert cache.get_or_compute("q", lambda: []) == []
+    assert cache.get_or_compute("q", lambda: ["a"]) == []
+
+
+def test_query_cache_bounds(monkeypatch):
+    cache = lookup.QueryCache(1000, 10)
+    cache.get_or_compute("q1", lambda: ["a" * 300])
+    cache.get_or_compute("q2", lambda: ["b" * 300])
+    cache.get_or_compute("q1", lambda: None)
+    cache.get_or_compute("q3", lambda: ["c" * 300])
+    # q2 was the least recently used
+    assert cache.get_or_compute("q2", lambda: "miss") == "miss"
+    assert cache.size <= 1000
+    # too large
+    cache.get_or_compute("q4", lambda: ["d" * 2000])
+    assert cache.get_or_compute("q4", lambda: "miss") == "miss"
+    now = lookup.time.monotonic()
+    monkeypatch.setattr(lookup.time, "monotonic", lambda: now + 11)
+    assert cache.get_or_compute("q1", lambda: "expired") == "expired"
+
+
+def test_get_endpoints_cached(monkeypatch):
+    queries = []
+
+    def mock_run_query(q, graph_id=None):
+        queries.append((q, graph_id))
+        return [("x",)]
+
+    monkeypatch.setattr(get, "run_select", mock_run_query)
+    for _ in range(2):
+        assert client.get("/get/workflow/", params={"graph_id": TC.GRAPH_ID_1}).json() == {"result": ["x"]}
+        assert client.get("/get/graphs-for-file/", params={"file_id": TC.FILE_ID_123}).json() == {"result": ["x"]}
+    assert len(queries) == 2
+    lookup.query_cache.bump()
+    client.get("/get/workflow/", params={"graph_id": TC.GRAPH_ID_1})
+    client.get("/get/graphs-for-file/", params={"file_id": TC.FILE_ID_123})
+    assert len(queries) == 3
+    assert queries[-1][1] is None
+
+
+def test_upload_bumps_query_cache_generation(mock_client):
+    generation = lookup.query_cache.generation
+    buf = make_zip(with_metadata=True)
+    r = mock_client.post("/upload/crate/",
+                         files={"crate_path": (TC.CRATE_ZIP, buf.getvalue(), TC.CONTENT_TYPE_ZIP)})
+    assert r.status_code == 200
+    assert lookup.query_cache.generation == generation + 1
+
+
+def test_query_cache_stats():
+    lookup.query_cache.get_or_compute("q", lambda: ["a"])
+    r = client.get("/admin/query-cache/stats")
+    assert r.status_code == 200
+    assert r.json()["result"]["entries"] == 1
+    assert r.json()["result"]["misses"] == 1
+
+
+# Tests for the crate catalog
+def test_catalog_graph(lineage_graph):
+    catalog = lineage_graph.graph(URIRef(CATALOG_GRAPH))
+    assert {(str(s), str(p).rsplit("/", 1)[-1], str(o)) for s, p, o in catalog} == {
+        ("arcp://uuid,c1/ro-crate-metadata.json", "about", "arcp://uuid,c1/"),
+        ("arcp://uuid,c1/", "url", "http://x/c1.zip"),
+        ("arcp://uuid,c1/", "mentions", "arcp://uuid,c1/#a1"),
+        ("arcp://uuid,c1/", "mentions", "arcp://uuid,c1/#a2"),
+    }
+
+
+def test_catalog_queries(lineage_graph):
+    def run(q):
+        return [tuple(str(_) for _ in row) for row in lineage_graph.query(q)]
+
+    assert run(GRAPHS_QUERY) == [("http://x/c1.zip",)]
+    assert run(GRAPH_ID_FOR_RESULT_QUERY.bind(result="file:/out.txt")) == [("http://x/c1.zip",)]
+    assert run(ACTIONS_FOR_RESULT_QUERY.bind(result="file:/mid.txt")) == [("arcp://uuid,c1/#a1",)]
+    # the move action is not mentioned by a crate's root data entity
+    assert run(ACTIONS_FOR_RESULT_QUERY.bind(result="file:/moved.txt")) == []
+
+
+def test_backfill_catalog(monkeypatch, lineage_graph):
+    attempts = []
+
+    def update(q):
+        attempts.append(q)
+        if len(attempts) < 3:
+            raise httpx.ConnectError("All connection attempts failed")
+        lineage_graph.update(q)
+
+    monkeypatch.setattr(catalog, "arun_update", as_async(update))
+    catalog_entries = set(lineage_graph.graph(URIRef(CATALOG_GRAPH)))
+    lineage_graph.remove_graph(lineage_graph.graph(URIRef(CATALOG_GRAPH)))
+    generation = lookup.query_cache.generation
+    asyncio.run(catalog.backfill_catalog(delay=0))
+    assert attempts == [CATALOG_BACKFILL_UPDATE] * 3
+    assert set(lineage_graph.graph(URIRef(CATALOG_GRAPH))) == catalog_entries
+    assert len(catalog_entries) == 4
+    assert lookup.query_cache.generation > generation
+    # runs even if the catalog is not empty
+    lineage_graph.graph(URIRef(CATALOG_GRAPH)).remove((None, URIRef("http://schema.org/url"), None))
+    asyncio.run(catalog.backfill_catalog())
+    assert set(lineage_graph.graph(URIRef(CATALOG_GRAPH))) == catalog_entries
+
+
+def test_rebuild_catalog(monkeypatch, lineage_graph):
+    monkeypatch.setattr(catalog, "run_update", lineage_graph.update)
+    lineage_graph.graph(URIRef(CATALOG_GRAPH)).add((URIRef("x:stale"), URIRef("x:p"), URIRef("x:o")))
+    generation = lookup.query_cache.generation
+    r = client.post("/admin/catalog/rebuild")
+    assert r.status_code == 200
+    assert len(lineage_graph.graph(URIRef(CATALOG_GRAPH))) == 4
+    assert lookup.query_cache.generation == generation + 1
+
+
+# Tests for run summaries
+RUN_TTL = """\
+@prefix schema: <http://schema.org/> .
+<arcp://uuid,r1/ro-crate-metadata.json> a schema:CreativeWork ; schema:about <arcp://uuid,r1/> .
+<arcp://uuid,r1/> schema:mainEntity <arcp://uuid,r1/wf.cwl> ;
+    schema:mentions <arcp://uuid,r1/#run>, <arcp://uuid,r1/#step> .
+<arcp://uuid,r1/#run> a schema:CreateAction ;
+    schema:instrument <arcp://uuid,r1/wf.cwl> ;
+    schema:startTime "2026-01-01T10:00:00Z" ; schema:endTime "2026-01-01T11:00:00Z" ;
+    schema:object <file:/in.txt>, <arcp://uuid,r1/#p> ;
+    schema:result <file:/out.txt> .
+<arcp://uuid,r1/#step> a schema:CreateAction .
+<file:/in.txt> a schema:MediaObject .
+<file:/out.txt> a schema:MediaObject .
+<arcp://uuid,r1/#p> a schema:PropertyValue ; schema:name "n" ; schema:value "42" .
+"""
+
+RUN_SUMMARY = {
+    "version": 1,
+    "workflow": ["arcp://uuid,r1/wf.cwl"],
+    "results": ["file:/out.txt"],
+    "objects": ["file:/in.txt"],
+    "params": [["n", "42"]],
+    "start_time": "2026-01-01T10:00:00Z",
+    "end_time": "2026-01-01T11:00:00Z",
+    "actions": 2,
+}
+
+
+@pytest.fixture
+def run_graph():
+    return Graph().parse(data=RUN_TTL, format="turtle")
+
+
+def test_build_run_summary(run_graph):
+    s = summary.build_run_summary(run_graph.query)
+    assert json.loads(json.dumps(s)) == RUN_SUMMARY
+    s = summary.build_run_summary(Graph().query)
+    assert s["workflow"] == [] and s["actions"] == 0 and s["start_time"] is None
+
+
+def test_summarize_crate(monkeypatch, object_store, run_graph):
+    summary.summarize_crate(TC.CRATE_ZIP, CRATE_URL, run_graph)
+    path = object_store.path / summary.run_summaries.key(TC.CRATE_ZIP)
+    assert json.loads(path.read_bytes()) == RUN_SUMMARY
+    # a stale summary is removed if the new one cannot be built
+    summary.summarize_crate(TC.CRATE_ZIP, CRATE_URL, None)
+    assert not path.exists()
+    assert summary.run_summaries.cache.get(CRATE_URL) is None
+
+
+def test_read_run_summary(monkeypatch):
+    seen = []
+
+    def filer(request):
+        seen.append(str(request.url))
+        if request.url.path.endswith(f"/{TC.CRATE_ZIP}.json"):
+            return httpx.Response(200, json=RUN_SUMMARY)
+        return httpx.Response(404)
+
+    filer_client = httpx.AsyncClient(transport=httpx.MockTransport(filer))
+    monkeypatch.setattr(sidecar, "get_filer_client", lambda: filer_client)
+    assert asyncio.run(summary.read_run_summary(CRATE_URL)) == RUN_SUMMARY
+    assert asyncio.run(summary.read_run_summary(CRATE_URL)) == RUN_SUMMARY
+    assert seen == [summary.run_summaries.url(CRATE_URL)]
+    assert asyncio.run(summary.read_run_summary("http://x/missing.zip")) is None
+
+
+def test_get_endpoints_from_run_summary(monkeypatch):
+    urls = []
+
+    async def mock_read(url):
+        urls.append(url)
+        return RUN_SUMMARY
+
+    monkeypatch.setattr(get, "read_run_summary", mock_read)
+    monkeypatch.setattr(get, "run_query", None)
+    monkeypatch.setattr(get, "run_select", None)
+    for path, field in [("workflow", "workflow"), ("run-results", "results"), ("run-objects", "objects"),
+                        ("run-params", "params"), ("run-summary", None)]:
+        r = client.get(f"/get/{path}/", params={"graph_id": "crate"})
+        assert r.status_code == 200
+        assert r.json() == {"result": RUN_SUMMARY[field] if field else RUN_SUMMARY}
+    assert set(urls) == {f"http://{TC.SEAWEEDFS_FILER}/buckets/{TC.SEAWEEDFS_BUCKET}/crate.zip"}
+
+
+def test_get_run_summary_from_store(monkeypatch, run_graph):
+    seen = []
+
+    def mock_run_query(q, graph_id=None):
+        seen.append(graph_id)
+        return run_graph.query(q)
+
+    monkeypatch.setattr(get, "run_query", mock_run_query)
+    r = client.get("/get/run-summary/", params={"graph_id": "crate"})
+    assert r.status_code == 200
+    assert r.json() == {"result": RUN_SUMMARY}
+    assert set(seen) == {"crate"}
+
+
+def test_rebuild_run_summary(monkeypatch, object_store, run_graph):
+    def mock_run_query(q, graph_id=None):
+        if graph_id == "http://x/bad.zip":
+            raise httpx.ConnectError("down")
+        return run_graph.query(q)
+
+    monkeypatch.setattr(summary, "run_query", mock_run_query)
+    monkeypatch.setattr(admin, "run_query", lambda q: [("http://x/a.zip",), ("http://x/bad.zip",)])
+    r = client.post("/admin/run-summary/rebuild")
+    assert r.status_code == 200
+    assert r.json() == {"result": "success", "summarized": 1, "failed": ["http://x/bad.zip"]}
+    assert (object_store.path / summary.run_summaries.key("a.zip")).exists()
+
+
+# Tests for query templates
+def test_query_template_bind():
+    template = QueryTemplate("t", "SELECT * { $iri{s} ?p $literal{o} VALUES ?id { $iris{ids} } $iri{s} }")
+    query = template.bind(s="file:/a.txt", o='say "hi"\\\n', ids=["file:/b", "file:/c"])
+    assert query == 'SELECT * { <file:/a.txt> ?p "say \\"hi\\"\\\\\\n" VALUES ?id { <file:/b> <file:/c> } <file:/a.txt> }'
+    assert query.name == "t"
+    assert template.bind(s="x:s", o="", ids=[]).endswith("VALUES ?id {  } <x:s> }")
+    for bad in ["file:/a> } DROP ALL {", "file:/a b", ""]:
+        with pytest.raises(InvalidTermError):
+            template.bind(s=bad, o="", ids=[])
+    with pytest.raises(TypeError):
+        template.bind(s="x:s")
+
+
+def test_invalid_id_is_bad_request(monkeypatch):
+    monkeypatch.setattr(get, "run_select", None)
+    r = client.get("/get/graphs-for-result/", params={"result_id": "file:/a> } . ?s ?p ?o { ?s"})
+    assert r.status_code == 400
+    r = client.post("/get/graphs-for-result/", json=["file:/a", "file:/b>"])
+    assert r.status_code == 400
+
+
+# Tests for batched lookups
+def test_fetch_for_ids(monkeypatch):
+    queries = []
+
+    def mock_run_query(q):
+        queries.append(q)
+        return [(TC.RESULT_ID_7, TC.ACTION_ID_1), (TC.RESULT_ID_42, TC.ACTION_ID_1)]
+
+    monkeypatch.setattr(get_utils, "run_select", mock_run_query)
+    monkeypatch.setattr(get_utils.settings, "sparql_batch_size", 2)
+    ids = [TC.RESULT_ID_7, TC.RESULT_ID_8, TC.RESULT_ID_42, TC.RESULT_ID_7]
+    found = get_utils.fetch_for_ids(QueryTemplate("ids", "VALUES ?id { $iris{ids} }"), ids)
+    assert queries == [
+        f"VALUES ?id {{ <{TC.RESULT_ID_7}> <{TC.RESULT_ID_8}> }}",
+        f"VALUES ?id {{ <{TC.RESULT_ID_42}> }}",
+    ]
+    assert found == {TC.RESULT_ID_7: [TC.ACTION_ID_1], TC.RESULT_ID_8: [], TC.RESULT_ID_42: [TC.ACTION_ID_1]}
+
+
+def test_batched_lookup_endpoints(monkeypatch, lineage_graph):
+    monkeypatch.setattr(get_utils, "run_select", lambda q: select_rows(lineage_graph, q))
+    r = client.post("/get/actions-for-result/", json=["file:/out.txt", "file:/mid.txt", "file:/none"])
+    assert r.status_code == 200
+    assert r.json() == {"result": {
+        "file:/out.txt": ["arcp://uuid,c1/#a2"], "file:/mid.txt": ["arcp://uuid,c1/#a1"], "file:/none": []
+    }}
+    r = client.post("/get/graphs-for-result/", json=["file:/out.txt"])
+    assert r.json() == {"result": {"file:/out.txt": ["http://x/c1.zip"]}}
+    r = client.post("/get/objects-for-result/", json=["file:/out.txt"])
+    assert r.json() == {"result": {"file:/out.txt": ["file:/mid.txt"]}}
+    r = client.post("/get/objects-for-action/", json=["arcp://uuid,c1/#a1"])
+    assert r.json() == {"result": {"arcp://uuid,c1/#a1": ["file:/in.txt"]}}
+    r = client.post("/get/results-for-action/", json=["arcp://uuid,c1/#a1"])
+    assert r.json() == {"result": {"arcp://uuid,c1/#a1": ["file:/mid.txt"]}}
+    r = client.post("/get/graphs-for-file/", json=["file:/in.txt"])
+    assert r.json() == {"result": {"file:/in.txt": []}}
+
+
+# Tests for timings and metrics
+def test_histogram_exposition():
+    histogram = metrics.Histogram("h_seconds", "Test.", ("route",), buckets=(0.1, 1.0))
+    histogram.observe(("/a",), 0.05)
+    histogram.observe(("/a",), 0.5)
+    histogram.observe(('"b"',), 5.0)
+    counter = metrics.Counter("c_total", "Test.", ("kind",))
+    counter.inc(("x",), 3)
+    assert list(histogram.collect()) == [
+        "# HELP h_seconds Test.",
+        "# TYPE h_seconds histogram",
+        'h_seconds_bucket{route="\\"b\\"",le="0.1"} 0',
+        'h_seconds_bucket{route="\\"b\\"",le="1.0"} 0',
+        'h_seconds_bucket{route="\\"b\\"",le="+Inf"} 1',
+        'h_seconds_sum{route="\\"b\\""} 5.0',
+        'h_seconds_count{route="\\"b\\""} 1',
+        'h_seconds_bucket{route="/a",le="0.1"} 1',
+        'h_seconds_bucket{route="/a",le="1.0"} 2',
+        'h_seconds_bucket{route="/a",le="+Inf"} 2',
+        'h_seconds_sum{route="/a"} 0.55',
+        'h_seconds_count{route="/a"} 2',
+    ]
+    assert list(counter.collect())[2] == 'c_total{kind="x"} 3'
+
+
+def test_request_timings_header():
+    timings = metrics.RequestTimings()
+    timings.add("sparql", "graph-id-for-result", 0.012, nbytes=300)
+    timings.add("sparql", "graph-id-for-result", 0.008, nbytes=200)
+    timings.add("parse", "graph-id-for-result", 0.001, rows=4)
+    assert timings.server_timing(0.05) == (
+        'sparql.graph-id-for-result;dur=20.0;desc="2 calls / 500 bytes", '
+        'parse.graph-id-for-result;dur=1.0;desc="1 call / 4 rows", '
+        "total;dur=50.0"
+    )
+
+
+def test_server_timing_and_metrics(monkeypatch):
+    def handler(request):
+        body = {
+            "head": {"vars": ["g"]},
+            "results": {"bindings": [{"g": {"type": "uri", "value": TC.EXAMPLE_GRAPH_URI_1}}]},
+        }
+        return httpx.Response(200, json=body, headers={"Content-Type": "application/sparql-results+json"})
+
+    sparql_client = SPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(get, "run_select", lambda q: sparql_client.select(q))
+    r = client.get("/get/graphs-for-result/", params={"result_id": TC.RESULT_ID_7})
+    sparql_client.close()
+    assert r.json() == {"result": [TC.EXAMPLE_GRAPH_URI_1]}
+    entries = {_.split(";")[0]: _ for _ in r.headers["Server-Timing"].split(", ")}
+    assert set(entries) == {"sparql.graph-id-for-result", "parse.graph-id-for-result", "encode.json", "total"}
+    assert entries["parse.graph-id-for-result"].endswith('desc="1 call / 1 rows"')
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    lines = r.text.splitlines()
+    assert "# TYPE provstor_http_request_duration_seconds histogram" in lines
+    assert any(_.startswith(
+        'provstor_http_request_duration_seconds_count{method="GET",route="/get/graphs-for-result/",status="200"} '
+    ) for _ in lines)
+    assert any(_.startswith(
+        'provstor_operation_rows_total{kind="parse",name="graph-id-for-result"} '
+    ) for _ in lines)
+
+
+def test_server_timing_disabled(monkeypatch):
+    middleware = metrics.MetricsMiddleware(app.router, server_timing=False)
+    r = TestClient(middleware).get("/status/")
+    assert r.status_code == 200
+    assert "Server-Timing" not in r.headers
+
+
+# Tests for the slow query log and tracing
+def graph_rows_handler(seen=None):
+    def handler(request):
+        if seen is not None:
+            seen.append(request)
+        body = {
+            "head": {"vars": ["g"]},
+            "results": {"bindings": [{"g": {"type": "uri", "value": TC.EXAMPLE_GRAPH_URI_1}}]},
+        }
+        return httpx.Response(200, json=body, headers={"Content-Type": "application/sparql-results+json"})
+    return handler
+
+
+def test_slow_query_log(monkeypatch, caplog):
+    sparql_client = SPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET, transport=httpx.MockTransport(graph_rows_handler()))
+    ids = [f"file:/{i}" for i in range(8)]
+    query = QueryTemplate("ids", "SELECT ?g { VALUES ?id { $iris{ids} } }").bind(ids=ids)
+    with caplog.at_level("WARNING", logger="provstor_api.slow_queries"):
+        sparql_client.select(query, default_graph=TC.EXAMPLE_GRAPH_URI_1)
+        assert caplog.records == []
+        monkeypatch.setattr(get_utils.settings, "slow_query_threshold", 1e-9)
+        sparql_client.select(query, default_graph=TC.EXAMPLE_GRAPH_URI_1)
+        sparql_client.select(TC.QUERY_SELECT_ALL)
+    sparql_client.close()
+    assert len(caplog.records) == 2
+    message = caplog.records[0].getMessage()
+    assert message.startswith("slow query ids: ")
+    assert f"1 rows, graph {TC.EXAMPLE_GRAPH_URI_1}, " in message
+    assert "'file:/4', '... 8 values'" in message and "file:/5" not in message
+    assert caplog.records[1].getMessage().endswith(f"graph default, query {TC.QUERY_SELECT_ALL!r}")
+
+
+class CollectingExporter:
+
+    enabled = True
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+def test_tracing(monkeypatch):
+    exporter = CollectingExporter()
+    monkeypatch.setattr(tracing, "_exporter", exporter)
+    seen = []
+    sparql_client = SPARQLClient(TC.FUSEKI_URL, TC.FUSEKI_DATASET,
+                                 transport=httpx.MockTransport(graph_rows_handler(seen)))
+    monkeypatch.setattr(get, "run_select", lambda q: sparql_client.select(q))
+    trace_id, caller_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    r = client.get("/get/graphs-for-result/", params={"result_id": TC.RESULT_ID_7},
+                   headers={"traceparent": f"00-{trace_id}-{caller_id}-01"})
+    sparql_client.close()
+    assert r.status_code == 200
+    spans = {span.name: span for span in exporter.spans}
+    assert set(spans) == {
+        "GET /get/graphs-for-result/", "sparql graph-id-for-result", "parse graph-id-for-result", "encode json"
+    }
+    root = spans["GET /get/graphs-for-result/"]
+    assert root.parent_id == caller_id
+    assert root.attributes["http.status_code"] == 200
+    assert {span.trace_id for span in exporter.spans} == {trace_id}
+    assert all(span.parent_id == root.span_id for span in exporter.spans if span is not root)
+    sparql = spans["sparql graph-id-for-result"]
+    assert seen[0].headers["traceparent"] == sparql.traceparent
+    assert spans["parse graph-id-for-result"].attributes["rows"] == 1
+
+
+def test_tracing_disabled():
+    assert tracing.get_exporter().enabled is False
+    with tracing.start_span("noop") as span:
+        assert span is None
+    headers = {}
+    tracing.inject(headers)
+    assert headers == {}
+    with pytest.raises(ValueError):
+        tracing.exporter_from_name("zipkin")
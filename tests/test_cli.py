@@ -16,6 +16,7 @@
 # along with ProvStor. If not, see <https://www.gnu.org/licenses/>.
 
 import shutil
+import time
 import uuid
 
 from click.testing import CliRunner
@@ -35,6 +36,35 @@ def test_cli_load(data_dir, tmp_path, crate_map, zipped):
     assert result.exit_code == 0, result.exception
 
 
+def test_cli_load_many(data_dir, crate_map):
+    runner = CliRunner()
+    args = ["load", str(data_dir / "crate1"), str(data_dir / "crate2")]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.exception
+    # proccrate1's results are already in the store
+    args = ["load", str(data_dir / "crate1"), str(data_dir / "proccrate1")]
+    result = runner.invoke(cli, args)
+    assert result.exit_code != 0
+    assert "failed to load 1 out of 2 crates" in result.output
+
+
+def test_cli_load_no_wait(data_dir, tmp_path, crate_map):
+    runner = CliRunner()
+    crate = shutil.make_archive(tmp_path / "crate1", "zip", data_dir / "crate1")
+    result = runner.invoke(cli, ["load", "--no-wait", str(crate)])
+    assert result.exit_code == 0, result.exception
+    job_id = result.stdout.strip()
+    for _ in range(100):
+        result = runner.invoke(cli, ["job-status", job_id])
+        assert result.exit_code == 0, result.exception
+        if "status: done" in result.stdout.splitlines():
+            break
+        time.sleep(0.1)
+    lines = result.stdout.splitlines()
+    assert "status: done" in lines
+    assert f"job_id: {job_id}" in lines
+
+
 @pytest.mark.parametrize("graph", [None, "crate1"])
 def test_cli_query(graph, crate_map, data_dir):
     query_path = data_dir / "query.txt"
@@ -53,6 +83,21 @@ def test_cli_query(graph, crate_map, data_dir):
         }
 
 
+def test_cli_query_construct(crate_map, tmp_path):
+    query_path = tmp_path / "construct.txt"
+    query_path.write_text(
+        "PREFIX schema: <http://schema.org/>\n"
+        "CONSTRUCT { ?person schema:name ?name }\n"
+        "WHERE { ?person a schema:Person . ?person schema:name ?name }\n"
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, ["query", str(query_path), "-g", "crate1"])
+    assert result.exit_code == 0, result.exception
+    assert result.stdout.rstrip() == "https://orcid.org/0000-0001-8271-5429, http://schema.org/name, Simone Leo"
+    result = runner.invoke(cli, ["query", str(query_path), "-g", "crate1", "-f", "ndjson"])
+    assert result.exit_code != 0
+
+
 @pytest.mark.parametrize("cwd", [False, True])
 def test_cli_get_crate(crate_map, tmp_path, monkeypatch, cwd):
     runner = CliRunner()
@@ -82,6 +127,21 @@ def test_cli_get_file(crate_map, tmp_path, monkeypatch, cwd):
     assert (tmp_path / "ro-crate-metadata.json").is_file()
 
 
+@pytest.mark.parametrize("graph", [None, "crate1"])
+def test_cli_rebuild_member_index(crate_map, data_dir, tmp_path, graph):
+    runner = CliRunner()
+    args = ["rebuild-member-index"]
+    if graph:
+        args.extend(["-g", graph])
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.exception
+    file_id = crate_map["crate1"]["rde_id"] + "ro-crate-metadata.json"
+    result = runner.invoke(cli, ["get-file", file_id, "-o", tmp_path])
+    assert result.exit_code == 0, result.exception
+    expected = (data_dir / "crate1" / "ro-crate-metadata.json").read_bytes()
+    assert (tmp_path / "ro-crate-metadata.json").read_bytes() == expected
+
+
 def test_cli_get_graphs_for_file(crate_map):
     runner = CliRunner()
     args = ["get-graphs-for-file", "file:///path/to/FOOBAR123.deepvariant.vcf.gz"]
@@ -97,6 +157,19 @@ def test_cli_get_graphs_for_file(crate_map):
     assert result.stdout == ""
 
 
+def test_cli_get_graphs_for_file_stdin(crate_map):
+    runner = CliRunner()
+    file_id = "file:///path/to/FOOBAR123.deepvariant.vcf.gz"
+    stdin = f"{file_id}\n\nfile:///not/present\n"
+    result = runner.invoke(cli, ["get-graphs-for-file", "-"], input=stdin)
+    assert result.exit_code == 0, result.exception
+    assert set(result.stdout.splitlines()) >= {
+        f"{file_id}\t{crate_map['proccrate1']['url']}",
+        f"{file_id}\t{crate_map['provcrate1']['url']}",
+    }
+    assert "file:///not/present" not in result.stdout
+
+
 def test_cli_get_graphs_for_result(crate_map):
     runner = CliRunner()
     args = ["get-graphs-for-result", "file:///path/to/FOOBAR123.deepvariant.vcf.gz"]
@@ -242,6 +315,22 @@ def test_cli_get_actions_for_result(crate_map):
     assert result.stdout == ""
 
 
+def test_cli_get_actions_for_result_stdin(crate_map):
+    runner = CliRunner()
+    proccrate2_rde_id = crate_map["proccrate2"]["rde_id"]
+    proccrate1_rde_id = crate_map["proccrate1"]["rde_id"]
+    result_ids = [
+        "file:///path/to/FOOBAR123.deepvariant.ann.norm.vcf.gz",
+        "file:///path/to/FOOBAR123.deepvariant.ann.vcf.gz",
+    ]
+    result = runner.invoke(cli, ["get-actions-for-result", "-"], input="\n".join(result_ids))
+    assert result.exit_code == 0, result.exception
+    assert set(result.stdout.splitlines()) >= {
+        f"{result_ids[0]}\t{proccrate2_rde_id}#normalization-1",
+        f"{result_ids[1]}\t{proccrate1_rde_id}#annotation-1",
+    }
+
+
 def test_cli_get_objects_for_action(crate_map):
     runner = CliRunner()
     proccrate2_rde_id = crate_map["proccrate2"]["rde_id"]
@@ -410,6 +499,17 @@ def test_cli_backtrack(crate_map):
     }
 
 
+def test_cli_lineage_index(crate_map):
+    runner = CliRunner()
+    result = runner.invoke(cli, ["rebuild-lineage-index"])
+    assert result.exit_code == 0, result.exception
+    result = runner.invoke(cli, ["check-lineage-index"])
+    assert result.exit_code == 0, result.exception
+    lines = result.stdout.splitlines()
+    assert "ready: True" in lines
+    assert "consistent: True" in lines
+
+
 def test_cli_cp(crate_map):
     src = "file:///path/to/FOOBAR123.deepvariant.ann.norm.vcf.gz"
     dest = f"file:///{str(uuid.uuid4())}/FOOBAR123.deepvariant.ann.norm.vcf.gz"